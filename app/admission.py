@@ -0,0 +1,222 @@
+import json
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from starlette.responses import JSONResponse
+from config import settings
+import cache, metrics
+
+logger = logging.getLogger("admission")
+
+# Admission control in front of the handlers: a token bucket per client and
+# route class, and a cap on requests in flight in this worker. Turning a request
+# away costs microseconds; letting it queue for the threadpool and the SQLite
+# write lock makes every request behind it slower.
+
+BULK_WRITE = "bulk_write"
+WRITE = "write"
+LIST_READ = "list_read"
+POINT_READ = "point_read"
+
+BULK_WRITES = {("POST", "/scores/bulk"), ("PATCH", "/players/state/"), ("DELETE", "/players/")}
+# POSTs that only read
+READ_POSTS = {("POST", "/players/batch")}
+# Neither limited nor counted
+EXEMPT_PATHS = {"/", "/metrics"}
+EXEMPT_PREFIXES = ("/debug/",)
+# Long-lived streams would hold a slot for minutes; they are only rate limited
+UNCAPPED_PATHS = {"/events/stream"}
+
+SHED = metrics.Counter("admission_shed_total", "Requests turned away by admission control, by reason and route class.",
+                       ("reason", "route_class"))
+ADMITTED = metrics.Counter("admission_admitted_total", "Requests let through by admission control.", ("route_class",))
+STORE_ERRORS = metrics.Counter("admission_store_errors_total", "Bucket store failures; the request was let through unchecked.")
+
+
+def classify(method: str, path: str):
+    # path is the matched route template; None when admission control leaves the request alone
+    if path in EXEMPT_PATHS or path.startswith(EXEMPT_PREFIXES):
+        return None
+    if (method, path) in BULK_WRITES:
+        return BULK_WRITE
+    if method in ("GET", "HEAD") or (method, path) in READ_POSTS:
+        return POINT_READ if "{" in path else LIST_READ
+    return WRITE
+
+
+def limits():
+    # route class -> (tokens per second, burst); a rate of 0 turns the class's bucket off
+    return {
+        BULK_WRITE: (settings.admission_bulk_write_rate, settings.admission_bulk_write_burst),
+        WRITE: (settings.admission_write_rate, settings.admission_write_burst),
+        LIST_READ: (settings.admission_list_read_rate, settings.admission_list_read_burst),
+        POINT_READ: (settings.admission_point_read_rate, settings.admission_point_read_burst),
+    }
+
+
+class MemoryBucketStore:
+    # Buckets local to this process; the least recently used are forgotten past
+    # max_keys, which is the same as finding them full again
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def take(self, key: str, rate: float, burst: float, cost: float = 1):
+        # Seconds until cost tokens are available; 0 means they were taken
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= cost else (cost - tokens) / rate
+            self._buckets[key] = (tokens - cost if wait == 0 else tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+# The same bucket arithmetic as MemoryBucketStore.take, atomic in Redis. The wait is
+# returned as a string: Redis truncates Lua numbers to integers.
+TAKE_SCRIPT = """
+local rate, burst, cost, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= cost then tokens = tokens - cost else wait = (cost - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisBucketStore:
+    # Buckets shared by every worker, in Redis. One awaited EVALSHA per request,
+    # so the event loop never blocks on the round trip and workers can't race on
+    # a bucket.
+
+    def __init__(self, client, prefix: str = "bucket:"):
+        # client is a redis.asyncio.Redis
+        self.client = client
+        self.prefix = prefix
+        self._take = client.register_script(TAKE_SCRIPT)
+
+    async def take(self, key: str, rate: float, burst: float, cost: float = 1):
+        # Wall clock, since the timestamps are compared across processes
+        return float(await self._take(keys=[self.prefix + key], args=[rate, burst, cost, time.time()]))
+
+
+class KeyValueBucketStore:
+    # Buckets in an in-process client with redis-py's get/set(ex=), e.g.
+    # cache.FakeKeyValueClient, for tests. A plain read-modify-write and
+    # synchronous calls: networked stores go through RedisBucketStore.
+
+    def __init__(self, client, prefix: str = "bucket:"):
+        self.client = client
+        self.prefix = prefix
+
+    async def take(self, key: str, rate: float, burst: float, cost: float = 1):
+        # Wall clock, since the timestamps are compared across processes
+        now = time.time()
+        raw = self.client.get(self.prefix + key)
+        tokens, updated = json.loads(raw) if raw is not None else (burst, now)
+        tokens = min(burst, tokens + max(0, now - updated) * rate)
+        wait = 0 if tokens >= cost else (cost - tokens) / rate
+        # Expires once it would have refilled anyway
+        self.client.set(self.prefix + key, json.dumps([tokens - cost if wait == 0 else tokens, now]),
+                        ex=max(1, math.ceil(burst / rate)))
+        return wait
+
+
+def make_store(name: str):
+    if name == "memory":
+        return MemoryBucketStore()
+    if name == "redis":
+        try:
+            import redis.asyncio
+        except ImportError:
+            raise RuntimeError("ADMISSION_STORE=redis requires the redis package (4.2 or later)")
+        # A store that stops answering must not hold requests up for long
+        timeout = settings.admission_store_timeout_ms / 1000
+        return RedisBucketStore(redis.asyncio.Redis.from_url(
+            settings.admission_store_url, socket_timeout=timeout, socket_connect_timeout=timeout))
+    if name == "fake":
+        return KeyValueBucketStore(cache.FakeKeyValueClient())
+    raise ValueError(f"Unknown admission store {name!r}")
+
+
+class AdmissionController:
+    def __init__(self, store=None):
+        self.store = store
+        # Only touched on the event loop
+        self.in_flight = 0
+        self.store_failing = False
+
+    def client_id(self, request):
+        if settings.admission_client_header:
+            value = request.headers.get(settings.admission_client_header)
+            if value:
+                return value
+        return request.client.host if request.client else "unknown"
+
+    async def check(self, request, route_class: str, capped: bool = True):
+        # None to admit, otherwise the 429/503 response to send instead
+        if capped and settings.admission_max_in_flight and self.in_flight >= settings.admission_max_in_flight:
+            return self.shed("overloaded", route_class, 503, settings.admission_retry_after_seconds,
+                             "Server is busy, retry later")
+        rate, burst = limits()[route_class]
+        if rate > 0 and self.store is not None:
+            wait = await self.take(f"{route_class}:{self.client_id(request)}", rate, burst)
+            if wait > 0:
+                return self.shed("rate_limited", route_class, 429, wait, "Too many requests")
+        return None
+
+    async def take(self, key: str, rate: float, burst: float):
+        # Fails open: an unreachable store must not turn every request into a 500.
+        # The in-flight cap still protects the worker meanwhile.
+        try:
+            wait = await self.store.take(key, rate, burst)
+        except Exception:
+            STORE_ERRORS.inc()
+            if not self.store_failing:
+                logger.exception("admission store failed; admitting requests without rate limits")
+            self.store_failing = True
+            return 0
+        if self.store_failing:
+            logger.warning("admission store recovered")
+        self.store_failing = False
+        return wait
+
+    def shed(self, reason: str, route_class: str, status_code: int, retry_after: float, detail: str):
+        SHED.labels(reason, route_class).inc()
+        return JSONResponse({"detail": detail}, status_code=status_code,
+                            headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+    async def admit(self, request, call_next, path: str):
+        route_class = classify(request.method, path)
+        if route_class is None:
+            return await call_next(request)
+        capped = path not in UNCAPPED_PATHS
+        response = await self.check(request, route_class, capped)
+        if response is not None:
+            return response
+        ADMITTED.labels(route_class).inc()
+        if not capped:
+            return await call_next(request)
+        self.in_flight += 1
+        try:
+            return await call_next(request)
+        finally:
+            # Released once the response starts; a streamed body finishes outside the cap
+            self.in_flight -= 1
+
+
+controller = AdmissionController(make_store(settings.admission_store))
+
+metrics.Gauge("admission_in_flight", "Requests holding an admission slot in this worker.",
+              callback=lambda: controller.in_flight)
@@ -0,0 +1,128 @@
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+import crud, profiling, schemas
+
+
+# Every crud function gets an awaitable twin. With an AsyncSession the sync
+# implementation runs through run_sync (greenlet-bridged, so IO goes through the
+# async driver); with a plain Session it runs in the threadpool as before. ORM
+# rows are turned into plain dicts inside that call so nothing lazy-loads afterwards.
+
+def _call_and_release(db, fn, *args, **kwargs):
+    # A handler may hop into the threadpool several times; holding a pooled
+    # connection between hops lets threads and connections deadlock each other
+    try:
+        return profiling.run_profiled(fn, db, *args, **kwargs)
+    finally:
+        db.close()
+
+async def _run(db, fn, *args, **kwargs):
+    run_sync = getattr(db, "run_sync", None)
+    if run_sync is not None:
+        return await run_sync(fn, *args, **kwargs)
+    return await run_in_threadpool(_call_and_release, db, fn, *args, **kwargs)
+
+
+def _player_out(player):
+    return crud.player_dict(player) if player is not None else None
+
+
+async def get_all_players(db, skip: int = 0, limit: int = 10, scores_limit: int = None, after: str = None):
+    return await _run(db, lambda session: [_player_out(player) for player in crud.get_all_players(session, skip, limit, scores_limit, after)])
+
+async def get_player_by_username(db, player_username: str, scores_limit: int = None):
+    return await _run(db, lambda session: _player_out(crud.get_player_by_username(session, player_username, scores_limit)))
+
+async def player_exists(db, player_username: str):
+    return await _run(db, crud.player_exists, player_username)
+
+async def add_player(db, player: schemas.PlayerBase):
+    return await _run(db, lambda session: _player_out(crud.add_player(session, player)))
+
+async def add_riskScore_to_player(db, player_username: str, risk_score: schemas.RiskScoreBase):
+    return await _run(db, lambda session: crud.score_dict(crud.add_riskScore_to_player(session, player_username, risk_score)))
+
+async def bulk_add_riskScores(db, items):
+    return await _run(db, crud.bulk_add_riskScores, items)
+
+async def get_score_summary(db, player_username: str):
+    return await _run(db, crud.get_score_summary, player_username)
+
+async def get_riskScores_for_a_player(db, player_username: str, skip: int = 0, limit: int = 10, **filters):
+    # Keeps the ids alongside the rows so the caller can build the next cursor
+    return await _run(db, lambda session: [
+        (score.id, crud.score_dict(score))
+        for score in crud.get_riskScores_for_a_player(session, player_username, skip, limit, **filters)
+    ])
+
+async def get_players_batch(db, usernames, fields, scores_limit: int = 1):
+    return await _run(db, crud.get_players_batch, usernames, fields, scores_limit)
+
+async def delete_players(db, usernames=None, filters=None, no_scores_since=None):
+    return await _run(db, crud.delete_players, usernames, filters, no_scores_since)
+
+async def get_events(db, after: int = 0, usernames=None, types=None, limit: int = 500):
+    try:
+        return await _run(db, crud.get_events, after, usernames, types, limit)
+    finally:
+        # Change feed streams call this repeatedly on one session; ending the read
+        # transaction each time lets the next call see newer commits
+        if getattr(db, "run_sync", None) is not None:
+            await db.close()
+
+async def get_latest_event_seq(db):
+    return await _run(db, crud.get_latest_event_seq)
+
+async def get_versions(db, keys):
+    return await _run(db, crud.get_versions, keys)
+
+async def get_player_state(db, player_username: str):
+    return await _run(db, crud.get_player_state, player_username)
+
+async def change_player_state(db, player_username: str):
+    return await _run(db, crud.change_player_state, player_username)
+
+async def set_state_of_players(db, state: str, usernames=None, filters=None):
+    return await _run(db, crud.set_state_of_players, state, usernames, filters)
+
+async def delete_player(db, player_username: str):
+    return await _run(db, lambda session: _player_out(crud.delete_player(session, player_username)))
+
+async def get_state_of_players(db, state: str = None):
+    return await _run(db, crud.get_state_of_players, state)
+
+async def get_scores_of_players(db):
+    return await _run(db, crud.get_scores_of_players)
+
+async def get_score_stats(db, percentiles=(), **filters):
+    return await _run(db, crud.get_score_stats, percentiles, **filters)
+
+async def get_score_rollup(db, bucket: str = "hour", **filters):
+    return await _run(db, crud.get_score_rollup, bucket, **filters)
+
+async def get_top_players(db, by: str = "latest", state: str = None, k: int = 100):
+    return await _run(db, crud.get_top_players, by, state, k)
+
+async def get_threshold_crossings(db, threshold: float, since, until=None, state: str = None, limit: int = 100):
+    return await _run(db, crud.get_threshold_crossings, threshold, since, until, state, limit)
+
+async def stream_scores_of_players(db, after: tuple = None, limit: int = None, batch_size: int = 1000):
+    if getattr(db, "run_sync", None) is None:
+        async for group in iterate_in_threadpool(crud.stream_scores_of_players(db, after, limit, batch_size)):
+            yield group
+        return
+
+    # AsyncSession.stream keeps a server-side cursor open; regroup rows per player as they arrive
+    result = await db.stream(crud.scores_export_statement(after).execution_options(yield_per=batch_size))
+    username, scores, emitted = None, [], 0
+    async for row in result:
+        if row[0] != username and scores:
+            yield username, scores
+            emitted += 1
+            if limit is not None and emitted >= limit:
+                await result.close()
+                return
+            scores = []
+        username = row[0]
+        scores.append({"score": row[1], "created_at": row[2]})
+    if scores:
+        yield username, scores
@@ -0,0 +1,808 @@
+"""
+Benchmarks against a throwaway SQLite database.
+
+The suite: a synthetic dataset, a micro-benchmark per crud function and a
+concurrent HTTP driver per route (against a uvicorn it starts itself, or --url).
+Results go to JSON, and compare flags regressions between two result files.
+
+    python benchmark.py generate --db bench.db --players 1000 --scores-per-player 50
+    python benchmark.py crud --db bench.db --output crud.json
+    python benchmark.py http --db bench.db --concurrency 16 --output http.json
+    python benchmark.py compare baseline.json crud.json --threshold 0.15
+    python benchmark.py workers --db bench.db --workers 1 2 4 8
+
+Ad-hoc comparisons:
+
+    python benchmark.py bulk --players 100 --scores 20000
+    python benchmark.py pagination --scores 110000 --page 10000
+    python benchmark.py serialize --rows 50000
+    python benchmark.py load --url http://127.0.0.1:8000 --concurrency 200 [--respect-retry-after]
+    python benchmark.py growth --steps 5 --step-rows 200000
+    python benchmark.py delete --players 3 --scores 100000
+"""
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from sqlalchemy.orm import sessionmaker
+
+import crud, migrations, models, retention, schemas
+from database import make_engine
+
+
+def make_session_factory(path):
+    engine = make_engine(f"sqlite:///{path}")
+    migrations.upgrade(engine)
+    return engine, sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def seed_players(db, count):
+    usernames = [f"bench{i}" for i in range(count)]
+    for username in usernames:
+        db.add(models.Player(
+            username=username,
+            first_name="Bench",
+            last_name="Player",
+            birthday=datetime.date(1990, 1, 1),
+            gender=random.choice(["male", "female", "others"]),
+            state=random.choice(["active", "inactive"]),
+        ))
+    db.commit()
+    return usernames
+
+
+def report(label, rows, elapsed):
+    print(f"{label:<28} {rows:>9} rows {elapsed:>9.3f}s {rows / elapsed:>12.0f} rows/s")
+
+
+def bench_bulk(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine, Session = make_session_factory(os.path.join(tmp, "bench.db"))
+        with Session() as db:
+            usernames = seed_players(db, args.players)
+            items = [
+                (index, schemas.BulkRiskScoreIn(username=random.choice(usernames), score=random.uniform(0, 100)))
+                for index in range(args.scores)
+            ]
+
+            # The per-row path pays one round trip and one commit per score
+            per_row = items[:args.per_row]
+            start = time.perf_counter()
+            for _, item in per_row:
+                crud.add_riskScore_to_player(db, item.username, item)
+            report("per-row add", len(per_row), time.perf_counter() - start)
+
+            start = time.perf_counter()
+            inserted, _ = crud.bulk_add_riskScores(db, items)
+            report("bulk_add_riskScores", inserted, time.perf_counter() - start)
+        engine.dispose()
+
+
+def best_of(repeat, fn):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def bench_pagination(args):
+    # One player with a long history; compare OFFSET and keyset at the same depth
+    with tempfile.TemporaryDirectory() as tmp:
+        engine, Session = make_session_factory(os.path.join(tmp, "bench.db"))
+        with Session() as db:
+            (username,) = seed_players(db, 1)
+            start_at = datetime.datetime(2020, 1, 1)
+            crud.bulk_add_riskScores(db, [
+                (index, schemas.BulkRiskScoreIn(
+                    username=username, score=random.uniform(0, 100),
+                    created_at=start_at + datetime.timedelta(seconds=index)))
+                for index in range(args.scores)
+            ], chunk_size=5000)
+
+            for page in sorted({1, args.page // 100, args.page // 10, args.page}):
+                skip = (page - 1) * args.page_size
+                rows, offset_elapsed = best_of(3, lambda: crud.get_riskScores_for_a_player(db, username, skip=skip, limit=args.page_size))
+
+                # the keyset cursor for this page is the last row of the previous one
+                previous = crud.get_riskScores_for_a_player(db, username, skip=skip - 1, limit=1) if skip else []
+                after = (previous[0].created_at, previous[0].id) if previous else None
+                keyset_rows, keyset_elapsed = best_of(3, lambda: crud.get_riskScores_for_a_player(db, username, limit=args.page_size, after=after))
+
+                assert [row.id for row in rows] == [row.id for row in keyset_rows]
+                print(f"page {page:>6}  offset {offset_elapsed * 1000:>8.2f}ms  keyset {keyset_elapsed * 1000:>8.2f}ms")
+        engine.dispose()
+
+
+def bench_serialize(args):
+    # What the list endpoints spend after the query: validate + encode vs the trusted fast path
+    from typing import List
+    from fastapi.encoders import jsonable_encoder
+    from pydantic import parse_obj_as
+    from starlette.responses import JSONResponse
+    import responses
+
+    now = datetime.datetime.now()
+    datasets = {
+        "/players/state/": (List[schemas.AllPlayerStateOut], [
+            {"username": f"bench{i}", "first_name": "Bench", "last_name": "Player", "middle_name": "", "state": "active"}
+            for i in range(args.rows)
+        ]),
+        "/players/scores/": (List[schemas.AllPlayerScoreOut], [
+            {"username": f"bench{i}", "risk_scores": [{"score": random.uniform(0, 100), "created_at": now}] * 5}
+            for i in range(args.rows // 5)
+        ]),
+    }
+    for path, (model, rows) in datasets.items():
+        start = time.perf_counter()
+        validated = JSONResponse(jsonable_encoder(parse_obj_as(model, rows))).body
+        report(f"{path} validated", len(rows), time.perf_counter() - start)
+
+        start = time.perf_counter()
+        fast = responses.render(rows)
+        report(f"{path} fast", len(rows), time.perf_counter() - start)
+        assert fast == validated
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def bench_load(args):
+    # Seed one player, then hammer it with a 3:1 mix of reads and score writes
+    base = args.url.rstrip("/")
+    username = f"load{random.randrange(10**9)}"
+    requests.post(f"{base}/players/", json={
+        "username": username, "first_name": "Load", "last_name": "Test", "middle_name": "",
+        "birthday": "1990-01-01", "gender": "male", "state": "active",
+    }).raise_for_status()
+
+    local = threading.local()
+
+    def call(index):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = time.perf_counter()
+        if index % 4 == 0:
+            response = session.post(f"{base}/players/{username}/scores/", json={"score": random.uniform(0, 100)})
+        else:
+            response = session.get(f"{base}/players/{username}/state/")
+        latency = time.perf_counter() - start
+        if args.respect_retry_after and response.status_code in (429, 503):
+            # A well-behaved client backs off before its next request
+            time.sleep(float(response.headers.get("Retry-After", 1)))
+        return latency, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(call, range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency * 1000 for latency, _ in results]
+    # 429/503 from admission control are reported apart from errors
+    shed = [latency * 1000 for latency, status in results if status in (429, 503)]
+    served = [latency * 1000 for latency, status in results if status < 400]
+    errors = len(results) - len(shed) - len(served)
+    print(f"{args.requests} requests, concurrency {args.concurrency}, {len(shed)} shed, {errors} errors")
+    print(f"{args.requests / elapsed:.0f} req/s  mean {statistics.mean(latencies):.1f}ms  "
+          f"p50 {percentile(latencies, 50):.1f}ms  p99 {percentile(latencies, 99):.1f}ms")
+    if shed and served:
+        print(f"served {len(served) / elapsed:.0f} req/s  p50 {percentile(served, 50):.1f}ms  p99 {percentile(served, 99):.1f}ms;  "
+              f"shed p99 {percentile(shed, 99):.1f}ms")
+
+
+def bench_growth(args):
+    # Single-row insert latency as scores grows, then again once pruned back to the retention window
+    with tempfile.TemporaryDirectory() as tmp:
+        engine, Session = make_session_factory(os.path.join(tmp, "bench.db"))
+        with Session() as db:
+            usernames = seed_players(db, args.players)
+            oldest = datetime.datetime.now() - datetime.timedelta(days=args.days)
+
+            def sample(label):
+                latencies = []
+                for _ in range(args.samples):
+                    start = time.perf_counter()
+                    crud.add_riskScore_to_player(db, random.choice(usernames), schemas.RiskScoreBase(score=random.uniform(0, 100)))
+                    latencies.append((time.perf_counter() - start) * 1000)
+                rows = db.query(models.RiskScores).count()
+                print(f"{label:<14} {rows:>10} rows  p50 {percentile(latencies, 50):>7.2f}ms  p99 {percentile(latencies, 99):>7.2f}ms")
+
+            sample("empty")
+            for step in range(args.steps):
+                crud.bulk_add_riskScores(db, [
+                    (index, schemas.BulkRiskScoreIn(
+                        username=random.choice(usernames), score=random.uniform(0, 100),
+                        created_at=oldest + datetime.timedelta(seconds=random.uniform(0, args.days * 86400))))
+                    for index in range(args.step_rows)
+                ], chunk_size=5000)
+                sample(f"step {step + 1}")
+
+            start = time.perf_counter()
+            cutoff = datetime.datetime.now() - datetime.timedelta(days=args.keep_days)
+            result = retention.prune(db, cutoff, archive_dir=os.path.join(tmp, "archive"))
+            print(f"pruned {result['deleted']} rows in {result['batches']} batches, {time.perf_counter() - start:.1f}s")
+            sample("after prune")
+        engine.dispose()
+
+
+def bench_delete(args):
+    # Deleting players with long histories: the ORM cascade that loads every score,
+    # the single-player route, and the chunked bulk delete, all on the same data
+    with tempfile.TemporaryDirectory() as tmp:
+        engine, Session = make_session_factory(os.path.join(tmp, "bench.db"))
+        with Session() as db:
+            def seed(prefix):
+                usernames = [f"{prefix}{index}" for index in range(args.players)]
+                for username in usernames:
+                    crud.add_player(db, schemas.PlayerBase(
+                        username=username, first_name="Bench", last_name="Player", middle_name="",
+                        birthday=datetime.date(1990, 1, 1), gender="male", state="inactive"))
+                crud.bulk_add_riskScores(db, [
+                    (index, schemas.BulkRiskScoreIn(username=username, score=random.uniform(0, 100)))
+                    for username in usernames for index in range(args.scores)
+                ], chunk_size=5000)
+                return usernames
+
+            def orm_cascade(usernames):
+                # What delete_player did before passive_deletes
+                for username in usernames:
+                    player = db.query(models.Player).filter(models.Player.username == username).first()
+                    len(player.risk_scores)
+                    db.delete(player)
+                    db.commit()
+
+            def delete_player(usernames):
+                for username in usernames:
+                    crud.delete_player(db, username)
+
+            for label, delete in [
+                ("ORM cascade", orm_cascade),
+                ("delete_player", delete_player),
+                ("delete_players (bulk)", lambda usernames: crud.delete_players(db, usernames)),
+            ]:
+                usernames = seed("benchdelete")
+                db.expunge_all()
+                tracemalloc.start()
+                start = time.perf_counter()
+                delete(usernames)
+                elapsed = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                assert db.query(models.RiskScores).count() == 0
+                print(f"{label:<24} {args.players} x {args.scores} scores {elapsed:>8.2f}s  peak {peak / 2 ** 20:>8.1f} MiB")
+        engine.dispose()
+
+
+FIRST_NAMES = ["Alex", "Sam", "Maria", "Jonas", "Aisha", "Chen", "Lena", "Omar", "Sofia", "Noah"]
+LAST_NAMES = ["Hansen", "Nielsen", "Garcia", "Khan", "Larsen", "Smith", "Novak", "Rossi", "Berg", "Ito"]
+
+
+def generate_dataset(db, players, scores_per_player, days=365, seed=0):
+    # Deterministic for a seed. Scores per player are exponential around the mean
+    # (a few heavy players, many light ones), scores lean low (beta(2, 5) * 100)
+    # and timestamps bunch up towards now.
+    rng = random.Random(seed)
+    now = datetime.datetime.now().replace(microsecond=0)
+    usernames = [f"player{index:07d}" for index in range(players)]
+    db.bulk_insert_mappings(models.Player, [{
+        "username": username,
+        "first_name": rng.choice(FIRST_NAMES),
+        "last_name": rng.choice(LAST_NAMES),
+        "middle_name": "",
+        "birthday": datetime.date(1950, 1, 1) + datetime.timedelta(days=rng.randrange(56 * 365)),
+        "gender": rng.choices(["male", "female", "others"], weights=[48, 48, 4])[0],
+        "state": "active" if rng.random() < 0.85 else "inactive",
+    } for username in usernames])
+    db.bulk_insert_mappings(models.PlayerScoreSummary, [
+        {"player_username": username, "count": 0, "total": 0.0, "total_sq": 0.0} for username in usernames
+    ])
+    db.commit()
+
+    items = []
+    for username in usernames:
+        for _ in range(int(rng.expovariate(1 / scores_per_player)) if scores_per_player else 0):
+            # Generated data is trusted, so skip pydantic validation
+            items.append((len(items), schemas.BulkRiskScoreIn.construct(
+                username=username,
+                score=round(rng.betavariate(2, 5) * 100, 2),
+                created_at=now - datetime.timedelta(seconds=int(days * 86400 * rng.betavariate(1, 3))),
+            )))
+            if len(items) == 50000:
+                crud.bulk_add_riskScores(db, items, chunk_size=5000)
+                items = []
+    if items:
+        crud.bulk_add_riskScores(db, items, chunk_size=5000)
+    return usernames
+
+
+def ensure_dataset(args, tmp):
+    # Reuse --db when it exists; otherwise generate one (into --db, or a temp file)
+    path = args.db or os.path.join(tmp, "bench.db")
+    fresh = not os.path.exists(path)
+    engine, Session = make_session_factory(path)
+    with Session() as db:
+        if fresh:
+            start = time.perf_counter()
+            generate_dataset(db, args.players, args.scores_per_player, args.days, args.seed)
+            print(f"generated {args.players} players in {time.perf_counter() - start:.1f}s -> {path}")
+        usernames = [username for (username,) in db.query(models.Player.username).order_by(models.Player.username)]
+    return path, engine, Session, usernames
+
+
+def bench_generate(args):
+    if not args.db:
+        raise SystemExit("--db is required")
+    if os.path.exists(args.db):
+        raise SystemExit(f"{args.db} already exists")
+    path, engine, Session, usernames = ensure_dataset(args, None)
+    with Session() as db:
+        scores = db.query(models.RiskScores).count()
+    print(f"{len(usernames)} players, {scores} scores")
+    engine.dispose()
+
+
+def latency_stats(latencies, elapsed, errors=0):
+    latencies_ms = [latency * 1000 for latency in latencies]
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "ops_per_sec": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "mean_ms": round(statistics.mean(latencies_ms), 3),
+        "p50_ms": round(percentile(latencies_ms, 50), 3),
+        "p95_ms": round(percentile(latencies_ms, 95), 3),
+        "p99_ms": round(percentile(latencies_ms, 99), 3),
+    }
+
+
+def print_stats(name, stats):
+    print(f"{name:<44} {stats['ops_per_sec']:>10.1f}/s  p50 {stats['p50_ms']:>8.2f}ms  "
+          f"p95 {stats['p95_ms']:>8.2f}ms  p99 {stats['p99_ms']:>8.2f}ms" + (f"  {stats['errors']} errors" if stats["errors"] else ""))
+
+
+def crud_benchmarks(usernames, rng):
+    # (name, iterations divisor, call); heavy whole-table reads run fewer times
+    created = []
+    fresh = itertools.count()
+    pick = lambda: rng.choice(usernames)
+
+    def add_player(db):
+        username = f"benchnew{next(fresh):07d}"
+        created.append(username)
+        crud.add_player(db, schemas.PlayerBase(
+            username=username, first_name="Bench", last_name="Player", middle_name="",
+            birthday=datetime.date(1990, 1, 1), gender="male", state="active"))
+
+    def delete_player(db):
+        # Deletes the players add_player made, so the dataset keeps its shape
+        if created:
+            crud.delete_player(db, created.pop())
+
+    def paged_scores(db):
+        username = pick()
+        page = crud.get_riskScores_for_a_player(db, username, limit=50)
+        if page:
+            crud.get_riskScores_for_a_player(db, username, limit=50, after=(page[-1].created_at, page[-1].id))
+
+    return [
+        ("get_all_players", 1, lambda db: crud.get_all_players(db, limit=50)),
+        ("get_all_players(scores_limit=5)", 1, lambda db: crud.get_all_players(db, limit=50, scores_limit=5)),
+        ("get_player_by_username", 1, lambda db: crud.get_player_by_username(db, pick())),
+        ("player_exists", 1, lambda db: crud.player_exists(db, pick())),
+        ("get_top_players(latest)", 1, lambda db: crud.get_top_players(db, "latest", k=100)),
+        ("get_top_players(average, active)", 1, lambda db: crud.get_top_players(db, "average", "active", k=100)),
+        ("get_threshold_crossings(80, 1h)", 1, lambda db: crud.get_threshold_crossings(
+            db, 80, datetime.datetime.now() - datetime.timedelta(hours=1))),
+        ("get_threshold_crossings(80, 7d)", 1, lambda db: crud.get_threshold_crossings(
+            db, 80, datetime.datetime.now() - datetime.timedelta(days=7))),
+        ("get_threshold_crossings(90, 1y)", 1, lambda db: crud.get_threshold_crossings(
+            db, 90, datetime.datetime.now() - datetime.timedelta(days=365))),
+        ("get_players_batch(200)", 1, lambda db: crud.get_players_batch(
+            db, [pick() for _ in range(200)], [field.value for field in schemas.PlayerField], 5)),
+        ("add_player", 1, add_player),
+        ("add_riskScore_to_player", 1, lambda db: crud.add_riskScore_to_player(db, pick(), schemas.RiskScoreBase(score=rng.uniform(0, 100)))),
+        ("bulk_add_riskScores(100)", 1, lambda db: crud.bulk_add_riskScores(db, [
+            (index, schemas.BulkRiskScoreIn(username=pick(), score=rng.uniform(0, 100))) for index in range(100)])),
+        ("get_score_summary", 1, lambda db: crud.get_score_summary(db, pick())),
+        ("get_riskScores_for_a_player", 1, lambda db: crud.get_riskScores_for_a_player(db, pick(), limit=50)),
+        ("get_riskScores_for_a_player(keyset x2)", 1, paged_scores),
+        ("get_player_state", 1, lambda db: crud.get_player_state(db, pick())),
+        ("change_player_state", 1, lambda db: crud.change_player_state(db, pick())),
+        ("set_state_of_players(10)", 1, lambda db: crud.set_state_of_players(db, rng.choice(["active", "inactive"]), rng.sample(usernames, 10))),
+        ("delete_player", 1, delete_player),
+        ("get_state_of_players", 20, lambda db: crud.get_state_of_players(db)),
+        ("get_state_of_players(state)", 20, lambda db: crud.get_state_of_players(db, "inactive")),
+        ("get_scores_of_players", 50, lambda db: crud.get_scores_of_players(db)),
+        ("stream_scores_of_players(100)", 1, lambda db: list(crud.stream_scores_of_players(db, limit=100))),
+        ("get_score_stats(player)", 1, lambda db: crud.get_score_stats(db, [50, 95], player_username=pick())),
+        ("get_score_stats", 20, lambda db: crud.get_score_stats(db, [50, 95, 99])),
+        ("get_score_rollup(player, day)", 1, lambda db: crud.get_score_rollup(db, "day", player_username=pick())),
+        ("get_score_rollup(day)", 20, lambda db: crud.get_score_rollup(db, "day")),
+    ]
+
+
+def bench_crud(args):
+    rng = random.Random(args.seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        path, engine, Session, usernames = ensure_dataset(args, tmp)
+        for name, divisor, call in crud_benchmarks(usernames, rng):
+            if args.only and args.only not in name:
+                continue
+            iterations = max(3, args.iterations // divisor)
+            latencies = []
+            with Session() as db:
+                call(db)  # warm-up
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    call_start = time.perf_counter()
+                    call(db)
+                    latencies.append(time.perf_counter() - call_start)
+                elapsed = time.perf_counter() - start
+            results[name] = latency_stats(latencies, elapsed)
+            print_stats(name, results[name])
+        engine.dispose()
+    save_results(args, "crud", results)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_server(server, base, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"{base}/", timeout=1)
+            return base
+        except requests.RequestException:
+            time.sleep(0.1)
+    server.terminate()
+    raise SystemExit(f"server at {base} did not start")
+
+
+def start_server(path, log):
+    # uvicorn running this app against the given SQLite file, on a free local port
+    port = free_port()
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{path}")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+    return server, wait_for_server(server, f"http://127.0.0.1:{port}")
+
+
+def http_routes(usernames, rng):
+    # (name, requests divisor, setup, call); call(session, base, item) gets one item of
+    # setup(session, base, count). Whole-table reads run fewer requests.
+    fresh = itertools.count()
+    pick = lambda: rng.choice(usernames)
+
+    def new_player(username):
+        return {"username": username, "first_name": "Load", "last_name": "Test", "middle_name": "",
+                "birthday": "1990-01-01", "gender": "male", "state": "active"}
+
+    def create_victims(session, base, count):
+        victims = [f"benchvictim{next(fresh):07d}" for _ in range(count)]
+        for username in victims:
+            session.post(f"{base}/players/", json=new_player(username)).raise_for_status()
+        return victims
+
+    def state_etag(session, base, count):
+        return [session.get(f"{base}/players/state/").headers.get("ETag", "")] * count
+
+    def player_page(session, base, item):
+        return session.get(f"{base}/players/{pick()}/scores/", params={"limit": 50})
+
+    return [
+        ("GET /", 1, None, lambda session, base, item: session.get(f"{base}/")),
+        ("GET /players/", 2, None, lambda session, base, item: session.get(f"{base}/players/", params={"limit": 50})),
+        ("GET /players/{username}", 1, None, lambda session, base, item: session.get(f"{base}/players/{pick()}")),
+        ("GET /players/top/", 1, None, lambda session, base, item: session.get(f"{base}/players/top/", params={"state": "active"})),
+        ("GET /players/crossings/", 1, None, lambda session, base, item: session.get(f"{base}/players/crossings/", params={"threshold": 80})),
+        ("POST /players/batch (200)", 1, None, lambda session, base, item: session.post(f"{base}/players/batch", json={
+            "usernames": [pick() for _ in range(200)], "scores_limit": 5})),
+        ("POST /players/", 1, None, lambda session, base, item: session.post(f"{base}/players/", json=new_player(f"benchnew{next(fresh):07d}"))),
+        ("POST /players/{username}/scores/", 1, None, lambda session, base, item: session.post(
+            f"{base}/players/{pick()}/scores/", json={"score": rng.uniform(0, 100)})),
+        ("POST /scores/bulk (100)", 1, None, lambda session, base, item: session.post(f"{base}/scores/bulk", json=[
+            {"username": pick(), "score": rng.uniform(0, 100)} for _ in range(100)])),
+        ("GET /players/{username}/scores/", 1, None, player_page),
+        ("GET /players/scores/", 20, None, lambda session, base, item: session.get(f"{base}/players/scores/")),
+        ("GET /players/scores/export (100)", 1, None, lambda session, base, item: session.get(f"{base}/players/scores/export", params={"limit": 100})),
+        ("GET /players/{username}/scores/stats/", 1, None, lambda session, base, item: session.get(f"{base}/players/{pick()}/scores/stats/")),
+        ("GET /players/{username}/scores/summary/", 1, None, lambda session, base, item: session.get(f"{base}/players/{pick()}/scores/summary/")),
+        ("GET /scores/stats/", 10, None, lambda session, base, item: session.get(f"{base}/scores/stats/")),
+        ("GET /scores/rollup/", 1, None, lambda session, base, item: session.get(f"{base}/scores/rollup/", params={"bucket": "day", "username": pick()})),
+        ("GET /players/{username}/state/", 1, None, lambda session, base, item: session.get(f"{base}/players/{pick()}/state/")),
+        ("GET /players/state/", 5, None, lambda session, base, item: session.get(f"{base}/players/state/")),
+        ("GET /players/state/ (If-None-Match)", 1, state_etag, lambda session, base, item: session.get(
+            f"{base}/players/state/", headers={"If-None-Match": item})),
+        ("PATCH /players/state/ (10)", 1, None, lambda session, base, item: session.patch(
+            f"{base}/players/state/", json={"state": rng.choice(["active", "inactive"]), "usernames": rng.sample(usernames, 10)})),
+        ("PATCH /players/{username}/state/", 1, None, lambda session, base, item: session.patch(f"{base}/players/{pick()}/state/")),
+        ("DELETE /players/{username}", 1, create_victims, lambda session, base, item: session.delete(f"{base}/players/{item}")),
+        ("GET /metrics", 1, None, lambda session, base, item: session.get(f"{base}/metrics")),
+    ]
+
+
+def drive(base, call, items, concurrency):
+    local = threading.local()
+
+    def one(item):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            status = call(session, base, item).status_code
+        except requests.RequestException:
+            # e.g. the server dropped the connection after an unhandled error
+            status = 599
+        return time.perf_counter() - start, status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, items))
+    elapsed = time.perf_counter() - start
+    errors = sum(1 for _, status in results if status >= 400)
+    return latency_stats([latency for latency, _ in results], elapsed, errors)
+
+
+def bench_http(args):
+    rng = random.Random(args.seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        server = None
+        if args.url:
+            base = args.url.rstrip("/")
+            usernames = [player["username"] for player in requests.get(f"{base}/players/state/").json()]
+        else:
+            path, engine, Session, usernames = ensure_dataset(args, tmp)
+            engine.dispose()
+            if args.db:
+                # Leave the reusable dataset untouched; the routes write to a copy
+                shutil.copy(path, os.path.join(tmp, "run.db"))
+                path = os.path.join(tmp, "run.db")
+            log_path = os.path.join(tmp, "server.log")
+            log = open(log_path, "w")
+            server, base = start_server(path, log)
+        try:
+            setup_session = requests.Session()
+            for name, divisor, setup, call in http_routes(usernames, rng):
+                if args.only and args.only not in name:
+                    continue
+                count = max(args.concurrency, args.requests // divisor)
+                items = setup(setup_session, base, count) if setup else [None] * count
+                drive(base, call, items[:args.concurrency], args.concurrency)  # warm-up
+                if setup:
+                    items = setup(setup_session, base, count)
+                results[name] = drive(base, call, items, args.concurrency)
+                print_stats(name, results[name])
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+                log.close()
+                with open(log_path) as log:
+                    errors = [line.rstrip() for line in log if "Error" in line or "Exception" in line]
+                if errors:
+                    print(f"server logged {len(errors)} error lines, last: {errors[-1]}")
+    save_results(args, "http", results)
+
+
+WORKER_PATHS = ["/players/{username}", "/players/{username}/state/", "/players/{username}/scores/summary/", "/players/{username}/scores/"]
+
+
+def _client_process(base, usernames, count, threads, seed):
+    # One load-generating process; several of them keep the client off the critical path
+    rng = random.Random(seed)
+    local = threading.local()
+
+    def one(_):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        path = rng.choice(WORKER_PATHS).format(username=rng.choice(usernames))
+        start = time.perf_counter()
+        try:
+            status = session.get(base + path).status_code
+        except requests.RequestException:
+            status = 599
+        return time.perf_counter() - start, status
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return list(pool.map(one, range(count)))
+
+
+def start_gunicorn(path, workers, log):
+    port = free_port()
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{path}", WEB_CONCURRENCY=str(workers), BIND=f"127.0.0.1:{port}")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "main:app"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+    return server, wait_for_server(server, f"http://127.0.0.1:{port}")
+
+
+def bench_workers(args):
+    # Read-heavy throughput through gunicorn as the worker count grows
+    from concurrent.futures import ProcessPoolExecutor
+
+    print(f"{os.cpu_count()} CPUs")
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        path, engine, Session, usernames = ensure_dataset(args, tmp)
+        engine.dispose()
+        with ProcessPoolExecutor(max_workers=args.client_processes) as clients:
+            for workers in args.workers:
+                with open(os.path.join(tmp, f"gunicorn-{workers}.log"), "w") as log:
+                    server, base = start_gunicorn(path, workers, log)
+                    try:
+                        per_client = args.requests // args.client_processes
+                        threads = max(1, args.concurrency // args.client_processes)
+                        # warm-up: every worker opens its connections and fills its caches
+                        list(clients.map(_client_process, *zip(*[(base, usernames, threads * 4, threads, seed)
+                                                                 for seed in range(args.client_processes)])))
+                        start = time.perf_counter()
+                        samples = clients.map(_client_process, *zip(*[(base, usernames, per_client, threads, args.seed + seed)
+                                                                      for seed in range(args.client_processes)]))
+                        samples = [sample for chunk in samples for sample in chunk]
+                        elapsed = time.perf_counter() - start
+                    finally:
+                        server.terminate()
+                        server.wait()
+                errors = sum(1 for _, status in samples if status >= 400)
+                name = f"{workers} workers"
+                results[name] = latency_stats([latency for latency, _ in samples], elapsed, errors)
+                print_stats(name, results[name])
+    save_results(args, "workers", results)
+
+
+def save_results(args, suite, results):
+    if not args.output:
+        return
+    config = {key: value for key, value in vars(args).items() if key not in ("func", "output")}
+    document = {
+        "suite": suite,
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "config": config,
+        "environment": {"python": platform.python_version(), "sqlite": sqlite3.sqlite_version, "platform": platform.platform()},
+        "results": results,
+    }
+    with open(args.output, "w") as output:
+        json.dump(document, output, indent=2)
+    print(f"results written to {args.output}")
+
+
+def bench_compare(args):
+    # Flags throughput drops and p95 increases beyond the threshold
+    with open(args.baseline) as baseline_file, open(args.current) as current_file:
+        baseline, current = json.load(baseline_file)["results"], json.load(current_file)["results"]
+    regressions = 0
+    for name in sorted(set(baseline) & set(current)):
+        before, after = baseline[name], current[name]
+        ops_change = after["ops_per_sec"] / before["ops_per_sec"] - 1
+        p95_change = after["p95_ms"] / before["p95_ms"] - 1 if before["p95_ms"] else 0.0
+        regressed = ops_change < -args.threshold or p95_change > args.threshold
+        regressions += regressed
+        print(f"{'REGRESSION' if regressed else 'ok':<10} {name:<44} ops {ops_change:>+7.1%}  p95 {p95_change:>+7.1%}")
+    for name in sorted(set(baseline) ^ set(current)):
+        print(f"{'missing':<10} {name} (only in {'baseline' if name in baseline else 'current'})")
+    print(f"{regressions} regressions beyond {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+def add_dataset_arguments(parser):
+    parser.add_argument("--db", help="SQLite file holding the dataset; generated when missing, a temp file when omitted")
+    parser.add_argument("--players", type=int, default=1000)
+    parser.add_argument("--scores-per-player", type=int, default=50, help="mean; the per-player count is exponential")
+    parser.add_argument("--days", type=int, default=365, help="history spanned by the generated scores")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    bulk = commands.add_parser("bulk", help="per-row score inserts vs the bulk ingestion path")
+    bulk.add_argument("--players", type=int, default=100)
+    bulk.add_argument("--scores", type=int, default=20000)
+    bulk.add_argument("--per-row", type=int, default=2000, help="rows to push through the per-row path")
+    bulk.set_defaults(func=bench_bulk)
+
+    pagination = commands.add_parser("pagination", help="OFFSET vs keyset page latency as pages get deeper")
+    pagination.add_argument("--scores", type=int, default=110000)
+    pagination.add_argument("--page", type=int, default=10000)
+    pagination.add_argument("--page-size", type=int, default=10)
+    pagination.set_defaults(func=bench_pagination)
+
+    serialize = commands.add_parser("serialize", help="response serialization rows/sec, validated vs fast JSON")
+    serialize.add_argument("--rows", type=int, default=50000)
+    serialize.set_defaults(func=bench_serialize)
+
+    load = commands.add_parser("load", help="concurrent HTTP load against a running server")
+    load.add_argument("--url", default="http://127.0.0.1:8000")
+    load.add_argument("--concurrency", type=int, default=200)
+    load.add_argument("--requests", type=int, default=5000)
+    load.add_argument("--respect-retry-after", action="store_true", help="sleep for Retry-After after a 429/503")
+    load.set_defaults(func=bench_load)
+
+    growth = commands.add_parser("growth", help="insert latency as the scores table grows, and after pruning it")
+    growth.add_argument("--players", type=int, default=1000)
+    growth.add_argument("--steps", type=int, default=5)
+    growth.add_argument("--step-rows", type=int, default=200000)
+    growth.add_argument("--samples", type=int, default=500, help="single-row inserts timed per step")
+    growth.add_argument("--days", type=int, default=365, help="spread of created_at across the seeded rows")
+    growth.add_argument("--keep-days", type=int, default=30, help="retention window for the final prune")
+    growth.set_defaults(func=bench_growth)
+
+    delete = commands.add_parser("delete", help="deleting players with long score histories, ORM cascade vs database cascade")
+    delete.add_argument("--players", type=int, default=3)
+    delete.add_argument("--scores", type=int, default=100000, help="scores per player")
+    delete.set_defaults(func=bench_delete)
+
+    generate = commands.add_parser("generate", help="write a synthetic dataset to a SQLite file")
+    add_dataset_arguments(generate)
+    generate.set_defaults(func=bench_generate)
+
+    crud_suite = commands.add_parser("crud", help="micro-benchmark every crud function")
+    add_dataset_arguments(crud_suite)
+    crud_suite.add_argument("--iterations", type=int, default=200)
+    crud_suite.add_argument("--only", help="only benchmarks whose name contains this")
+    crud_suite.add_argument("--output", help="write results to this JSON file")
+    crud_suite.set_defaults(func=bench_crud)
+
+    http_suite = commands.add_parser("http", help="concurrent load against every route")
+    add_dataset_arguments(http_suite)
+    http_suite.add_argument("--url", help="drive an already running server instead of starting one")
+    http_suite.add_argument("--concurrency", type=int, default=16)
+    http_suite.add_argument("--requests", type=int, default=500, help="requests per route")
+    http_suite.add_argument("--only", help="only routes whose name contains this")
+    http_suite.add_argument("--output", help="write results to this JSON file")
+    http_suite.set_defaults(func=bench_http)
+
+    workers = commands.add_parser("workers", help="read throughput through gunicorn for each worker count")
+    add_dataset_arguments(workers)
+    workers.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    workers.add_argument("--concurrency", type=int, default=64)
+    workers.add_argument("--client-processes", type=int, default=4)
+    workers.add_argument("--requests", type=int, default=4000)
+    workers.add_argument("--output", help="write results to this JSON file")
+    workers.set_defaults(func=bench_workers)
+
+    compare = commands.add_parser("compare", help="compare two result files and flag regressions")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument("--threshold", type=float, default=0.1, help="relative change that counts as a regression")
+    compare.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args) or 0)
+
+
+if __name__ == "__main__":
+    main()
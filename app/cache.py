@@ -0,0 +1,198 @@
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+from config import settings
+import metrics
+
+# Left in place of an invalidated entry for a short while, so a read that loaded
+# the row before the write committed can't put the old state back (see PlayerCache.fill)
+INVALIDATED = "invalidated"
+
+
+class MemoryBackend:
+    # Bounded LRU with a per-entry TTL, local to this process
+
+    def __init__(self, max_size: int = 10000, ttl: float = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def add(self, key, value):
+        # set, unless an unexpired entry is already there
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] >= time.monotonic():
+                return False
+            self._set(key, value)
+            return True
+
+    def _set(self, key, value, ttl: float = None):
+        self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class KeyValueBackend:
+    # Any client with redis-py's get/set(ex=)/delete works, e.g. redis.Redis or FakeKeyValueClient
+
+    def __init__(self, client, ttl: float = 60, prefix: str = "player:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl: float = None):
+        self.client.set(self.prefix + key, json.dumps(value), ex=max(1, math.ceil(self.ttl if ttl is None else ttl)))
+
+    def add(self, key, value):
+        # SET NX: atomic in the store, so it never overwrites an invalidation
+        return bool(self.client.set(self.prefix + key, json.dumps(value), ex=max(1, int(self.ttl)), nx=True))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in list(self.client.scan_iter(self.prefix + "*")):
+            self.client.delete(key)
+
+
+class FakeKeyValueClient:
+    # In-process stand-in for an external KV store, for tests and local runs
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None, nx=False):
+        with self._lock:
+            if nx:
+                entry = self._data.get(key)
+                if entry is not None and (entry[1] is None or entry[1] >= time.monotonic()):
+                    return None
+            self._data[key] = (value, time.monotonic() + ex if ex else None)
+        return True
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(self._data.pop(key, None) is not None for key in keys)
+
+    def scan_iter(self, match="*"):
+        prefix = match.rstrip("*")
+        with self._lock:
+            return [key for key in self._data if key.startswith(prefix)]
+
+
+class PlayerCache:
+    def __init__(self, backend=None):
+        # backend None disables caching but keeps the counters meaningful
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        # Bumped by invalidate_all; fills started before it are dropped
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, username: str):
+        value = self.backend.get(username) if self.backend is not None else None
+        if value == INVALIDATED:
+            value = None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def fill(self, username: str, value: dict, generation: int = None):
+        # After a miss, with the row read from the database. Only fills an empty
+        # slot: when a write committed and invalidated the entry while the row was
+        # being read, the invalidation is still there and the possibly stale row
+        # is not cached. generation is self.generation from before the read.
+        if self.backend is None or (generation is not None and generation != self.generation):
+            return False
+        return self.backend.add(username, value)
+
+    def invalidate(self, username: str):
+        # Called after the write commits
+        if self.backend is not None:
+            self.backend.set(username, INVALIDATED, ttl=settings.player_cache_invalidation_ttl)
+
+    def invalidate_all(self):
+        # Other workers' in-flight fills can still land after a clear; their
+        # entries live at most player_cache_ttl
+        with self._lock:
+            self.generation += 1
+        if self.backend is not None:
+            self.backend.clear()
+
+    def clear(self):
+        self.invalidate_all()
+        with self._lock:
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def make_backend(name: str):
+    if name == "memory":
+        return MemoryBackend(settings.player_cache_size, settings.player_cache_ttl)
+    if name == "redis":
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("PLAYER_CACHE_BACKEND=redis requires the redis package")
+        return KeyValueBackend(redis.Redis.from_url(settings.player_cache_url), settings.player_cache_ttl)
+    if name == "fake":
+        return KeyValueBackend(FakeKeyValueClient(), settings.player_cache_ttl)
+    if name == "none":
+        return None
+    raise ValueError(f"Unknown player cache backend {name!r}")
+
+
+player_cache = PlayerCache(make_backend(settings.player_cache_backend))
+
+metrics.Counter("player_cache_hits_total", "Player cache lookups served from the cache.", callback=lambda: player_cache.hits)
+metrics.Counter("player_cache_misses_total", "Player cache lookups that fell through to the database.", callback=lambda: player_cache.misses)
@@ -0,0 +1,125 @@
+from pydantic import BaseSettings
+from typing import Dict, Optional
+
+
+class Settings(BaseSettings):
+    database_url: str = "sqlite:///./softwareTask_app.db"
+
+    # Pool settings; ignored for in-memory SQLite, which needs a single connection
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_timeout: float = 30
+    pool_pre_ping: bool = False
+    pool_recycle: int = -1
+    # Server-side statement timeout in milliseconds (PostgreSQL); 0 disables it
+    statement_timeout_ms: int = 0
+
+    # Applied through PRAGMAs on every new SQLite connection
+    sqlite_journal_mode: str = "WAL"
+    sqlite_synchronous: str = "NORMAL"
+    sqlite_mmap_size: int = 256 * 1024 * 1024
+    sqlite_cache_size: int = -64000
+    sqlite_busy_timeout_ms: int = 5000
+    # SQLite leaves foreign keys unenforced unless asked; deletes rely on ON DELETE CASCADE
+    sqlite_foreign_keys: bool = True
+
+    # Username lookups: memory (per-process LRU), redis (shared, needs PLAYER_CACHE_URL), fake or none
+    player_cache_backend: str = "memory"
+    player_cache_size: int = 10000
+    player_cache_ttl: float = 60
+    player_cache_url: str = "redis://localhost:6379/0"
+    # How long a write keeps its player out of the cache; longer than any read takes
+    player_cache_invalidation_ttl: float = 2
+
+    # Render large read-only listings straight from trusted dicts (orjson when installed)
+    fast_json_responses: bool = True
+
+    # Serve every route through an AsyncSession instead of the threadpool-bound Session
+    database_async: bool = False
+    # Defaults to the sync URL with its async driver swapped in (aiosqlite / asyncpg)
+    async_database_url: Optional[str] = None
+
+    # Change feed: crud writes go to the change_events outbox and to in-process
+    # subscribers; streams re-read the outbox after every quiet poll interval
+    change_feed_enabled: bool = True
+    change_feed_buffer_size: int = 1000
+    change_feed_poll_seconds: float = 5
+    change_feed_read_limit: int = 500
+    # Streams end after this long; SSE clients reconnect with Last-Event-ID
+    change_feed_max_stream_seconds: float = 300
+    change_feed_retention_hours: float = 24
+    # Outside SQLite, sequence numbers can commit out of order; outbox reads skip rows
+    # younger than this so a late commit is still read. Longer write transactions can be missed.
+    change_feed_commit_lag_ms: float = 1000
+
+    # Most usernames accepted by one POST /players/batch
+    batch_max_usernames: int = 1000
+    # Most scores accepted by one POST /scores/bulk, which inserts them in a single transaction
+    bulk_scores_max_items: int = 10000
+
+    # Polled read endpoints answer If-None-Match from version counters (see versions.py)
+    etags_enabled: bool = True
+    read_cache_control: str = "private, no-cache"
+    # Per-route overrides keyed by route template, e.g. {"/players/state/": "public, max-age=5"}
+    cache_control_overrides: Dict[str, str] = {}
+
+    # Write-behind for POST /players/{username}/scores/: answer 202 and group-commit
+    # every score_ingest_flush_rows scores or score_ingest_flush_interval_ms
+    buffered_score_ingest: bool = False
+    score_ingest_queue_size: int = 10000
+    score_ingest_flush_rows: int = 500
+    score_ingest_flush_interval_ms: int = 50
+    # A group that hits a transient error (e.g. "database is locked") is retried this
+    # often, backing off exponentially from score_ingest_retry_backoff_ms
+    score_ingest_retries: int = 3
+    score_ingest_retry_backoff_ms: int = 50
+
+    # Apply pending migrations from the app's startup event. Otherwise startup only
+    # checks the schema version and refuses to serve an out-of-date database.
+    # gunicorn.conf.py migrates once in the master and turns this off for its workers.
+    migrate_on_startup: bool = True
+
+    # Score retention (manage.py prune-scores): rows older than retention_days go in
+    # batches of retention_batch_size, sleeping retention_pause_ms between them
+    retention_days: Optional[int] = None
+    retention_batch_size: int = 1000
+    retention_pause_ms: int = 0
+    # Pruned rows are kept here as gzipped NDJSON; score history reads with a since
+    # before the prune cutoff merge them back in
+    retention_archive_dir: Optional[str] = None
+
+    # Per-request cProfile: every request when profile_all_requests is set, otherwise only
+    # those carrying X-Profile-Timestamp (unix seconds) and X-Profile-Signature =
+    # hex HMAC-SHA256(profiling_secret, "METHOD /path TIMESTAMP"). /debug/ needs the signature too.
+    profiling_enabled: bool = False
+    profiling_secret: Optional[str] = None
+    profiling_signature_max_age: float = 60
+    profile_all_requests: bool = False
+    profiling_dir: str = "./profiles"
+
+    # Admission control: a token bucket per client (its address, or admission_client_header
+    # behind a trusted proxy) and route class, rates in requests per second (0 = unlimited),
+    # answering 429; plus a cap on requests in flight per worker (0 = none), answering 503
+    admission_enabled: bool = False
+    admission_store: str = "memory"
+    admission_store_url: str = "redis://localhost:6379/1"
+    admission_store_timeout_ms: float = 50
+    admission_client_header: Optional[str] = None
+    admission_max_in_flight: int = 16
+    admission_retry_after_seconds: float = 1
+    admission_bulk_write_rate: float = 1
+    admission_bulk_write_burst: float = 5
+    admission_write_rate: float = 50
+    admission_write_burst: float = 100
+    admission_list_read_rate: float = 10
+    admission_list_read_burst: float = 20
+    admission_point_read_rate: float = 100
+    admission_point_read_burst: float = 200
+
+    # Statements slower than this are logged to the "slow_query" logger; 0 disables it
+    slow_query_threshold_ms: float = 200
+    # Parameters carry usernames and other personal data
+    slow_query_log_parameters: bool = False
+
+
+settings = Settings()
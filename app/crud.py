@@ -1,13 +1,97 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, case, func, literal_column, or_, select, update
+from sqlalchemy.orm import Session, aliased, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 import datetime
 import models, schemas
+from config import settings
+from cache import player_cache
+import events, retention, summary, versions
 from collections import defaultdict
+from itertools import groupby
+from typing import List, Tuple
+import math
+import numpy as np
+from operator import itemgetter
 
-def get_all_players(db: Session, skip: int = 0, limit: int = 10):
-    return db.query(models.Player).offset(skip).limit(limit).all()
+def latest_scores_for_players(db: Session, usernames: List[str], scores_limit: int):
+    # Latest N scores per player in one windowed query over idx_username_createdat
+    rank = func.row_number().over(
+        partition_by=models.RiskScores.player_username,
+        order_by=(models.RiskScores.created_at.desc(), models.RiskScores.id.desc()),
+    ).label("rank")
+    ranked = select(models.RiskScores, rank).where(models.RiskScores.player_username.in_(usernames)).subquery()
+    latest = aliased(models.RiskScores, ranked)
+    rows = db.query(latest).filter(ranked.c.rank <= scores_limit).order_by(latest.player_username, latest.created_at, latest.id)
 
-def get_player_by_username(db: Session, player_username: str):
-    return db.query(models.Player).filter(models.Player.username == player_username).first()
+    scores = defaultdict(list)
+    for score in rows:
+        scores[score.player_username].append(score)
+    return scores
+
+def _load_risk_scores(db: Session, query, scores_limit: int = None):
+    # Either every score in one extra IN query, or only the latest scores_limit per player
+    if scores_limit is None:
+        return query.options(selectinload(models.Player.risk_scores)).all()
+    players = query.all()
+    if players:
+        scores = latest_scores_for_players(db, [player.username for player in players], scores_limit)
+        for player in players:
+            set_committed_value(player, "risk_scores", scores.get(player.username, []))
+    return players
+
+def get_all_players(db: Session, skip: int = 0, limit: int = 10, scores_limit: int = None, after: str = None):
+    # Ordered by the primary key; `after` is the keyset alternative to skip
+    query = db.query(models.Player).order_by(models.Player.username)
+    if after is not None:
+        query = query.filter(models.Player.username > after)
+    elif skip:
+        query = query.offset(skip)
+    return _load_risk_scores(db, query.limit(limit), scores_limit)
+
+def get_player_by_username(db: Session, player_username: str, scores_limit: int = None):
+    players = _load_risk_scores(db, db.query(models.Player).filter(models.Player.username == player_username), scores_limit)
+    return players[0] if players else None
+
+def score_dict(score):
+    return {"score": score.score, "created_at": score.created_at}
+
+def player_dict(player):
+    # Same keys, in the same order, as schemas.PlayerOut
+    return {
+        "username": player.username,
+        "first_name": player.first_name,
+        "last_name": player.last_name,
+        "middle_name": player.middle_name,
+        "birthday": player.birthday,
+        "gender": player.gender,
+        "state": player.state,
+        "risk_scores": [score_dict(score) for score in player.risk_scores],
+    }
+
+# Only what the state endpoints return; selected as plain rows, not entities
+STATE_COLUMNS = (
+    models.Player.username,
+    models.Player.first_name,
+    models.Player.last_name,
+    models.Player.middle_name,
+    models.Player.state,
+)
+
+def get_cached_player(db: Session, player_username: str):
+    # Read-through: hits skip the database entirely, misses are not cached
+    cached = player_cache.get(player_username)
+    if cached is not None:
+        return cached
+    generation = player_cache.generation
+    row = db.query(*STATE_COLUMNS).filter(models.Player.username == player_username).first()
+    if row is None:
+        return None
+    state = dict(row._mapping)
+    player_cache.fill(player_username, state, generation)
+    return state
+
+def player_exists(db: Session, player_username: str):
+    return get_cached_player(db, player_username) is not None
 
 def add_player(db: Session, player: schemas.PlayerBase):
     db_player = models.Player(
@@ -20,7 +104,12 @@ def add_player(db: Session, player: schemas.PlayerBase):
         state = player.state,
     )
     db.add(db_player)
+    db.add(models.PlayerScoreSummary(player_username=player.username, count=0, total=0.0, total_sq=0.0))
+    versions.bump(db, [versions.PLAYERS, versions.player_key(player.username)])
+    events.record(db, [(events.PLAYER_CREATED, player.username, player.dict(exclude={"username"}))])
     db.commit()
+    events.publish(db)
+    # No invalidation: misses are never cached, and a deleted player's entry was already invalidated
     db.refresh(db_player)
     return db_player
 
@@ -31,63 +120,255 @@ def add_riskScore_to_player(db: Session, player_username: str, risk_score: schem
         created_at=datetime.datetime.now() 
     )
     db.add(db_risk_score)
+    summary.apply_scores(db, [(player_username, db_risk_score.score, db_risk_score.created_at)])
+    versions.bump(db, [versions.SCORES, versions.player_key(player_username)])
+    events.record(db, [(events.SCORE_ADDED, player_username, score_dict(db_risk_score))])
     db.commit()
+    events.publish(db)
     db.refresh(db_risk_score)
     return db_risk_score
 
-def get_riskScores_for_a_player(db: Session, player_username: str, skip: int = 0, limit: int = 10):
-    return db.query(models.RiskScores).filter(models.RiskScores.player_username == player_username).offset(skip).limit(limit).all()
+def bulk_add_riskScores(db: Session, items: List[Tuple[int, schemas.BulkRiskScoreIn]], chunk_size: int = 500):
+    # items are (index, score) pairs so failures can point back at the request body
+    usernames = list({item.username for _, item in items})
+    existing = set()
+    for start in range(0, len(usernames), chunk_size):
+        chunk = usernames[start:start + chunk_size]
+        existing.update(
+            username for (username,) in
+            db.query(models.Player.username).filter(models.Player.username.in_(chunk))
+        )
+
+    now = datetime.datetime.now()
+    mappings, failed = [], []
+    for index, item in items:
+        if item.username not in existing:
+            failed.append({"index": index, "username": item.username, "errors": [{"msg": "Player does not exist"}]})
+            continue
+        mappings.append({
+            "score": item.score,
+            "player_username": item.username,
+            "created_at": item.created_at or now,
+        })
+
+    # All chunks go out in one transaction: one commit for the whole batch
+    for start in range(0, len(mappings), chunk_size):
+        db.bulk_insert_mappings(models.RiskScores, mappings[start:start + chunk_size])
+    summary.apply_scores(db, [(row["player_username"], row["score"], row["created_at"]) for row in mappings])
+    if mappings:
+        versions.bump(db, [versions.SCORES] + [versions.player_key(row["player_username"]) for row in mappings])
+    events.record(db, [(events.SCORE_ADDED, row["player_username"], {"score": row["score"], "created_at": row["created_at"]}) for row in mappings])
+    db.commit()
+    events.publish(db)
+    return len(mappings), failed
+
+def get_score_summary(db: Session, player_username: str):
+    return summary.get_summary(db, player_username)
+
+def get_riskScores_for_a_player(db: Session, player_username: str, skip: int = 0, limit: int = 10,
+                                since: datetime.datetime = None, until: datetime.datetime = None,
+                                descending: bool = False, after: tuple = None):
+    # (created_at, id) ordering is served by idx_username_createdat, whose
+    # entries end in the rowid, so keyset pages cost the same at any depth
+    created_at, score_id = models.RiskScores.created_at, models.RiskScores.id
+    order = (created_at.desc(), score_id.desc()) if descending else (created_at, score_id)
+    query = _filter_scores(db.query(models.RiskScores), player_username=player_username, since=since, until=until).order_by(*order)
+    if after is not None:
+        after_created_at, after_id = schemas.naive_local(after[0]), after[1]
+        # Spelled with a leading range on created_at so the planner can seek the index
+        if descending:
+            query = query.filter(created_at <= after_created_at, or_(created_at < after_created_at, score_id < after_id))
+        else:
+            query = query.filter(created_at >= after_created_at, or_(created_at > after_created_at, score_id > after_id))
+    elif skip:
+        query = query.offset(skip)
+
+    horizon = retention.reaches_archive(since, descending, after)
+    if horizon is None:
+        return query.limit(limit).all()
+
+    # The window reaches back into archived history: page over the live rows and the archive together
+    wanted = (skip if after is None else 0) + limit
+    live = query.offset(None).limit(wanted).all()
+    if descending and len(live) == wanted and live[-1].created_at >= horizon:
+        return live[wanted - limit:]
+    live_ids = {score.id for score in live}
+    archived = [score for score in retention.read_archive(player_username, since, until, descending, after, wanted) if score.id not in live_ids]
+    merged = sorted(live + archived, key=lambda score: (score.created_at, score.id), reverse=descending)
+    return merged[wanted - limit:wanted]
+
+def get_events(db: Session, after: int = 0, usernames: List[str] = None, types: List[str] = None, limit: int = 500):
+    return events.read_outbox(db, after, usernames, types, limit)
+
+def get_latest_event_seq(db: Session):
+    return events.latest_seq(db)
+
+def get_versions(db: Session, keys: List[str]):
+    return versions.get_versions(db, keys)
 
 def get_player_state(db: Session, player_username: str):
-    player = db.query(models.Player).filter(models.Player.username == player_username).first()
-    if player is not None:
-        return {
-            "username": player.username,
-            "first_name": player.first_name,
-            "last_name": player.last_name,
-            "middle_name": player.middle_name,
-            "state": player.state
-        }
-    else:
-        return None
+    return get_cached_player(db, player_username)
+
+def _supports_update_returning(db: Session):
+    return db.get_bind().dialect.update_returning
 
 def change_player_state(db: Session, player_username: str):
-    player = db.query(models.Player).filter(models.Player.username == player_username).first()
-    if player is None:
+    # A single conditional UPDATE, so concurrent toggles can't lose each other's writes
+    toggled = case((models.Player.state == 'active', 'inactive'), else_='active')
+    statement = (
+        update(models.Player)
+        .where(models.Player.username == player_username)
+        .values(state=toggled)
+        .execution_options(synchronize_session=False)
+    )
+    if _supports_update_returning(db):
+        row = db.execute(statement.returning(*STATE_COLUMNS)).first()
+    else:
+        # The UPDATE holds the row lock until commit, so this read sees our own write
+        updated = db.execute(statement).rowcount
+        row = db.query(*STATE_COLUMNS).filter(models.Player.username == player_username).first() if updated else None
+    if row is None:
+        db.rollback()
         return None
-    if player.state == 'active':
-        player.state = 'inactive'
-        db.commit()
-    elif player.state == 'inactive':
-        player.state = 'active'
-        db.commit()
-    return {
-        "username": player.username,
-        "first_name": player.first_name,
-        "last_name": player.last_name,
-        "middle_name": player.middle_name,
-        "state": player.state
-    }
+    state = dict(row._mapping)
+    versions.bump(db, [versions.PLAYERS, versions.player_key(player_username)])
+    events.record(db, [(events.STATE_CHANGED, player_username, {"state": state["state"]})])
+    db.commit()
+    events.publish(db)
+    player_cache.invalidate(player_username)
+    return state
+
+def set_state_of_players(db: Session, state: str, usernames: List[str] = None, filters: dict = None, chunk_size: int = 500):
+    # One set-based UPDATE (per chunk of usernames), all in one transaction
+    statement = update(models.Player).values(state=state).execution_options(synchronize_session=False)
+    for column, value in (filters or {}).items():
+        if value is not None:
+            statement = statement.where(getattr(models.Player, column) == value)
+
+    # With RETURNING the change feed gets one event per updated player; without
+    # it, one event with no username stands for everyone the filter matched
+    returning = settings.change_feed_enabled and _supports_update_returning(db)
+    if returning:
+        statement = statement.returning(models.Player.username)
+    statements = [statement] if usernames is None else [
+        statement.where(models.Player.username.in_(usernames[start:start + chunk_size]))
+        for start in range(0, len(usernames), chunk_size)
+    ]
+    updated, changed = 0, []
+    for chunk_statement in statements:
+        result = db.execute(chunk_statement)
+        if returning:
+            changed.extend(username for (username,) in result)
+        else:
+            updated += result.rowcount
+    if returning:
+        updated = len(changed)
+    if usernames is None:
+        versions.bump(db, [versions.PLAYERS, versions.ALL_PLAYERS])
+    else:
+        versions.bump(db, [versions.PLAYERS] + [versions.player_key(username) for username in usernames])
+    if returning:
+        events.record(db, [(events.STATE_CHANGED, username, {"state": state}) for username in changed])
+    elif updated:
+        events.record(db, [(events.STATE_CHANGED, None, {"state": state, "usernames": usernames, "filter": filters or {}})])
+    db.commit()
+    events.publish(db)
+
+    if usernames is None:
+        player_cache.invalidate_all()
+    else:
+        for username in usernames:
+            player_cache.invalidate(username)
+    return updated
 
 def delete_player(db: Session, player_username: str):
     player = db.query(models.Player).filter(models.Player.username == player_username).first()
     if player is None:
         return None
+    # Only the profile is echoed back; the database cascades the scores without them being read
+    set_committed_value(player, "risk_scores", [])
     db.delete(player)
+    versions.bump(db, [versions.PLAYERS, versions.SCORES, versions.player_key(player_username)])
+    events.record(db, [(events.PLAYER_DELETED, player_username, {})])
     db.commit()
+    events.publish(db)
+    player_cache.invalidate(player_username)
     return player
 
-def get_state_of_players(db: Session):
-    players = db.query(models.Player).all()
+def delete_players(db: Session, usernames: List[str] = None, filters: dict = None,
+                   no_scores_since: datetime.datetime = None, chunk_size: int = 500):
+    # Set-based deletes in chunks, each its own short transaction; scores and
+    # summaries go through ON DELETE CASCADE
+    query = db.query(models.Player.username)
+    for column, value in (filters or {}).items():
+        if value is not None:
+            query = query.filter(getattr(models.Player, column) == value)
+    if no_scores_since is not None:
+        # One seek on idx_username_createdat per candidate player
+        recent = select(models.RiskScores.id).where(
+            models.RiskScores.player_username == models.Player.username,
+            models.RiskScores.created_at >= schemas.naive_local(no_scores_since),
+        )
+        query = query.filter(~recent.exists())
+
+    deleted, last = 0, None
+    chunks = iter([usernames[start:start + chunk_size] for start in range(0, len(usernames), chunk_size)]) if usernames is not None else None
+    while True:
+        if chunks is not None:
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+            batch = [username for (username,) in query.filter(models.Player.username.in_(chunk))]
+        else:
+            # Keyset over the primary key, so every round makes progress
+            page = query if last is None else query.filter(models.Player.username > last)
+            batch = [username for (username,) in page.order_by(models.Player.username).limit(chunk_size)]
+            if not batch:
+                break
+            last = batch[-1]
+        if batch:
+            deleted += db.query(models.Player).filter(models.Player.username.in_(batch)).delete(synchronize_session=False)
+            versions.bump(db, [versions.PLAYERS, versions.SCORES] + [versions.player_key(username) for username in batch])
+            events.record(db, [(events.PLAYER_DELETED, username, {}) for username in batch])
+            db.commit()
+            events.publish(db)
+            for username in batch:
+                player_cache.invalidate(username)
+    return deleted
+
+def get_state_of_players(db: Session, state: str = None):
+    query = db.query(*STATE_COLUMNS)
+    if state is not None:
+        # Served by the index on players.state
+        query = query.filter(models.Player.state == state)
+    return [dict(row._mapping) for row in query]
+
+# Columns a batch lookup may ask for, in schemas.PlayerOut order
+BATCH_COLUMNS = {
+    "first_name": models.Player.first_name,
+    "last_name": models.Player.last_name,
+    "middle_name": models.Player.middle_name,
+    "birthday": models.Player.birthday,
+    "gender": models.Player.gender,
+    "state": models.Player.state,
+}
+
+def get_players_batch(db: Session, usernames: List[str], fields: List[str], scores_limit: int = 1):
+    # One IN query for the requested columns, plus one windowed query for the
+    # latest scores; results follow the request order, misses have found=False
+    unique = list(dict.fromkeys(usernames))
+    columns = [BATCH_COLUMNS[field] for field in BATCH_COLUMNS if field in fields]
+    rows = db.query(models.Player.username, *columns).filter(models.Player.username.in_(unique)) if unique else []
+    found = {row.username: dict(row._mapping) for row in rows}
+
+    if "risk_scores" in fields:
+        scores = latest_scores_for_players(db, list(found), scores_limit) if found and scores_limit else {}
+        for username, player in found.items():
+            player["risk_scores"] = [score_dict(score) for score in scores.get(username, [])]
+
     return [
-        {
-            "username": player.username,
-            "first_name": player.first_name,
-            "last_name": player.last_name,
-            "middle_name": player.middle_name,
-            "state": player.state
-        }
-        for player in players
+        {"username": username, "found": True, **found[username]} if username in found else {"username": username, "found": False}
+        for username in usernames
     ]
 
 def get_scores_of_players(db: Session):
@@ -99,8 +380,143 @@ def get_scores_of_players(db: Session):
         grouped_scores[score.player_username].append({"score": score.score, "created_at": score.created_at})
 
     return [{"username": username, "risk_scores": scores} for username, scores in grouped_scores.items()]
-        
 
-    
+def scores_export_statement(after: tuple = None):
+    statement = select(
+        models.RiskScores.player_username,
+        models.RiskScores.score,
+        models.RiskScores.created_at,
+    ).order_by(models.RiskScores.player_username, models.RiskScores.created_at)
+    if after is not None:
+        username, created_at = after[0], schemas.naive_local(after[1])
+        statement = statement.where(or_(
+            models.RiskScores.player_username > username,
+            and_(models.RiskScores.player_username == username, models.RiskScores.created_at > created_at),
+        ))
+    return statement
+
+def group_scores_by_player(rows, limit: int = None):
+    emitted = 0
+    for username, group in groupby(rows, key=itemgetter(0)):
+        yield username, [{"score": score, "created_at": created_at} for _, score, created_at in group]
+        emitted += 1
+        if limit is not None and emitted >= limit:
+            break
+
+def stream_scores_of_players(db: Session, after: tuple = None, limit: int = None, batch_size: int = 1000):
+    # Walks idx_username_createdat with a server-side cursor so only one player's
+    # scores are held in memory at a time
+    statement = scores_export_statement(after).execution_options(yield_per=batch_size)
+    yield from group_scores_by_player(db.execute(statement), limit)
+
+def _filter_scores(query, player_username: str = None, state: str = None, gender: str = None,
+                   since: datetime.datetime = None, until: datetime.datetime = None):
+    if player_username is not None:
+        query = query.filter(models.RiskScores.player_username == player_username)
+    if state is not None or gender is not None:
+        query = query.join(models.Player, models.Player.username == models.RiskScores.player_username)
+        if state is not None:
+            query = query.filter(models.Player.state == state)
+        if gender is not None:
+            query = query.filter(models.Player.gender == gender)
+    if since is not None:
+        query = query.filter(models.RiskScores.created_at >= schemas.naive_local(since))
+    if until is not None:
+        query = query.filter(models.RiskScores.created_at < schemas.naive_local(until))
+    return query
 
+def _score_percentiles(db: Session, filters: dict, percentiles: List[float]):
+    if not percentiles:
+        return {}
+    labels = [f"p{pct:g}" for pct in percentiles]
+    if db.get_bind().dialect.name == "postgresql":
+        columns = [func.percentile_cont(pct / 100).within_group(models.RiskScores.score) for pct in percentiles]
+        values = _filter_scores(db.query(*columns), **filters).one()
+        return {label: value for label, value in zip(labels, values) if value is not None}
 
+    # No ordered-set aggregates here: stream the score column into a NumPy array instead
+    rows = _filter_scores(db.query(models.RiskScores.score), **filters).yield_per(10000)
+    scores = np.fromiter((score for (score,) in rows), dtype=float)
+    if scores.size == 0:
+        return {}
+    return dict(zip(labels, np.percentile(scores, percentiles).tolist()))
+
+def get_score_stats(db: Session, percentiles: List[float] = (), **filters):
+    count, mean, low, high, total_sq = _filter_scores(db.query(
+        func.count(models.RiskScores.id),
+        func.avg(models.RiskScores.score),
+        func.min(models.RiskScores.score),
+        func.max(models.RiskScores.score),
+        func.sum(models.RiskScores.score * models.RiskScores.score),
+    ), **filters).one()
+    stats = {"count": count, "mean": mean, "min": low, "max": high, "stddev": None, "percentiles": {}}
+    if count:
+        # Population standard deviation from the running sums
+        stats["stddev"] = math.sqrt(max(total_sq / count - mean * mean, 0.0))
+        stats["percentiles"] = _score_percentiles(db, filters, list(percentiles))
+    return stats
+
+def get_top_players(db: Session, by: str = "latest", state: str = None, k: int = 100):
+    # Walks ix_summary_latest_score or ix_summary_mean_score from the top and stops
+    # after k players; players without any score are left out
+    Summary = models.PlayerScoreSummary
+    key = Summary.latest_score if by == "latest" else models.MEAN_SCORE
+    query = db.query(
+        Summary.player_username.label("username"),
+        models.Player.state,
+        Summary.latest_score,
+        Summary.latest_at,
+        models.MEAN_SCORE.label("mean"),
+        Summary.count,
+    ).join(models.Player, models.Player.username == Summary.player_username).filter(key.isnot(None))
+    if state is not None:
+        # Spelled as an expression so the planner can't swap in ix_players_state and
+        # sort half the table; a state is common enough to meet while walking the ranking
+        query = query.filter(models.Player.state + "" == state)
+    return [dict(row._mapping) for row in query.order_by(key.desc(), Summary.player_username).limit(k)]
+
+def get_threshold_crossings(db: Session, threshold: float, since: datetime.datetime, until: datetime.datetime = None,
+                            state: str = None, limit: int = 100):
+    # Players with at least one score at or above threshold in [since, until).
+    # Meant to range over idx_score_createdat: the threshold bounds the range and
+    # the window is checked from the same index entries, so the cost follows the
+    # number of high scores, not the width of the window.
+    score, created_at = models.RiskScores.score, models.RiskScores.created_at
+    since, until = schemas.naive_local(since), schemas.naive_local(until)
+    window = [created_at >= since] + ([created_at < until] if until is not None else [])
+    if db.get_bind().dialect.name == "sqlite":
+        # Without statistics SQLite would rather range over ix_scores_created_at,
+        # which reads every score of a wide window
+        window = [func.likelihood(condition, literal_column("0.9")) for condition in window]
+    # Grouped by an expression: grouping by the bare column lets SQLite walk
+    # ix_scores_player_username to skip the sort, i.e. read the whole table
+    username = (models.RiskScores.player_username + "").label("username")
+    max_score = func.max(score).label("max_score")
+    query = _filter_scores(db.query(
+        username,
+        func.min(created_at).label("first_crossed_at"),
+        max_score,
+        func.count(models.RiskScores.id).label("count"),
+    ).filter(score >= threshold, *window), state=state)
+    query = query.group_by(username).order_by(max_score.desc(), username)
+    return [dict(row._mapping) for row in query.limit(limit)]
+
+def _time_bucket(db: Session, bucket: str):
+    if db.get_bind().dialect.name == "postgresql":
+        return func.date_trunc(bucket, models.RiskScores.created_at)
+    pattern = "%Y-%m-%d %H:00:00" if bucket == "hour" else "%Y-%m-%d 00:00:00"
+    return func.strftime(pattern, models.RiskScores.created_at)
+
+def get_score_rollup(db: Session, bucket: str = "hour", **filters):
+    bucket_start = _time_bucket(db, bucket).label("bucket")
+    query = _filter_scores(db.query(
+        bucket_start,
+        func.count(models.RiskScores.id),
+        func.avg(models.RiskScores.score),
+        func.min(models.RiskScores.score),
+        func.max(models.RiskScores.score),
+    ), **filters).group_by(bucket_start).order_by(bucket_start)
+    return [
+        {"bucket": start, "count": count, "mean": mean, "min": low, "max": high}
+        for start, count, mean, low, high in query
+    ]
@@ -1,11 +1,112 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from config import settings
+import metrics, profiling
 
-database_url = "sqlite:///./softwareTask_app.db"
+# Pools that report how long each checkout waited
+TimedQueuePool = metrics.timed_pool(QueuePool)
+TimedAsyncQueuePool = metrics.timed_pool(AsyncAdaptedQueuePool)
 
-engine = create_engine(database_url, connect_args={"check_same_thread": False})
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+
+def _is_memory_sqlite(url):
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers proceed while a writer holds the lock; the rollback
+    # journal would serialize them behind it
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={settings.sqlite_journal_mode}")
+    cursor.execute(f"PRAGMA synchronous={settings.sqlite_synchronous}")
+    cursor.execute(f"PRAGMA mmap_size={int(settings.sqlite_mmap_size)}")
+    cursor.execute(f"PRAGMA cache_size={int(settings.sqlite_cache_size)}")
+    cursor.execute(f"PRAGMA busy_timeout={int(settings.sqlite_busy_timeout_ms)}")
+    cursor.execute(f"PRAGMA foreign_keys={'ON' if settings.sqlite_foreign_keys else 'OFF'}")
+    cursor.close()
+
+
+def engine_options(url, is_async=False):
+    url = make_url(url)
+    options = {}
+    connect_args = {}
+    if url.get_backend_name() == "sqlite":
+        connect_args["check_same_thread"] = False
+    elif url.get_backend_name() == "postgresql" and settings.statement_timeout_ms:
+        if is_async:
+            connect_args["server_settings"] = {"statement_timeout": str(settings.statement_timeout_ms)}
+        else:
+            connect_args["options"] = f"-c statement_timeout={settings.statement_timeout_ms}"
+
+    if not _is_memory_sqlite(url):
+        # Explicit for SQLite too: older SQLAlchemy releases default file databases to NullPool
+        options["poolclass"] = TimedAsyncQueuePool if is_async else TimedQueuePool
+        options.update(
+            pool_size=settings.pool_size,
+            max_overflow=settings.max_overflow,
+            pool_timeout=settings.pool_timeout,
+            pool_pre_ping=settings.pool_pre_ping,
+            pool_recycle=settings.pool_recycle,
+        )
+    options["connect_args"] = connect_args
+    return options
+
+
+def make_engine(url: str = None):
+    url = url or settings.database_url
+    engine = create_engine(url, **engine_options(url))
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", set_sqlite_pragmas)
+    metrics.instrument_engine(engine)
+    profiling.instrument_engine(engine)
+    return engine
+
+
+def upsert(db, table):
+    # INSERT with on_conflict_do_update / on_conflict_do_nothing, which SQLite and PostgreSQL spell the same way
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+
+def to_async_url(url: str):
+    scheme, _, rest = url.partition("://")
+    return f"{ASYNC_DRIVERS.get(scheme.split('+')[0], scheme)}://{rest}"
+
+
+def make_async_engine(url: str = None):
+    # Imported lazily so the sync deployment doesn't need greenlet or an async driver
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    url = url or settings.async_database_url or to_async_url(settings.database_url)
+    engine = create_async_engine(url, **engine_options(url, is_async=True))
+    if engine.dialect.name == "sqlite":
+        event.listen(engine.sync_engine, "connect", set_sqlite_pragmas)
+    metrics.instrument_engine(engine.sync_engine)
+    profiling.instrument_engine(engine.sync_engine)
+    return engine
+
+
+engine = make_engine()
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-Base = declarative_base()
\ No newline at end of file
+Base = declarative_base()
+
+async_engine = None
+AsyncSessionLocal = None
+
+if settings.database_async:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+    async_engine = make_async_engine()
+    AsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession, autocommit=False, autoflush=False)
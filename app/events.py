@@ -0,0 +1,240 @@
+import asyncio
+import datetime
+import json
+import threading
+import time
+from sqlalchemy import func, insert, or_
+from sqlalchemy.orm import Session
+from typing import List
+from config import settings
+import metrics, models
+
+Event = models.ChangeEvent
+
+PLAYER_CREATED = "player.created"
+SCORE_ADDED = "score.added"
+STATE_CHANGED = "state.changed"
+PLAYER_DELETED = "player.deleted"
+
+EVENTS_PUBLISHED = metrics.Counter("change_feed_events_total", "Change events handed to in-process subscribers.")
+SUBSCRIBER_OVERFLOWS = metrics.Counter("change_feed_overflows_total", "Times a slow subscriber's buffer filled up and it fell back to the outbox.")
+metrics.Gauge("change_feed_subscribers", "Open change feed streams in this process.", callback=lambda: len(bus.subscriptions))
+
+
+# Write side: crud calls record() inside the write's transaction and publish()
+# after the commit, so subscribers never see a change that was rolled back
+
+def _isoformat(value):
+    # dates and datetimes in event data
+    return value.isoformat()
+
+
+def record(db: Session, events: List[tuple]):
+    # events are (type, username, data) triples; username None means "players
+    # matching a filter", which every username filter lets through
+    if not settings.change_feed_enabled or not events:
+        return
+    now = datetime.datetime.now()
+    rows = [{"type": type_, "player_username": username, "data": json.dumps(data, default=_isoformat), "created_at": now}
+            for type_, username, data in events]
+    if db.get_bind().dialect.insert_executemany_returning_sort_by_parameter_order:
+        # One multi-row INSERT ... RETURNING for the sequence numbers, in parameter order
+        statement = insert(Event).returning(Event.seq, sort_by_parameter_order=True)
+        seqs = [seq for (seq,) in db.execute(statement, rows)]
+    else:
+        # No RETURNING (SQLite before 3.35): one Core INSERT per event, reading back its key
+        seqs = [db.execute(insert(Event.__table__), row).inserted_primary_key[0] for row in rows]
+    db.info.setdefault("pending_events", []).extend(
+        {"seq": seq, "type": row["type"], "username": row["player_username"], "data": json.loads(row["data"]),
+         "created_at": now.isoformat()}
+        for seq, row in zip(seqs, rows)
+    )
+
+
+def publish(db: Session):
+    bus.publish(db.info.pop("pending_events", []))
+
+
+def event_dict(row):
+    return {
+        "seq": row.seq,
+        "type": row.type,
+        "username": row.player_username,
+        "data": json.loads(row.data),
+        "created_at": row.created_at.isoformat(),
+    }
+
+
+# Outbox reads, for resuming and for changes committed by other processes
+
+def commit_lag(db: Session):
+    # Seconds a row must have existed before readers move past it. On SQLite writers
+    # are serialized, so sequence numbers commit in order. Elsewhere (PostgreSQL) they
+    # are taken at insert time and a lower one can commit after a higher one; reading
+    # only settled rows keeps a reader from skipping it for good.
+    if db.get_bind().dialect.name == "sqlite":
+        return 0
+    return settings.change_feed_commit_lag_ms / 1000
+
+
+def _settled(db: Session, query):
+    lag = commit_lag(db)
+    if lag:
+        query = query.filter(Event.created_at < datetime.datetime.now() - datetime.timedelta(seconds=lag))
+    return query
+
+
+def _filtered(query, usernames: List[str] = None, types: List[str] = None):
+    if usernames:
+        query = query.filter(or_(Event.player_username.in_(usernames), Event.player_username.is_(None)))
+    if types:
+        query = query.filter(Event.type.in_(types))
+    return query
+
+
+def read_outbox(db: Session, after: int = 0, usernames: List[str] = None, types: List[str] = None, limit: int = 500):
+    query = _settled(db, _filtered(db.query(Event).filter(Event.seq > after), usernames, types))
+    return [event_dict(row) for row in query.order_by(Event.seq).limit(limit)]
+
+
+def latest_seq(db: Session):
+    return _settled(db, db.query(func.max(Event.seq))).scalar() or 0
+
+
+def prune(db: Session, before: datetime.datetime, batch_size: int = 5000):
+    # Resuming from a pruned sequence number just starts at the oldest event kept
+    deleted = 0
+    while True:
+        ids = [seq for (seq,) in db.query(Event.seq).filter(Event.created_at < before).order_by(Event.seq).limit(batch_size)]
+        if not ids:
+            return deleted
+        deleted += db.query(Event).filter(Event.seq.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+
+
+# In-process pub/sub
+
+class Subscription:
+    # A bounded buffer on one event loop. When it fills up the subscriber is
+    # marked overflowed instead of blocking the writer, and catches up from the outbox.
+
+    def __init__(self, loop, usernames: List[str] = None, types: List[str] = None, max_buffer: int = 1000):
+        self.loop = loop
+        self.usernames = set(usernames or ())
+        self.types = set(types or ())
+        self.queue = asyncio.Queue(maxsize=max_buffer)
+        self.overflowed = False
+
+    def matches(self, event):
+        if self.types and event["type"] not in self.types:
+            return False
+        return not self.usernames or event["username"] is None or event["username"] in self.usernames
+
+    def _offer(self, event):
+        # Runs on the subscriber's loop
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            SUBSCRIBER_OVERFLOWS.inc()
+
+    def reset(self):
+        self.overflowed = False
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+
+class EventBus:
+    def __init__(self):
+        self.subscriptions = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, usernames: List[str] = None, types: List[str] = None, max_buffer: int = None):
+        subscription = Subscription(asyncio.get_running_loop(), usernames, types,
+                                    max_buffer or settings.change_feed_buffer_size)
+        with self._lock:
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self.subscriptions.discard(subscription)
+
+    def publish(self, events):
+        # Called from whichever thread committed; delivery hops onto each subscriber's loop
+        if not events:
+            return
+        with self._lock:
+            subscriptions = list(self.subscriptions)
+        for event in events:
+            for subscription in subscriptions:
+                if subscription.matches(event):
+                    subscription.loop.call_soon_threadsafe(subscription._offer, event)
+        EVENTS_PUBLISHED.inc(len(events))
+
+
+bus = EventBus()
+
+
+async def follow(subscription, read, after: int, poll_interval: float = None, duration: float = None,
+                 commit_lag: float = 0):
+    # Yields events in sequence order, each once, starting after `after`, and None
+    # as a keep-alive whenever poll_interval passes quietly. read(after) returns the
+    # outbox rows after a sequence number; it is used to catch up at the start,
+    # after an overflow, on every quiet interval, which is how changes committed by
+    # other worker processes arrive, and whenever an in-process event skips
+    # sequence numbers. Those may be another worker's, another thread's that is
+    # published late, or just filtered out; only the outbox can tell, and an event
+    # is never yielded ahead of a lower one it holds. With a commit_lag (see
+    # commit_lag()) the outbox holds back the newest rows, so an event it doesn't
+    # return yet is looked for again once the lag has passed.
+    poll_interval = poll_interval or settings.change_feed_poll_seconds
+    deadline = time.monotonic() + (duration or settings.change_feed_max_stream_seconds)
+    last, catch_up, waiting_for, waiting_since = after, True, None, 0
+    while True:
+        if catch_up:
+            if subscription.overflowed:
+                subscription.reset()
+            while True:
+                batch = await read(last)
+                for event in batch:
+                    if event["seq"] > last:
+                        last = event["seq"]
+                        yield event
+                if len(batch) < settings.change_feed_read_limit:
+                    break
+            catch_up = False
+            # Once the lag has passed the outbox returns the event if it ever will
+            if waiting_for is not None and (waiting_for <= last or time.monotonic() - waiting_since >= commit_lag):
+                waiting_for = None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        wait = min(poll_interval, remaining)
+        if waiting_for is not None:
+            wait = min(wait, commit_lag)
+        try:
+            event = await asyncio.wait_for(subscription.queue.get(), wait)
+        except asyncio.TimeoutError:
+            catch_up = True
+            if waiting_for is None:
+                yield None
+            continue
+        if subscription.overflowed:
+            catch_up = True
+        elif event["seq"] == last + 1:
+            last = event["seq"]
+            yield event
+        elif event["seq"] > last:
+            catch_up = True
+            if waiting_for is None:
+                waiting_since = time.monotonic()
+            waiting_for = max(waiting_for or 0, event["seq"])
+
+
+def sse_message(event):
+    if event is None:
+        return ": keep-alive\n\n"
+    return f"id: {event['seq']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
@@ -0,0 +1,29 @@
+from pagination import encode_cursor
+from responses import render
+
+
+def _player_chunk(username, scores):
+    cursor = encode_cursor(username, scores[-1]["created_at"]) if scores else None
+    return {"username": username, "risk_scores": scores}, cursor
+
+
+async def ndjson_lines(groups):
+    # One line per player, each carrying the cursor to resume right after it
+    async for username, scores in groups:
+        chunk, cursor = _player_chunk(username, scores)
+        chunk["cursor"] = cursor
+        yield render(chunk) + b"\n"
+
+
+async def json_chunks(groups, limit=None):
+    # A single JSON document written incrementally; next_cursor comes last
+    # and is null once the export has been exhausted
+    yield b'{"players":['
+    cursor, count = None, 0
+    async for username, scores in groups:
+        chunk, cursor = _player_chunk(username, scores)
+        yield (b"," if count else b"") + render(chunk)
+        count += 1
+    if limit is None or count < limit:
+        cursor = None
+    yield b'],"next_cursor":' + render(cursor) + b"}"
@@ -0,0 +1,29 @@
+# Multi-worker deployment, run from the app directory:
+#
+#     gunicorn -c gunicorn.conf.py main:app
+#
+# WEB_CONCURRENCY overrides the worker count, BIND the listen address.
+import multiprocessing
+import os
+import sys
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+# Workers import the app after the fork, so each builds its own engine and pool
+preload_app = False
+# Long enough for the write-behind ingest queue to flush on shutdown
+graceful_timeout = 30
+
+
+def on_starting(server):
+    import startup
+
+    startup.prepare_workers(workers)
+
+
+def post_fork(server, worker):
+    # Pooled connections must never cross a fork; matters when preload_app is turned on
+    database = sys.modules.get("database")
+    if database is not None:
+        database.engine.dispose(close=False)
@@ -0,0 +1,175 @@
+import datetime
+import itertools
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from sqlalchemy.exc import IntegrityError, OperationalError
+from config import settings
+from database import SessionLocal
+import crud, metrics, schemas
+
+logger = logging.getLogger("ingest")
+
+INGEST_QUEUE_DEPTH = metrics.Gauge("score_ingest_queue_depth", "Scores accepted but not yet committed.",
+                                   callback=lambda: ingestor.queue.qsize())
+INGEST_ACCEPTED = metrics.Counter("score_ingest_accepted_total", "Scores accepted into the write-behind queue.")
+INGEST_REJECTED = metrics.Counter("score_ingest_rejected_total", "Scores refused with 429 because the queue was full.")
+INGEST_COMMITTED = metrics.Counter("score_ingest_committed_total", "Buffered scores committed to the database.")
+INGEST_FAILED = metrics.Counter("score_ingest_failed_total", "Buffered scores dropped at flush time.")
+INGEST_RETRIES = metrics.Counter("score_ingest_retries_total", "Group commits retried after a transient database error.")
+INGEST_FLUSH_ROWS = metrics.Histogram("score_ingest_flush_rows", "Scores per group commit.",
+                                      buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000))
+INGEST_FLUSH_LATENCY = metrics.Histogram("score_ingest_flush_seconds", "Time to write and commit one group.")
+
+
+class QueueFull(Exception):
+    pass
+
+
+class ScoreIngestor:
+    # Write-behind for single score posts: the request thread only enqueues, one
+    # writer thread drains the queue into bulk_add_riskScores, committing every
+    # flush_rows scores or every flush_interval, whichever comes first
+
+    def __init__(self, session_factory, max_size: int = 10000, flush_rows: int = 500, flush_interval: float = 0.05,
+                 retries: int = 3, retry_backoff: float = 0.05):
+        self.session_factory = session_factory
+        self.queue = queue.Queue(maxsize=max_size)
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        # Ingestion ids are <process id>-<sequence>; one writer commits in sequence
+        # order, so everything up to committed_through is durable
+        self.process_id = uuid.uuid4().hex[:12]
+        self._sequence = itertools.count(1)
+        self._sequence_lock = threading.Lock()
+        self.committed_through = 0
+        self.failed = deque(maxlen=10000)
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="score-ingest", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 30):
+        # Flushes whatever is still queued before returning
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, player_username: str, score: float):
+        with self._sequence_lock:
+            sequence = next(self._sequence)
+            try:
+                # Under the lock so the queue stays in sequence order
+                self.queue.put_nowait((sequence, player_username, score, datetime.datetime.now()))
+            except queue.Full:
+                INGEST_REJECTED.inc()
+                raise QueueFull()
+        INGEST_ACCEPTED.inc()
+        return f"{self.process_id}-{sequence}"
+
+    def status(self, ingestion_id: str):
+        process_id, _, sequence = ingestion_id.rpartition("-")
+        if process_id != self.process_id or not sequence.isdigit():
+            return None
+        sequence = int(sequence)
+        if sequence in self.failed:
+            return "failed"
+        return "committed" if sequence <= self.committed_through else "queued"
+
+    def _take_batch(self):
+        try:
+            batch = [self.queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.flush_rows:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        # (inserted, failed sequence numbers). The scores were already answered
+        # with 202, so a group is only given up after retrying transient errors
+        # (e.g. "database is locked"), and a constraint violation (e.g. a player
+        # deleted since the request) is bisected down to the rows that cause it.
+        # Already validated by the route, so skip pydantic here
+        items = [
+            (sequence, schemas.BulkRiskScoreIn.construct(username=username, score=score, created_at=created_at))
+            for sequence, username, score, created_at in batch
+        ]
+        for attempt in range(self.retries + 1):
+            try:
+                with self.session_factory() as db:
+                    inserted, missing = crud.bulk_add_riskScores(db, items)
+                return inserted, [error["index"] for error in missing]
+            except IntegrityError:
+                if len(batch) == 1:
+                    logger.exception("dropping buffered score %d after a constraint violation", batch[0][0])
+                    return 0, [batch[0][0]]
+                middle = len(batch) // 2
+                first, second = self._write(batch[:middle]), self._write(batch[middle:])
+                return first[0] + second[0], first[1] + second[1]
+            except OperationalError:
+                if attempt < self.retries:
+                    INGEST_RETRIES.inc()
+                    time.sleep(self.retry_backoff * 2 ** attempt)
+                    continue
+                logger.exception("dropping %d buffered scores after %d retries", len(batch), self.retries)
+            except Exception:
+                logger.exception("dropping %d buffered scores after a failed flush", len(batch))
+            return 0, [sequence for sequence, *_ in batch]
+
+    def flush(self, batch):
+        start = time.perf_counter()
+        inserted, failed = self._write(batch)
+        self.failed.extend(failed)
+        self.committed_through = batch[-1][0]
+        INGEST_COMMITTED.inc(inserted)
+        INGEST_FAILED.inc(len(failed))
+        INGEST_FLUSH_ROWS.observe(len(batch))
+        INGEST_FLUSH_LATENCY.observe(time.perf_counter() - start)
+
+    def drain(self):
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
+            self.flush(batch)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._take_batch()
+            if batch:
+                self.flush(batch)
+        self.drain()
+
+
+ingestor = ScoreIngestor(
+    SessionLocal,
+    max_size=settings.score_ingest_queue_size,
+    flush_rows=settings.score_ingest_flush_rows,
+    flush_interval=settings.score_ingest_flush_interval_ms / 1000,
+    retries=settings.score_ingest_retries,
+    retry_backoff=settings.score_ingest_retry_backoff_ms / 1000,
+)
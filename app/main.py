@@ -1,14 +1,18 @@
-from fastapi import Depends, FastAPI, HTTPException, Request, status
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response, WebSocket, status
 from sqlalchemy.orm import Session
-from typing import List
-import crud, models, schemas
-from database import SessionLocal, engine
+from typing import List, Optional
+import admission, async_crud, schemas, events, export, ingest, metrics, profiling, startup, versions
+from config import settings
+from database import AsyncSessionLocal, SessionLocal
+from responses import FastJSONResponse
+from pagination import decode_cursor, encode_cursor
+from datetime import datetime, timedelta
 import time
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Match
 from pydantic import ValidationError
-from starlette.responses import JSONResponse
-
-models.Base.metadata.create_all(bind=engine)
+import asyncio
+import json
 
 app = FastAPI()
 
@@ -17,18 +21,114 @@ app = FastAPI()
 """
 
 # Dependency
-def get_db():
+async def get_db():
+    if AsyncSessionLocal is not None:
+        async with AsyncSessionLocal() as db:
+            yield db
+        return
     db = SessionLocal()
     try:
         yield db
     finally:
+        # Closed on the event loop: handing this to the threadpool can deadlock
+        # when every worker thread is already waiting on a pooled connection
         db.close()
 
+def list_response(content, response: Response, headers: dict = None):
+    # Large read listings skip response_model re-validation when fast JSON is on;
+    # the bytes on the wire are the same either way
+    if settings.fast_json_responses:
+        return FastJSONResponse(content, headers=headers)
+    response.headers.update(headers or {})
+    return content
+
+def route_path(scope):
+    # The matched route template (e.g. /players/{player_username}), so labels stay low-cardinality
+    endpoint = scope.get("endpoint")
+    for route in app.routes:
+        if getattr(route, "endpoint", None) is endpoint:
+            return route.path
+    return "unmatched"
+
+async def conditional_headers(request: Request, db, keys: List[str]):
+    # Only the version counters are read here; the listing query runs after a miss
+    headers = {}
+    cache_control = settings.cache_control_overrides.get(route_path(request.scope), settings.read_cache_control)
+    if cache_control:
+        headers["Cache-Control"] = cache_control
+    if settings.etags_enabled:
+        variant = f"{request.url.path}?{request.url.query}"
+        headers["ETag"] = versions.etag(keys, await async_crud.get_versions(db, keys), variant)
+    return headers
+
+def not_modified(request: Request, headers: dict):
+    etag = headers.get("ETag")
+    if etag and versions.etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return None
+
+@app.on_event("startup")
+def init_db():
+    # gunicorn workers only check: the master already migrated once
+    if settings.migrate_on_startup:
+        startup.init_db()
+    else:
+        startup.check_schema()
+
+@app.on_event("startup")
+def start_score_ingest():
+    if settings.buffered_score_ingest:
+        ingest.ingestor.start()
+
+@app.on_event("shutdown")
+def stop_score_ingest():
+    # Flushes every queued score before the process exits
+    ingest.ingestor.stop()
+
+@app.middleware("http")
+async def profile_request(request: Request, call_next):
+    if not profiling.wants_profile(request):
+        return await call_next(request)
+    return await profiling.profile_request(request, call_next)
+
+def match_route(scope):
+    # The route the router will pick, looked up ahead of it
+    for route in app.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route
+    return None
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    if not settings.admission_enabled:
+        return await call_next(request)
+    route = match_route(request.scope)
+    if route is None:
+        # 404s and 405s never reach a handler
+        return await call_next(request)
+    # Lets the request metrics label a shed request with its route
+    request.scope["endpoint"] = route.endpoint
+    return await admission.controller.admit(request, call_next, route.path)
+
 @app.middleware("http")
 async def add_process_time_header(request: Request, call_next):
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
+    start_time = time.perf_counter()
+    stats = metrics.RequestStats()
+    metrics.current_request.set(stats)
+    metrics.IN_FLIGHT.inc()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        metrics.IN_FLIGHT.dec()
+        process_time = time.perf_counter() - start_time
+        route = route_path(request.scope)
+        metrics.REQUESTS.labels(request.method, route, status_code).inc()
+        metrics.REQUEST_LATENCY.labels(request.method, route).observe(process_time)
+        metrics.REQUEST_DB_QUERIES.labels(route).observe(stats.queries)
+        metrics.REQUEST_DB_TIME.labels(route).observe(stats.db_time)
     response.headers["X-Process-Time"] = str(process_time)
     return response
 
@@ -42,83 +142,312 @@ async def validation_exception_handler(request, exc: ValidationError):
         },
     )
 
+@app.get('/metrics',include_in_schema=False)
+def get_metrics():
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+def require_signature(request: Request):
+    if not settings.profiling_enabled:
+        raise HTTPException(status_code=404, detail="Profiling is disabled")
+    if not profiling.is_signed(request):
+        raise HTTPException(status_code=403, detail="Missing, invalid or expired X-Profile-Signature")
+
+@app.get('/debug/profiles/{profile_id}',include_in_schema=False,dependencies=[Depends(require_signature)])
+def get_profile(profile_id: str, sort: str = "cumulative", limit: int = Query(50, ge=1)):
+    if sort not in profiling.SORT_KEYS:
+        raise HTTPException(status_code=400, detail="Invalid sort key")
+    report = profiling.load_report(profile_id, sort, limit)
+    if report is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return Response(report, media_type="text/plain")
+
+@app.get('/debug/slow-queries',include_in_schema=False,dependencies=[Depends(require_signature)])
+def get_slow_queries():
+    return list(profiling.slow_queries)
+
 @app.get('/')
 def root():
     return {'Mindway AI Software Task'}
 
 ## Task 1: Getting all players
 @app.get("/players/",response_model=List[schemas.PlayerOut],summary='Retrieve all players',description='Get all players from the database')
-def get_all_players(db: Session = Depends(get_db), skip: int = 0, limit: int = 10):
-    return crud.get_all_players(db,skip,limit)
+async def get_all_players(request: Request, response: Response, db: Session = Depends(get_db), skip: int = 0, limit: int = Query(10, ge=1, le=1000), scores_limit: Optional[int] = Query(None, ge=0), cursor: Optional[str] = None):
+    try:
+        after = decode_cursor(cursor, str)[0] if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    headers = await conditional_headers(request, db, [versions.PLAYERS, versions.SCORES])
+    unchanged = not_modified(request, headers)
+    if unchanged is not None:
+        return unchanged
+    players = await async_crud.get_all_players(db,skip,limit,scores_limit,after)
+    if len(players) == limit:
+        headers["X-Next-Cursor"] = encode_cursor(players[-1]["username"])
+    return list_response(players, response, headers)
 
 ## Task 2: Get a specific player given a username
 @app.get("/players/{player_username}",response_model=schemas.PlayerOut,summary='Retrieve a specific player',description='Get a speific player given a usernamr from the database')
-def get_player_by_username(player_username: str, db: Session = Depends(get_db)):
-    db_player = crud.get_player_by_username(db, player_username=player_username)
+async def get_player_by_username(player_username: str, request: Request, response: Response, scores_limit: Optional[int] = Query(None, ge=0), db: Session = Depends(get_db)):
+    headers = await conditional_headers(request, db, [versions.player_key(player_username), versions.ALL_PLAYERS])
+    unchanged = not_modified(request, headers)
+    if unchanged is not None:
+        return unchanged
+    db_player = await async_crud.get_player_by_username(db, player_username=player_username, scores_limit=scores_limit)
     if db_player is None:
         raise HTTPException(status_code=404, detail="Player does not exist")
+    response.headers.update(headers)
     return db_player
 
+## Look up many players and their latest scores in one call
+@app.post("/players/batch",response_model=List[schemas.PlayerBatchItem],response_model_exclude_unset=True,summary='Retrieve many players',description='Get the requested fields and latest scores of many players in request order; unknown usernames come back with found set to false')
+async def get_players_batch(batch: schemas.PlayerBatchIn, response: Response, db: Session = Depends(get_db)):
+    if len(batch.usernames) > settings.batch_max_usernames:
+        raise HTTPException(status_code=400, detail=f"At most {settings.batch_max_usernames} usernames per batch")
+    fields = [field.value for field in batch.fields]
+    return list_response(await async_crud.get_players_batch(db, batch.usernames, fields, batch.scores_limit), response)
+
 ## Task 3: Add a new player to the database
 @app.post("/players/",response_model=schemas.PlayerOut,summary='Creating a new player',description='Adding a new player to the database')
-def add_player(player: schemas.PlayerBase,db: Session = Depends(get_db)):
-    db_player = crud.get_player_by_username(db, player_username=player.username)
-    if db_player:
+async def add_player(player: schemas.PlayerBase,db: Session = Depends(get_db)):
+    if await async_crud.player_exists(db, player.username):
         raise HTTPException(status_code=400, detail="Player already exists")
-    return crud.add_player(db,player)
+    return await async_crud.add_player(db,player)
 
 ## Task 4: Add a risk score to a given player given a username
-@app.post("/players/{player_username}/scores/",response_model=schemas.RiskScoreOut,summary='Adding a new risk score to a player',description='Adding a new risk score to a given player in the database')
-def add_riskScore_to_player(player_username: str, risk_score: schemas.RiskScoreBase, db: Session = Depends(get_db)):
-    db_player = crud.get_player_by_username(db,player_username=player_username)
-    if db_player is None: 
+@app.post("/players/{player_username}/scores/",response_model=schemas.RiskScoreOut,summary='Adding a new risk score to a player',description='Adding a new risk score to a given player in the database',
+          responses={202: {"model": schemas.ScoreAcceptedOut, "description": "Queued for a group commit (buffered ingestion)"}, 429: {"description": "Ingestion queue is full"}})
+async def add_riskScore_to_player(player_username: str, risk_score: schemas.RiskScoreBase, db: Session = Depends(get_db)):
+    if not await async_crud.player_exists(db, player_username):
         raise HTTPException(status_code=404, detail="Player does not exist")
 
-    return crud.add_riskScore_to_player(db,player_username,risk_score)
+    if settings.buffered_score_ingest:
+        # Write-behind: queued here, committed by the ingest thread in groups
+        if not ingest.ingestor.running:
+            ingest.ingestor.start()
+        try:
+            ingestion_id = ingest.ingestor.submit(player_username, risk_score.score)
+        except ingest.QueueFull:
+            raise HTTPException(status_code=429, detail="Score ingestion queue is full", headers={"Retry-After": "1"})
+        return JSONResponse(status_code=202, content={"ingestion_id": ingestion_id, "status": "queued"})
+
+    return await async_crud.add_riskScore_to_player(db,player_username,risk_score)
+
+@app.get("/scores/ingest/{ingestion_id}",response_model=schemas.ScoreAcceptedOut,summary='Status of a buffered risk score',description='Whether a score accepted with 202 is still queued, committed or failed; only the worker process that accepted it knows')
+def get_ingestion_status(ingestion_id: str):
+    ingestion_status = ingest.ingestor.status(ingestion_id)
+    if ingestion_status is None:
+        raise HTTPException(status_code=404, detail="Unknown ingestion id")
+    return {"ingestion_id": ingestion_id, "status": ingestion_status}
+
+## Bulk ingestion of risk scores in a single transaction
+@app.post("/scores/bulk",response_model=schemas.BulkScoresOut,summary='Adding risk scores in bulk',description='Adding many risk scores at once from a JSON array or an NDJSON stream of {username, score, created_at}')
+async def bulk_add_riskScores(request: Request, db: Session = Depends(get_db)):
+    body = await request.body()
+    try:
+        if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+            payload = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            payload = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Malformed JSON body")
+    if not isinstance(payload, list):
+        raise HTTPException(status_code=400, detail="Expected a JSON array or NDJSON stream")
+    if len(payload) > settings.bulk_scores_max_items:
+        # One request must not hold the write lock for an unbounded transaction
+        raise HTTPException(status_code=413, detail=f"At most {settings.bulk_scores_max_items} scores per request")
+
+    items, failed = [], []
+    for index, raw in enumerate(payload):
+        try:
+            items.append((index, schemas.BulkRiskScoreIn.parse_obj(raw)))
+        except ValidationError as exc:
+            username = raw.get("username") if isinstance(raw, dict) else None
+            failed.append({"index": index, "username": username if isinstance(username, str) else None, "errors": exc.errors()})
+
+    inserted, missing = await async_crud.bulk_add_riskScores(db, items)
+    return {"inserted": inserted, "failed": sorted(failed + missing, key=lambda error: error["index"])}
 
 ## Task 5: Get risk scores for a given player
 @app.get("/players/{player_username}/scores/",response_model=List[schemas.RiskScoreOut],summary='Getting list of scores',description='Retrieving a list of scores for a given player in the database')
-def get_riskScores_for_a_player(player_username: str,db: Session = Depends(get_db)):
-    db_player = crud.get_player_by_username(db,player_username=player_username)
-    if db_player is None:
+async def get_riskScores_for_a_player(player_username: str, response: Response, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                                      order: schemas.SortOrder = schemas.SortOrder.asc, cursor: Optional[str] = None, limit: int = Query(10, ge=1, le=1000),
+                                      db: Session = Depends(get_db)):
+    try:
+        after = decode_cursor(cursor, datetime, int) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not await async_crud.player_exists(db, player_username):
         raise HTTPException(status_code=404, detail="Player does not exist")
 
-    return crud.get_riskScores_for_a_player(db,player_username, skip = 0,limit = 10)
+    rows = await async_crud.get_riskScores_for_a_player(db, player_username, limit=limit, since=since, until=until,
+                                                        descending=order == schemas.SortOrder.desc, after=after)
+    headers = None
+    if len(rows) == limit:
+        last_id, last_score = rows[-1]
+        headers = {"X-Next-Cursor": encode_cursor(last_score["created_at"], last_id)}
+    return list_response([score for _, score in rows], response, headers)
 
 ## Task 6: Get all risk scores for all the players
 @app.get("/players/scores/",response_model=List[schemas.AllPlayerScoreOut],summary='Retrieving scores of all the players',description='Retrieving scores of all the players from the database')
-def get_scores_of_players(db: Session = Depends(get_db)):
-    return crud.get_scores_of_players(db)
+async def get_scores_of_players(request: Request, response: Response, db: Session = Depends(get_db)):
+    headers = await conditional_headers(request, db, [versions.SCORES])
+    unchanged = not_modified(request, headers)
+    if unchanged is not None:
+        return unchanged
+    return list_response(await async_crud.get_scores_of_players(db), response, headers)
+
+## Streaming export of all risk scores, resumable with a keyset cursor
+@app.get("/players/scores/export",summary='Streaming export of scores of all the players',description='Stream scores of all the players as NDJSON or chunked JSON, one player at a time')
+async def export_scores_of_players(format: schemas.ExportFormat = schemas.ExportFormat.ndjson, cursor: Optional[str] = None, limit: Optional[int] = Query(None, ge=1), db: Session = Depends(get_db)):
+    try:
+        after = decode_cursor(cursor, str, datetime) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    groups = async_crud.stream_scores_of_players(db, after=after, limit=limit)
+    if format == schemas.ExportFormat.ndjson:
+        return StreamingResponse(export.ndjson_lines(groups), media_type="application/x-ndjson")
+    return StreamingResponse(export.json_chunks(groups, limit), media_type="application/json")
+
+## Aggregate statistics over risk scores, computed server-side
+def score_filters(since: Optional[datetime] = None, until: Optional[datetime] = None,
+                  percentiles: List[float] = Query([50, 90, 99])):
+    if any(not 0 <= pct <= 100 for pct in percentiles):
+        raise HTTPException(status_code=400, detail="Percentiles must be between 0 and 100")
+    return {"since": since, "until": until, "percentiles": percentiles}
+
+@app.get("/players/{player_username}/scores/stats/",response_model=schemas.ScoreStatsOut,summary='Score statistics of a player',description='Count, mean, min, max, standard deviation and percentiles of a given player scores')
+async def get_player_score_stats(player_username: str, filters: dict = Depends(score_filters), db: Session = Depends(get_db)):
+    if not await async_crud.player_exists(db, player_username):
+        raise HTTPException(status_code=404, detail="Player does not exist")
+    return await async_crud.get_score_stats(db, player_username=player_username, **filters)
+
+@app.get("/players/{player_username}/scores/summary/",response_model=schemas.ScoreSummaryOut,summary='Current risk and running statistics of a player',description='Latest score, count, mean, variance, min and max of a given player, read from the maintained summary table')
+async def get_player_score_summary(player_username: str, db: Session = Depends(get_db)):
+    if not await async_crud.player_exists(db, player_username):
+        raise HTTPException(status_code=404, detail="Player does not exist")
+    return await async_crud.get_score_summary(db, player_username)
+
+@app.get("/scores/stats/",response_model=schemas.ScoreStatsOut,summary='Score statistics across players',description='Count, mean, min, max, standard deviation and percentiles of all scores, optionally filtered by player state, gender and time range')
+async def get_score_stats(state: Optional[schemas.State] = None, gender: Optional[schemas.Gender] = None, filters: dict = Depends(score_filters), db: Session = Depends(get_db)):
+    return await async_crud.get_score_stats(db, state=state and state.value, gender=gender and gender.value, **filters)
+
+@app.get("/scores/rollup/",response_model=List[schemas.ScoreRollupOut],summary='Time-bucketed score rollups',description='Count, mean, min and max of scores per hour or day, optionally for one player or filtered by state, gender and time range')
+async def get_score_rollup(bucket: schemas.Bucket = schemas.Bucket.hour, username: Optional[str] = None, state: Optional[schemas.State] = None, gender: Optional[schemas.Gender] = None,
+                           since: Optional[datetime] = None, until: Optional[datetime] = None, db: Session = Depends(get_db)):
+    return await async_crud.get_score_rollup(db, bucket.value, player_username=username, state=state and state.value,
+                                             gender=gender and gender.value, since=since, until=until)
+
+## Rankings: riskiest players by latest or average score, and threshold crossings
+@app.get("/players/top/",response_model=List[schemas.TopPlayerOut],summary='Top-K riskiest players',description='The k players with the highest latest or average risk score, optionally only those in a given state')
+async def get_top_players(by: schemas.RankBy = schemas.RankBy.latest, state: Optional[schemas.State] = None, k: int = Query(100, ge=1, le=1000), db: Session = Depends(get_db)):
+    return await async_crud.get_top_players(db, by.value, state and state.value, k)
+
+@app.get("/players/crossings/",response_model=List[schemas.ThresholdCrossingOut],summary='Players that crossed a risk score threshold',description='Players with a score at or above the threshold in a time window (the last hour by default), highest first')
+async def get_threshold_crossings(threshold: float = Query(..., ge=0, le=100), since: Optional[datetime] = None, until: Optional[datetime] = None,
+                                  state: Optional[schemas.State] = None, limit: int = Query(100, ge=1, le=1000), db: Session = Depends(get_db)):
+    since = since or datetime.now() - timedelta(hours=1)
+    return await async_crud.get_threshold_crossings(db, threshold, since, until, state and state.value, limit)
 
 ## Task 7: Get the state of a given player
 @app.get("/players/{player_username}/state/",response_model=schemas.PlayerStateOut,summary='Retrive a given player states',description='retrieve a given player state from the database')
-def get_player_state(player_username: str, db: Session = Depends(get_db)):    
-    state = crud.get_player_state(db,player_username)
+async def get_player_state(player_username: str, db: Session = Depends(get_db)):    
+    state = await async_crud.get_player_state(db,player_username)
     if state is None:
         raise HTTPException(status_code=404, detail="Player does not exist")
     return state
 
 ## Task 8: Get the state of all the players
 @app.get("/players/state/",response_model=List[schemas.AllPlayerStateOut],summary='Retrieving state of all the players',description='Retrieving state of all the players from the database')
-def get_state_of_players(db: Session = Depends(get_db)):
-    return crud.get_state_of_players(db)
+async def get_state_of_players(request: Request, response: Response, state: Optional[schemas.State] = None, db: Session = Depends(get_db)):
+    headers = await conditional_headers(request, db, [versions.PLAYERS])
+    unchanged = not_modified(request, headers)
+    if unchanged is not None:
+        return unchanged
+    return list_response(await async_crud.get_state_of_players(db, state and state.value), response, headers)
     
+## Set the state of many players in one statement
+@app.patch("/players/state/",response_model=schemas.BulkStateChangeOut,summary='Change the state of many players',description='Set the state of the listed players, or of every player matching a filter, in one statement')
+async def set_state_of_players(change: schemas.BulkStateChangeIn, db: Session = Depends(get_db)):
+    filters = {key: value.value for key, value in change.filter.dict(exclude_none=True).items()} if change.filter else {}
+    updated = await async_crud.set_state_of_players(db, change.state.value, change.usernames, filters)
+    return {"updated": updated}
+
 ## Task 9: Change the state of a given player
 @app.patch("/players/{player_username}/state/",response_model=schemas.PlayerStateOut,summary='Change the state of the player', description='Change the state of the player in the database')
-def change_player_state(player_username: str, db: Session = Depends(get_db)):
-    state = crud.change_player_state(db,player_username)
+async def change_player_state(player_username: str, db: Session = Depends(get_db)):
+    state = await async_crud.change_player_state(db,player_username)
     if state is None:
         raise HTTPException(status_code=404, detail='Player does not exist')
     return state
 
 ## Task 10: Delete a given player from the database
 @app.delete("/players/{player_username}",response_model=schemas.PlayerOut,summary='Deleting a player',description='Removing a player from the database')
-def delete_player(player_username: str, db: Session = Depends(get_db)):
-    db_player = crud.get_player_by_username(db,player_username)
+async def delete_player(player_username: str, db: Session = Depends(get_db)):
+    db_player = await async_crud.delete_player(db, player_username)
     if db_player is None:
-        return HTTPException(status_code=404,detail='Player does not exist')
-    return crud.delete_player(db, player_username)
+        raise HTTPException(status_code=404,detail='Player does not exist')
+    return db_player
+
+## Delete many players in chunked set-based statements
+@app.delete("/players/",response_model=schemas.BulkDeleteOut,summary='Deleting many players',description='Remove the listed players, or every player matching a filter (state, gender, no scores since a given time), with their scores')
+async def delete_players(batch: schemas.BulkDeleteIn, db: Session = Depends(get_db)):
+    filters = batch.filter.dict(exclude_none=True) if batch.filter else {}
+    no_scores_since = filters.pop("no_scores_since", None)
+    filters = {key: value.value for key, value in filters.items()}
+    deleted = await async_crud.delete_players(db, batch.usernames, filters, no_scores_since)
+    return {"deleted": deleted}
+
+## Change feed: every write as an event, polled from the outbox or pushed over SSE / WebSocket
+def event_filters(usernames: Optional[List[str]] = Query(None, alias="username"), types: Optional[List[schemas.EventType]] = Query(None, alias="type")):
+    return {"usernames": usernames, "types": [event_type.value for event_type in types] if types else None}
+
+async def change_feed(db, after: Optional[int], filters: dict):
+    # Subscribed before the starting point is read, so nothing falls in between
+    subscription = events.bus.subscribe(**filters)
+    try:
+        if after is None:
+            after = await async_crud.get_latest_event_seq(db)
+        read = lambda last: async_crud.get_events(db, last, limit=settings.change_feed_read_limit, **filters)
+        async for event in events.follow(subscription, read, after, commit_lag=events.commit_lag(db)):
+            yield event
+    finally:
+        events.bus.unsubscribe(subscription)
+
+@app.get("/events/",response_model=List[schemas.ChangeEventOut],summary='Poll the change feed',description='Changes after a given sequence number, oldest first, optionally filtered by username and event type')
+async def get_events(response: Response, after: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=1000), filters: dict = Depends(event_filters), db: Session = Depends(get_db)):
+    return list_response(await async_crud.get_events(db, after, limit=limit, **filters), response)
+
+@app.get("/events/stream",summary='Stream the change feed',description='Server-Sent Events of every change from now, or after the given sequence number or Last-Event-ID, optionally filtered by username and event type')
+async def stream_events(request: Request, after: Optional[int] = Query(None, ge=0), filters: dict = Depends(event_filters), db: Session = Depends(get_db)):
+    last_event_id = request.headers.get("last-event-id", "")
+    if after is None and last_event_id.isdigit():
+        after = int(last_event_id)
+
+    async def messages():
+        # The stream ends after change_feed_max_stream_seconds; EventSource reconnects with Last-Event-ID
+        yield "retry: 1000\n\n"
+        async for event in change_feed(db, after, filters):
+            yield events.sse_message(event)
+
+    return StreamingResponse(messages(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
+@app.websocket("/events/ws")
+async def events_websocket(websocket: WebSocket, after: Optional[int] = Query(None, ge=0), filters: dict = Depends(event_filters), db: Session = Depends(get_db)):
+    await websocket.accept()
 
+    async def send_events():
+        async for event in change_feed(db, after, filters):
+            if event is not None:
+                await websocket.send_text(json.dumps(event))
+        await websocket.close()
 
+    async def wait_for_disconnect():
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
 
+    sender = asyncio.ensure_future(send_events())
+    receiver = asyncio.ensure_future(wait_for_disconnect())
+    await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+    for task in (sender, receiver):
+        task.cancel()
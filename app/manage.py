@@ -0,0 +1,131 @@
+"""
+Maintenance commands, run from the app directory:
+
+    python manage.py migrate [--check | --to VERSION]
+    python manage.py rebuild-summaries [--username NAME ...]
+    python manage.py check-summaries
+    python manage.py prune-scores [--days N | --before ISO] [--archive-dir DIR | --no-archive]
+    python manage.py create-partitions [--months N]
+    python manage.py drop-partitions --days N
+    python manage.py prune-events [--hours N]
+"""
+import argparse
+import datetime
+import sys
+
+import events, migrations, retention, startup, summary
+from config import settings
+from database import SessionLocal, engine
+
+
+def migrate(args):
+    if args.check:
+        with engine.connect() as connection:
+            version = migrations.current_version(connection)
+        print(f"Schema version {version}, latest {migrations.LATEST}")
+        return 0 if version >= migrations.LATEST else 1
+    for version, name in migrations.upgrade(engine, args.to):
+        print(f"Applied {version}: {name}")
+    print("Schema is up to date")
+
+
+def rebuild_summaries(args):
+    startup.init_db()
+    with SessionLocal() as db:
+        count = summary.rebuild(db, args.username)
+    print(f"Rebuilt {count} player score summaries")
+
+
+def check_summaries(args):
+    with SessionLocal() as db:
+        problems = summary.check(db)
+    for problem in problems:
+        print(f"{problem['username']}: {problem['field']} expected {problem['expected']!r}, found {problem['actual']!r}")
+    print(f"{len(problems)} inconsistencies found")
+    return 1 if problems else 0
+
+
+def retention_cutoff(args):
+    if args.before:
+        return datetime.datetime.fromisoformat(args.before)
+    days = args.days if args.days is not None else settings.retention_days
+    if days is None:
+        raise SystemExit("Pass --days or --before, or set RETENTION_DAYS")
+    return datetime.datetime.now() - datetime.timedelta(days=days)
+
+
+def prune_scores(args):
+    archive_dir = None if args.no_archive else (args.archive_dir or settings.retention_archive_dir)
+    with SessionLocal() as db:
+        result = retention.prune(db, retention_cutoff(args), args.batch_size, archive_dir)
+    print(f"Deleted {result['deleted']} scores in {result['batches']} batches, archived {result['archived']}, "
+          f"rebuilt {result['players']} player summaries")
+
+
+def create_partitions(args):
+    with SessionLocal() as db:
+        names = retention.ensure_partitions(db, datetime.date.today(), args.months)
+    if not names:
+        print("scores is not a partitioned PostgreSQL table; prune-scores uses batched deletes instead")
+        return 1
+    print("Partitions: " + ", ".join(names))
+
+
+def drop_partitions(args):
+    with SessionLocal() as db:
+        dropped = retention.drop_partitions_before(db, retention_cutoff(args))
+        if dropped:
+            summary.rebuild(db)
+    print(f"Dropped {len(dropped)} partitions" + (": " + ", ".join(dropped) if dropped else ""))
+
+
+def prune_events(args):
+    hours = args.hours if args.hours is not None else settings.change_feed_retention_hours
+    with SessionLocal() as db:
+        deleted = events.prune(db, datetime.datetime.now() - datetime.timedelta(hours=hours))
+    print(f"Deleted {deleted} change events")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = commands.add_parser("migrate", help="apply pending schema migrations")
+    migrate_parser.add_argument("--check", action="store_true", help="only report the schema version; exit 1 when behind")
+    migrate_parser.add_argument("--to", type=int, help="stop after this version")
+    migrate_parser.set_defaults(func=migrate)
+
+    rebuild = commands.add_parser("rebuild-summaries", help="backfill player_score_summary from the scores table")
+    rebuild.add_argument("--username", action="append", help="only rebuild these players (repeatable)")
+    rebuild.set_defaults(func=rebuild_summaries)
+
+    check = commands.add_parser("check-summaries", help="compare player_score_summary with the scores table")
+    check.set_defaults(func=check_summaries)
+
+    prune = commands.add_parser("prune-scores", help="delete (and archive) scores older than the retention period in batches")
+    prune.add_argument("--days", type=int, help="keep this many days of scores (default RETENTION_DAYS)")
+    prune.add_argument("--before", help="delete scores created before this ISO timestamp instead")
+    prune.add_argument("--batch-size", type=int, help="rows per delete transaction (default RETENTION_BATCH_SIZE)")
+    prune.add_argument("--archive-dir", help="append pruned rows here as gzipped NDJSON (default RETENTION_ARCHIVE_DIR)")
+    prune.add_argument("--no-archive", action="store_true", help="delete without archiving")
+    prune.set_defaults(func=prune_scores)
+
+    partitions = commands.add_parser("create-partitions", help="create monthly scores partitions ahead of time (PostgreSQL)")
+    partitions.add_argument("--months", type=int, default=3)
+    partitions.set_defaults(func=create_partitions)
+
+    drop = commands.add_parser("drop-partitions", help="drop whole monthly scores partitions older than the cutoff, without archiving (PostgreSQL)")
+    drop.add_argument("--days", type=int, help="keep this many days of scores (default RETENTION_DAYS)")
+    drop.add_argument("--before", help="drop partitions that end before this ISO timestamp instead")
+    drop.set_defaults(func=drop_partitions)
+
+    prune_events_parser = commands.add_parser("prune-events", help="delete change feed outbox rows older than the retention period")
+    prune_events_parser.add_argument("--hours", type=float, help="keep this many hours of events (default CHANGE_FEED_RETENTION_HOURS)")
+    prune_events_parser.set_defaults(func=prune_events)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args) or 0)
+
+
+if __name__ == "__main__":
+    main()
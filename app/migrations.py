@@ -0,0 +1,88 @@
+import datetime
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.orm import Session
+import models, summary
+
+Migration = models.SchemaMigration
+tables = models.Base.metadata.tables
+
+# Applied in order, once each, by "manage.py migrate" (or the gunicorn master).
+# Every step is idempotent, because databases from before this table existed
+# already have some of it. Tables are created from the current models, so a
+# column change to an existing table needs its own ALTER step here.
+
+
+def _create_tables(*names):
+    def step(connection):
+        for name in names:
+            tables[name].create(connection, checkfirst=True)
+    return step
+
+
+def _create_indexes(*names):
+    def step(connection):
+        for table in tables.values():
+            for index in table.indexes:
+                if index.name in names:
+                    # IF NOT EXISTS rather than checkfirst, which can't see expression indexes on SQLite
+                    connection.execute(CreateIndex(index, if_not_exists=True))
+    return step
+
+
+def _player_score_summary(connection):
+    if inspect(connection).has_table("player_score_summary"):
+        return
+    tables["player_score_summary"].create(connection)
+    # Backfilled from the scores already there
+    summary.rebuild(Session(bind=connection))
+
+
+MIGRATIONS = [
+    (1, "players and scores", _create_tables("players", "scores")),
+    (2, "player_score_summary, backfilled", _player_score_summary),
+    (3, "ix_players_state", _create_indexes("ix_players_state")),
+    (4, "data_versions", _create_tables("data_versions")),
+    (5, "change_events", _create_tables("change_events")),
+    (6, "ranking indexes", _create_indexes("idx_score_createdat", "ix_summary_latest_score", "ix_summary_mean_score")),
+]
+
+LATEST = MIGRATIONS[-1][0]
+
+
+class SchemaOutOfDate(RuntimeError):
+    pass
+
+
+def current_version(connection):
+    if not inspect(connection).has_table(Migration.__tablename__):
+        return 0
+    return connection.execute(Migration.__table__.select().with_only_columns(Migration.version).order_by(
+        Migration.version.desc()).limit(1)).scalar() or 0
+
+
+def upgrade(engine, target: int = None):
+    # One transaction per step, recorded in schema_migrations alongside its DDL
+    target = LATEST if target is None else target
+    with engine.begin() as connection:
+        Migration.__table__.create(connection, checkfirst=True)
+        version = current_version(connection)
+    applied = []
+    for step_version, name, step in MIGRATIONS:
+        if step_version <= version or step_version > target:
+            continue
+        with engine.begin() as connection:
+            step(connection)
+            connection.execute(Migration.__table__.insert().values(
+                version=step_version, name=name, applied_at=datetime.datetime.now()))
+        applied.append((step_version, name))
+    return applied
+
+
+def check(engine):
+    # The only schema work a worker does at startup: one small read
+    with engine.connect() as connection:
+        version = current_version(connection)
+    if version < LATEST:
+        raise SchemaOutOfDate(f"Database schema is at version {version}, the app needs {LATEST}; run python manage.py migrate")
+    return version
@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Enum, Date, DateTime, Float,Index
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Enum, Date, DateTime, Float,Index, func, literal_column
 from sqlalchemy.orm import relationship 
 from database import Base
 from enum import Enum as pyEnum
@@ -13,9 +13,12 @@ class Player(Base):
     middle_name = Column(String)
     birthday = Column(Date,nullable=False)
     gender = Column(Enum('male','female','others'),nullable=False)
-    state = Column(Enum('active','inactive'),nullable=False)
+    state = Column(Enum('active','inactive'),nullable=False,index=True)
 
-    risk_scores = relationship('RiskScores',back_populates='player',cascade="all, delete-orphan")
+    # passive_deletes: deleting a player leaves its scores and summary to ON DELETE
+    # CASCADE instead of loading them into the session and deleting them row by row
+    risk_scores = relationship('RiskScores',back_populates='player',cascade="all, delete-orphan",passive_deletes=True)
+    score_summary = relationship('PlayerScoreSummary',back_populates='player',uselist=False,cascade="all, delete-orphan",passive_deletes=True)
 
 class RiskScores(Base):
     __tablename__ = 'scores'
@@ -27,5 +30,56 @@ class RiskScores(Base):
 
     player = relationship('Player',back_populates='risk_scores')
 
+class PlayerScoreSummary(Base):
+    __tablename__ = 'player_score_summary'
+
+    # Maintained in the same transaction as every score insert, see summary.py
+    player_username = Column(String,ForeignKey("players.username", ondelete="CASCADE"),primary_key=True)
+    count = Column(Integer,nullable=False,default=0)
+    total = Column(Float,nullable=False,default=0.0)
+    total_sq = Column(Float,nullable=False,default=0.0)
+    min_score = Column(Float)
+    max_score = Column(Float)
+    latest_score = Column(Float)
+    latest_at = Column(DateTime)
+
+    player = relationship('Player',back_populates='score_summary')
+
 # Create compound index on player_username and created_at
 Index('idx_username_createdat', RiskScores.player_username, RiskScores.created_at)
+# Threshold crossings: a range on score, then created_at from the same entries
+Index('idx_score_createdat', RiskScores.score, RiskScores.created_at)
+
+# Top-K rankings walk these from the top. Queries have to spell the mean exactly
+# like this (0 as a literal, not a bound parameter) for the index to match.
+MEAN_SCORE = PlayerScoreSummary.total / func.nullif(PlayerScoreSummary.count, literal_column("0"))
+Index('ix_summary_latest_score', PlayerScoreSummary.latest_score)
+Index('ix_summary_mean_score', MEAN_SCORE)
+
+class DataVersion(Base):
+    __tablename__ = 'data_versions'
+
+    # Change counters behind the read endpoints' ETags, bumped by the crud writes, see versions.py
+    key = Column(String,primary_key=True)
+    version = Column(Integer,nullable=False,default=0)
+
+class ChangeEvent(Base):
+    __tablename__ = 'change_events'
+    # AUTOINCREMENT so sequence numbers are never reused after a prune
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    # Outbox behind the change feed, written in the same transaction as the change, see events.py
+    seq = Column(Integer,primary_key=True)
+    type = Column(String,nullable=False)
+    # Not indexed: feed reads are ranges of seq, filtered as they scan
+    player_username = Column(String)
+    data = Column(String,nullable=False)
+    created_at = Column(DateTime,nullable=False,index=True)
+
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migrations'
+
+    # One row per applied step of migrations.py
+    version = Column(Integer,primary_key=True,autoincrement=False)
+    name = Column(String,nullable=False)
+    applied_at = Column(DateTime,nullable=False)
@@ -0,0 +1,27 @@
+import base64
+import json
+from datetime import datetime
+
+
+def encode_cursor(*values):
+    payload = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, *types):
+    # Opaque cursors are base64 JSON arrays; types tells us how to revive each position
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(payload, list) or len(payload) != len(types):
+        raise ValueError("Invalid cursor")
+    values = []
+    for value, kind in zip(payload, types):
+        try:
+            values.append(datetime.fromisoformat(value) if kind is datetime else kind(value))
+        except (ValueError, TypeError):
+            raise ValueError("Invalid cursor")
+    return tuple(values)
@@ -0,0 +1,172 @@
+import contextvars
+import cProfile
+import hashlib
+import hmac
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from config import settings
+import metrics
+
+logger = logging.getLogger("slow_query")
+
+# Modules whose functions count as the "origin" of a query in the slow-query log
+ORIGIN_MODULES = {"crud", "summary"}
+
+SORT_KEYS = set(pstats.Stats.sort_arg_dict_default)
+
+
+class RequestProfile:
+    # One cProfile.Profile per thread that did work for the request, merged at the end
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.profiles = []
+        self._lock = threading.Lock()
+
+    def new_profile(self):
+        profile = cProfile.Profile()
+        with self._lock:
+            self.profiles.append(profile)
+        return profile
+
+    def stats(self):
+        with self._lock:
+            profiles = list(self.profiles)
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+
+current_profile = contextvars.ContextVar("current_profile", default=None)
+
+# cProfile hooks the whole event loop thread, so only one request is profiled there
+# at a time. Only ever touched from the event loop, so a plain flag is enough.
+_event_loop_busy = False
+
+
+def request_signature(method: str, path: str, timestamp: str, secret: str):
+    return hmac.new(secret.encode(), f"{method} {path} {timestamp}".encode(), hashlib.sha256).hexdigest()
+
+
+def signed_headers(method: str, path: str, secret: str, timestamp: int = None):
+    timestamp = str(int(time.time()) if timestamp is None else timestamp)
+    return {"X-Profile-Timestamp": timestamp, "X-Profile-Signature": request_signature(method, path, timestamp, secret)}
+
+
+def is_signed(request):
+    # A valid signature over the method, path and a timestamp no older than
+    # profiling_signature_max_age seconds, so a captured one can't be replayed later
+    signature = request.headers.get("X-Profile-Signature")
+    timestamp = request.headers.get("X-Profile-Timestamp")
+    if not signature or not timestamp or not settings.profiling_secret:
+        return False
+    try:
+        age = time.time() - int(timestamp)
+    except ValueError:
+        return False
+    if abs(age) > settings.profiling_signature_max_age:
+        return False
+    expected = request_signature(request.method, request.url.path, timestamp, settings.profiling_secret)
+    return hmac.compare_digest(signature, expected)
+
+
+def wants_profile(request):
+    if not settings.profiling_enabled:
+        return False
+    return settings.profile_all_requests or is_signed(request)
+
+
+async def profile_request(request, call_next):
+    global _event_loop_busy
+    if _event_loop_busy:
+        # Another request holds the profiler; serve this one unprofiled rather than queue it
+        return await call_next(request)
+    request_profile = RequestProfile()
+    current_profile.set(request_profile)
+    _event_loop_busy = True
+    # Coroutines of other in-flight requests also run on this thread and will show up here
+    profile = request_profile.new_profile()
+    profile.enable()
+    try:
+        response = await call_next(request)
+    finally:
+        profile.disable()
+        _event_loop_busy = False
+    save(request_profile)
+    response.headers["X-Profile-Id"] = request_profile.id
+    return response
+
+
+def run_profiled(fn, *args, **kwargs):
+    # Used for threadpool hops; those threads are invisible to the event loop's profiler
+    request_profile = current_profile.get()
+    if request_profile is None:
+        return fn(*args, **kwargs)
+    profile = request_profile.new_profile()
+    profile.enable()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        profile.disable()
+
+
+def _profile_path(profile_id: str):
+    return os.path.join(settings.profiling_dir, f"{profile_id}.prof")
+
+
+def save(request_profile):
+    os.makedirs(settings.profiling_dir, exist_ok=True)
+    request_profile.stats().dump_stats(_profile_path(request_profile.id))
+
+
+def load_report(profile_id: str, sort: str = "cumulative", limit: int = 50):
+    path = _profile_path(profile_id)
+    if not profile_id.isalnum() or not os.path.exists(path):
+        return None
+    output = io.StringIO()
+    pstats.Stats(path, stream=output).sort_stats(sort).print_stats(limit)
+    return output.getvalue()
+
+
+# Slow-query log
+
+slow_queries = deque(maxlen=200)
+
+
+def _origin():
+    frame = sys._getframe(2)
+    while frame is not None:
+        if frame.f_globals.get("__name__") in ORIGIN_MODULES:
+            return f"{frame.f_globals['__name__']}.{frame.f_code.co_name}"
+        frame = frame.f_back
+    return None
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = metrics.query_elapsed(context) * 1000
+    threshold = settings.slow_query_threshold_ms
+    if threshold <= 0 or elapsed_ms < threshold:
+        return
+    entry = {
+        "duration_ms": round(elapsed_ms, 3),
+        "origin": _origin(),
+        "statement": statement,
+        "parameters": repr(parameters)[:1000] if settings.slow_query_log_parameters else None,
+    }
+    slow_queries.append(entry)
+    logger.warning("slow query %.1fms in %s: %s %s", elapsed_ms, entry["origin"], statement, entry["parameters"] or "")
+
+
+def instrument_engine(engine):
+    from sqlalchemy import event
+
+    # Timed from the start metrics.instrument_engine records, so that goes on first
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
@@ -0,0 +1,42 @@
+import json
+from datetime import date, datetime
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # optional: the stdlib encoder is used instead
+    orjson = None
+
+# orjson and json.dumps only disagree on floats Python writes in exponent
+# notation: below 1e-4 (orjson: 0.00001, json: 1e-05) and from 1e16 up (1e16 vs
+# 1e+16). Output that might hold one is re-rendered with the stdlib to stay
+# byte-identical; a false positive from string content only costs speed.
+_SUSPECT_MARKERS = (b"0.0000", b"e-") + tuple(b"e%d" % digit for digit in range(10))
+
+
+def _default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _stdlib_render(content) -> bytes:
+    return json.dumps(
+        content, default=_default, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def render(content) -> bytes:
+    if orjson is None:
+        return _stdlib_render(content)
+    body = orjson.dumps(content)
+    if any(marker in body for marker in _SUSPECT_MARKERS):
+        return _stdlib_render(content)
+    return body
+
+
+class FastJSONResponse(JSONResponse):
+    # For trusted, already-shaped read data: skips response_model validation and
+    # jsonable_encoder, and renders the same bytes FastAPI's JSONResponse would
+    def render(self, content) -> bytes:
+        return render(content)
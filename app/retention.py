@@ -0,0 +1,217 @@
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from config import settings
+import datetime
+import gzip
+import json
+import os
+import time
+import models, schemas, summary, versions
+
+Scores = models.RiskScores
+
+# Archived scores live in one gzipped NDJSON file per day of created_at. Batches
+# are appended as extra gzip members, which gzip readers concatenate.
+ARCHIVE_PREFIX = "scores-"
+ARCHIVE_SUFFIX = ".ndjson.gz"
+# Everything created before the instant stored here may be in the archive
+HORIZON_FILE = "HORIZON"
+
+
+def _archive_path(archive_dir: str, day: datetime.date):
+    return os.path.join(archive_dir, f"{ARCHIVE_PREFIX}{day.isoformat()}{ARCHIVE_SUFFIX}")
+
+
+def archive_horizon(archive_dir: str = None):
+    archive_dir = archive_dir or settings.retention_archive_dir
+    if not archive_dir:
+        return None
+    try:
+        with open(os.path.join(archive_dir, HORIZON_FILE)) as horizon:
+            return datetime.datetime.fromisoformat(horizon.read().strip())
+    except FileNotFoundError:
+        return None
+
+
+def reaches_archive(since: datetime.datetime = None, descending: bool = False, after: tuple = None):
+    # The horizon when a score history query asks for archived rows, otherwise None.
+    # Only an explicit since before the horizon does: reading the archive means
+    # scanning every day file in the window, too slow for a default history read.
+    horizon = archive_horizon()
+    if horizon is None or since is None or schemas.naive_local(since) >= horizon:
+        return None
+    if not descending and after is not None and schemas.naive_local(after[0]) >= horizon:
+        return None
+    return horizon
+
+
+def _advance_horizon(archive_dir: str, cutoff: datetime.datetime):
+    current = archive_horizon(archive_dir)
+    if current is not None and current >= cutoff:
+        return
+    path = os.path.join(archive_dir, HORIZON_FILE)
+    with open(path + ".tmp", "w") as horizon:
+        horizon.write(cutoff.isoformat())
+    os.replace(path + ".tmp", path)
+
+
+def write_archive(archive_dir: str, rows):
+    # Appended and fsynced before the rows are deleted; a crash in between
+    # leaves a duplicate, which readers drop by id
+    os.makedirs(archive_dir, exist_ok=True)
+    by_day = {}
+    for row in rows:
+        by_day.setdefault(row.created_at.date(), []).append(row)
+    for day, day_rows in by_day.items():
+        lines = "".join(
+            json.dumps({"id": row.id, "player_username": row.player_username, "score": row.score,
+                        "created_at": row.created_at.isoformat()}) + "\n"
+            for row in day_rows
+        )
+        with open(_archive_path(archive_dir, day), "ab") as archive:
+            with gzip.GzipFile(fileobj=archive, mode="wb") as member:
+                member.write(lines.encode())
+            archive.flush()
+            os.fsync(archive.fileno())
+    return len(rows)
+
+
+def _archive_days(archive_dir: str):
+    days = []
+    for name in os.listdir(archive_dir):
+        if name.startswith(ARCHIVE_PREFIX) and name.endswith(ARCHIVE_SUFFIX):
+            days.append(datetime.date.fromisoformat(name[len(ARCHIVE_PREFIX):-len(ARCHIVE_SUFFIX)]))
+    return sorted(days)
+
+
+def read_archive(player_username: str, since: datetime.datetime = None, until: datetime.datetime = None,
+                 descending: bool = False, after: tuple = None, limit: int = None, archive_dir: str = None):
+    # Same filters and (created_at, id) ordering as crud.get_riskScores_for_a_player;
+    # rows come back as detached RiskScores
+    archive_dir = archive_dir or settings.retention_archive_dir
+    if not archive_dir or not os.path.isdir(archive_dir):
+        return []
+    since, until = schemas.naive_local(since), schemas.naive_local(until)
+    after_key = (schemas.naive_local(after[0]), after[1]) if after is not None else None
+
+    days = [
+        day for day in _archive_days(archive_dir)
+        if (since is None or day >= since.date()) and (until is None or day <= until.date())
+    ]
+    results = []
+    for day in reversed(days) if descending else days:
+        seen, rows = set(), []
+        with gzip.open(_archive_path(archive_dir, day), "rt") as archive:
+            for line in archive:
+                record = json.loads(line)
+                if record["player_username"] != player_username or record["id"] in seen:
+                    continue
+                created_at = datetime.datetime.fromisoformat(record["created_at"])
+                if (since is not None and created_at < since) or (until is not None and created_at >= until):
+                    continue
+                key = (created_at, record["id"])
+                if after_key is not None and (key >= after_key if descending else key <= after_key):
+                    continue
+                seen.add(record["id"])
+                rows.append(Scores(id=record["id"], player_username=player_username, score=record["score"], created_at=created_at))
+        rows.sort(key=lambda score: (score.created_at, score.id), reverse=descending)
+        results.extend(rows)
+        if limit is not None and len(results) >= limit:
+            break
+    return results[:limit] if limit is not None else results
+
+
+def prune(db: Session, cutoff: datetime.datetime, batch_size: int = None, archive_dir: str = None, pause: float = None):
+    # Oldest-first batches, each its own short transaction, so writers are never
+    # locked out for long. Summaries of the affected players are rebuilt at the end.
+    batch_size = batch_size or settings.retention_batch_size
+    pause = settings.retention_pause_ms / 1000 if pause is None else pause
+    cutoff = schemas.naive_local(cutoff)
+    if archive_dir:
+        # Moved first so reads start merging the archive before rows leave the table
+        os.makedirs(archive_dir, exist_ok=True)
+        _advance_horizon(archive_dir, cutoff)
+
+    deleted = archived = batches = 0
+    affected = set()
+    while True:
+        rows = (
+            db.query(Scores.id, Scores.player_username, Scores.score, Scores.created_at)
+            .filter(Scores.created_at < cutoff)
+            .order_by(Scores.created_at, Scores.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            break
+        if archive_dir:
+            archived += write_archive(archive_dir, rows)
+        deleted += db.query(Scores).filter(Scores.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+        usernames = {row.player_username for row in rows}
+        versions.bump(db, [versions.SCORES] + [versions.player_key(username) for username in usernames])
+        db.commit()
+        affected |= usernames
+        batches += 1
+        if len(rows) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+
+    affected = sorted(affected)
+    for start in range(0, len(affected), 500):
+        summary.rebuild(db, affected[start:start + 500])
+    return {"deleted": deleted, "archived": archived, "batches": batches, "players": len(affected)}
+
+
+def _is_partitioned(db: Session):
+    return db.execute(text(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('scores')"
+    )).first() is not None
+
+
+def _month_start(day: datetime.date, months: int = 0):
+    month = day.month - 1 + months
+    return datetime.date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def ensure_partitions(db: Session, start: datetime.date, months: int = 3):
+    # PostgreSQL only, and only when scores was created PARTITION BY RANGE (created_at)
+    # (its primary key then has to be (id, created_at)). Other backends prune with
+    # batched deletes alone and get an empty list back.
+    if db.get_bind().dialect.name != "postgresql" or not _is_partitioned(db):
+        return []
+    names = []
+    for offset in range(months):
+        low, high = _month_start(start, offset), _month_start(start, offset + 1)
+        name = f"scores_{low.year}{low.month:02d}"
+        db.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF scores "
+            f"FOR VALUES FROM ('{low.isoformat()}') TO ('{high.isoformat()}')"
+        ))
+        names.append(name)
+    db.commit()
+    return names
+
+
+def drop_partitions_before(db: Session, cutoff: datetime.datetime):
+    # Whole months older than the cutoff go with one DDL statement instead of row
+    # deletes. Nothing is archived, so run prune() first when an archive is kept.
+    if db.get_bind().dialect.name != "postgresql" or not _is_partitioned(db):
+        return []
+    boundary = _month_start(schemas.naive_local(cutoff).date())
+    dropped = []
+    for (name,) in db.execute(text(
+        "SELECT child.relname FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = to_regclass('scores') ORDER BY child.relname"
+    )):
+        if not name.startswith("scores_") or len(name) != 13 or not name[7:].isdigit():
+            continue
+        month = datetime.date(int(name[7:11]), int(name[11:13]), 1)
+        if _month_start(month, 1) <= boundary:
+            db.execute(text(f"ALTER TABLE scores DETACH PARTITION {name}"))
+            db.execute(text(f"DROP TABLE {name}"))
+            dropped.append(name)
+    if dropped:
+        versions.bump(db, [versions.SCORES, versions.ALL_PLAYERS])
+    db.commit()
+    return dropped
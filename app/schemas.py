@@ -1,8 +1,14 @@
 from pydantic import BaseModel, Field, validator
 from datetime import date, datetime
-from typing import Optional, List
+from typing import Optional, List, Dict
 from enum import Enum as pyEnum
 
+def naive_local(value):
+    # Timestamps are stored as naive local time; an aware one is converted to it, not just stripped
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone().replace(tzinfo=None)
+    return value
+
 class Gender(str, pyEnum):
     male = 'male'
     female = 'female'
@@ -12,6 +18,37 @@ class State(str, pyEnum):
     active = 'active'
     inactive = 'inactive'
 
+class ExportFormat(str, pyEnum):
+    ndjson = 'ndjson'
+    json = 'json'
+
+class SortOrder(str, pyEnum):
+    asc = 'asc'
+    desc = 'desc'
+
+class PlayerField(str, pyEnum):
+    first_name = 'first_name'
+    last_name = 'last_name'
+    middle_name = 'middle_name'
+    birthday = 'birthday'
+    gender = 'gender'
+    state = 'state'
+    risk_scores = 'risk_scores'
+
+class EventType(str, pyEnum):
+    player_created = 'player.created'
+    score_added = 'score.added'
+    state_changed = 'state.changed'
+    player_deleted = 'player.deleted'
+
+class RankBy(str, pyEnum):
+    latest = 'latest'
+    average = 'average'
+
+class Bucket(str, pyEnum):
+    hour = 'hour'
+    day = 'day'
+
 class PlayerCommon(BaseModel):
     username: str
     first_name: str
@@ -43,15 +80,138 @@ class RiskScoreBase(BaseModel):
 class RiskScoreOut(RiskScoreBase):
     created_at: datetime
 
+class BulkRiskScoreIn(RiskScoreBase):
+    username: str
+    created_at: Optional[datetime] = None
+
+    @validator('created_at')
+    def created_at_local(cls, value):
+        return naive_local(value)
+
+class ScoreAcceptedOut(BaseModel):
+    ingestion_id: str
+    status: str
+
+class BulkScoreError(BaseModel):
+    index: int
+    username: Optional[str] = None
+    errors: List[dict]
+
+class BulkScoresOut(BaseModel):
+    inserted: int
+    failed: List[BulkScoreError] = []
+
 class PlayerOut(PlayerBase):
     risk_scores: List[RiskScoreOut] = []
 
+class PlayerBatchIn(BaseModel):
+    usernames: List[str] = Field(..., min_items=1)
+    fields: List[PlayerField] = list(PlayerField)
+    scores_limit: int = Field(1, ge=0, le=100)
+
+    class Config:
+        extra = "forbid"
+
+class PlayerBatchItem(BaseModel):
+    username: str
+    found: bool
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    middle_name: Optional[str] = None
+    birthday: Optional[date] = None
+    gender: Optional[Gender] = None
+    state: Optional[State] = None
+    risk_scores: Optional[List[RiskScoreOut]] = None
+
 class PlayerStateOut(PlayerCommon):
     state: State
 
 class AllPlayerStateOut(PlayerCommon):
     state: State
 
+class PlayerFilter(BaseModel):
+    state: Optional[State] = None
+    gender: Optional[Gender] = None
+
+    class Config:
+        extra = "forbid"
+
+class PlayerSelection(BaseModel):
+    # The players a bulk operation targets: listed by username, or matching a filter
+    usernames: Optional[List[str]] = None
+    filter: Optional[PlayerFilter] = None
+
+    class Config:
+        extra = "forbid"
+
+    @validator('filter', always=True)
+    def usernames_or_filter(cls, value, values):
+        if value is None and values.get('usernames') is None:
+            raise ValueError("either usernames or filter is required; use an empty filter to target every player")
+        return value
+
+class BulkStateChangeIn(PlayerSelection):
+    state: State
+
+class BulkStateChangeOut(BaseModel):
+    updated: int
+
+class PlayerDeleteFilter(PlayerFilter):
+    # Players without a single score at or after this instant
+    no_scores_since: Optional[datetime] = None
+
+class BulkDeleteIn(PlayerSelection):
+    filter: Optional[PlayerDeleteFilter] = None
+
+class BulkDeleteOut(BaseModel):
+    deleted: int
+
 class AllPlayerScoreOut(BaseModel):
     username: str
     risk_scores: List[RiskScoreOut] = []
+
+class ScoreStatsOut(BaseModel):
+    count: int
+    mean: Optional[float] = None
+    min: Optional[float] = None
+    max: Optional[float] = None
+    stddev: Optional[float] = None
+    percentiles: Dict[str, float] = {}
+
+class ScoreRollupOut(BaseModel):
+    bucket: datetime
+    count: int
+    mean: float
+    min: float
+    max: float
+
+class TopPlayerOut(BaseModel):
+    username: str
+    state: State
+    latest_score: Optional[float] = None
+    latest_at: Optional[datetime] = None
+    mean: Optional[float] = None
+    count: int
+
+class ThresholdCrossingOut(BaseModel):
+    username: str
+    first_crossed_at: datetime
+    max_score: float
+    count: int
+
+class ScoreSummaryOut(BaseModel):
+    count: int
+    mean: Optional[float] = None
+    variance: Optional[float] = None
+    stddev: Optional[float] = None
+    min: Optional[float] = None
+    max: Optional[float] = None
+    latest_score: Optional[float] = None
+    latest_at: Optional[datetime] = None
+
+class ChangeEventOut(BaseModel):
+    seq: int
+    type: EventType
+    username: Optional[str] = None
+    data: dict
+    created_at: datetime
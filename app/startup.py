@@ -0,0 +1,39 @@
+import logging
+from config import settings
+
+logger = logging.getLogger("startup")
+
+
+def init_db():
+    # Migrations run once per deployment (gunicorn's master, the startup event of
+    # a single process, or manage.py migrate), never as an import side effect
+    import migrations
+    from database import engine
+
+    for version, name in migrations.upgrade(engine):
+        logger.info("applied migration %d: %s", version, name)
+
+
+def check_schema():
+    import migrations
+    from database import engine
+
+    migrations.check(engine)
+
+
+def prepare_workers(workers: int):
+    # Called in the gunicorn master before it forks
+    if workers > 1 and settings.player_cache_backend == "memory":
+        # A per-process cache would keep serving a state another worker just changed
+        logger.warning("PLAYER_CACHE_BACKEND=memory is per process; disabling the player cache for %d workers "
+                       "(use PLAYER_CACHE_BACKEND=redis to share one)", workers)
+        settings.player_cache_backend = "none"
+    if settings.migrate_on_startup:
+        init_db()
+    else:
+        check_schema()
+    # Workers inherit this module state; they must open their own connections
+    from database import engine
+
+    engine.dispose()
+    settings.migrate_on_startup = False
@@ -0,0 +1,160 @@
+from sqlalchemy import case, func, literal, or_, select
+from sqlalchemy.orm import Session
+import math
+import models
+from database import upsert
+
+Summary = models.PlayerScoreSummary
+
+
+def _fold(rows):
+    # rows are (username, score, created_at); fold them into one delta per player
+    deltas = {}
+    for username, score, created_at in rows:
+        delta = deltas.get(username)
+        if delta is None:
+            deltas[username] = {
+                "count": 1, "total": score, "total_sq": score * score, "min_score": score,
+                "max_score": score, "latest_score": score, "latest_at": created_at,
+            }
+            continue
+        delta["count"] += 1
+        delta["total"] += score
+        delta["total_sq"] += score * score
+        delta["min_score"] = min(delta["min_score"], score)
+        delta["max_score"] = max(delta["max_score"], score)
+        if created_at >= delta["latest_at"]:
+            delta["latest_score"], delta["latest_at"] = score, created_at
+    return deltas
+
+
+_table = Summary.__table__
+# Built once per dialect; constructing it costs about a millisecond
+_apply_statements = {}
+
+
+def _apply_statement(db: Session):
+    dialect = db.get_bind().dialect.name
+    if dialect not in _apply_statements:
+        _apply_statements[dialect] = _build_apply_statement(db)
+    return _apply_statements[dialect]
+
+
+def _build_apply_statement(db: Session):
+    # One upsert for every player, run as an executemany. Every right-hand side
+    # reads the pre-update row and the excluded (new) one, so the increments are
+    # atomic, and two first scores for a player can't both insert its row.
+    statement = upsert(db, _table)
+    new = statement.excluded
+    newer = or_(_table.c.latest_at.is_(None), _table.c.latest_at <= new.latest_at)
+    return statement.on_conflict_do_update(index_elements=[_table.c.player_username], set_={
+        "count": _table.c.count + new.count,
+        "total": _table.c.total + new.total,
+        "total_sq": _table.c.total_sq + new.total_sq,
+        "min_score": case(
+            (or_(_table.c.min_score.is_(None), _table.c.min_score > new.min_score), new.min_score),
+            else_=_table.c.min_score),
+        "max_score": case(
+            (or_(_table.c.max_score.is_(None), _table.c.max_score < new.max_score), new.max_score),
+            else_=_table.c.max_score),
+        "latest_score": case((newer, new.latest_score), else_=_table.c.latest_score),
+        "latest_at": case((newer, new.latest_at), else_=_table.c.latest_at),
+    })
+
+
+def apply_scores(db: Session, rows):
+    # Called inside the insert's transaction, before commit. Players without a
+    # row yet (created before the summary table existed) get one.
+    deltas = _fold(rows)
+    if deltas:
+        db.execute(_apply_statement(db), [dict(delta, player_username=username) for username, delta in deltas.items()])
+
+
+def get_summary(db: Session, player_username: str):
+    summary = db.query(Summary).filter(Summary.player_username == player_username).first()
+    if summary is None:
+        summary = Summary(player_username=player_username, count=0, total=0.0, total_sq=0.0)
+    mean = variance = stddev = None
+    if summary.count:
+        mean = summary.total / summary.count
+        variance = max(summary.total_sq / summary.count - mean * mean, 0.0)
+        stddev = math.sqrt(variance)
+    return {
+        "count": summary.count,
+        "mean": mean,
+        "variance": variance,
+        "stddev": stddev,
+        "min": summary.min_score,
+        "max": summary.max_score,
+        "latest_score": summary.latest_score,
+        "latest_at": summary.latest_at,
+    }
+
+
+def _aggregate_statement(usernames=None):
+    # One pass over scores: window aggregates per player, keep the newest row
+    partition = models.RiskScores.player_username
+    ranked = select(
+        partition.label("player_username"),
+        func.row_number().over(
+            partition_by=partition,
+            order_by=(models.RiskScores.created_at.desc(), models.RiskScores.id.desc()),
+        ).label("rank"),
+        func.count(models.RiskScores.id).over(partition_by=partition).label("count"),
+        func.sum(models.RiskScores.score).over(partition_by=partition).label("total"),
+        func.sum(models.RiskScores.score * models.RiskScores.score).over(partition_by=partition).label("total_sq"),
+        func.min(models.RiskScores.score).over(partition_by=partition).label("min_score"),
+        func.max(models.RiskScores.score).over(partition_by=partition).label("max_score"),
+        models.RiskScores.score.label("latest_score"),
+        models.RiskScores.created_at.label("latest_at"),
+    )
+    if usernames is not None:
+        ranked = ranked.where(partition.in_(usernames))
+    ranked = ranked.subquery()
+    return select(
+        ranked.c.player_username, ranked.c.count, ranked.c.total, ranked.c.total_sq,
+        ranked.c.min_score, ranked.c.max_score, ranked.c.latest_score, ranked.c.latest_at,
+    ).where(ranked.c.rank == 1)
+
+
+COLUMNS = ["player_username", "count", "total", "total_sq", "min_score", "max_score", "latest_score", "latest_at"]
+
+
+def rebuild(db: Session, usernames=None):
+    # Recompute summaries from scores, then add empty rows for players without any
+    query = db.query(Summary)
+    if usernames is not None:
+        query = query.filter(Summary.player_username.in_(usernames))
+    query.delete(synchronize_session=False)
+
+    db.execute(Summary.__table__.insert().from_select(COLUMNS, _aggregate_statement(usernames)))
+    missing = select(models.Player.username, literal(0), literal(0.0), literal(0.0)).where(
+        ~select(Summary.player_username).where(Summary.player_username == models.Player.username).exists()
+    )
+    if usernames is not None:
+        missing = missing.where(models.Player.username.in_(usernames))
+    db.execute(Summary.__table__.insert().from_select(["player_username", "count", "total", "total_sq"], missing))
+    db.commit()
+    return db.query(Summary).count()
+
+
+def check(db: Session, tolerance: float = 1e-6):
+    # Compare every stored summary with one recomputed from the scores table
+    expected = {row.player_username: row for row in db.execute(_aggregate_statement())}
+    stored = {row.player_username: row for row in db.query(Summary)}
+    problems = []
+    for username in sorted(set(expected) | set(stored)):
+        want, have = expected.get(username), stored.get(username)
+        if have is None:
+            problems.append({"username": username, "field": "row", "expected": "present", "actual": None})
+            continue
+        for field in COLUMNS[1:]:
+            wanted = getattr(want, field) if want is not None else (0 if field in ("count", "total", "total_sq") else None)
+            actual = getattr(have, field)
+            if isinstance(wanted, float) or isinstance(actual, float):
+                mismatch = wanted is None or actual is None or not math.isclose(wanted, actual, rel_tol=tolerance, abs_tol=tolerance)
+            else:
+                mismatch = wanted != actual
+            if mismatch:
+                problems.append({"username": username, "field": field, "expected": wanted, "actual": actual})
+    return problems
@@ -1,22 +1,36 @@
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 import pytest
+import json
+import datetime
+import time
+import sqlite3
 
 from main import app, get_db
+from database import make_engine
+from config import settings
+from cache import FakeKeyValueClient, KeyValueBackend, MemoryBackend, PlayerCache, player_cache
+from sqlalchemy import event
+from contextlib import contextmanager
+import migrations
 import models
 import schemas
 import crud
+import summary
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+TEST_DATABASE_PATH = "./test.db"
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{TEST_DATABASE_PATH}"
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+engine = make_engine(SQLALCHEMY_DATABASE_URL)
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-# Ensure the test database reflects the tables in the models
-models.Base.metadata.create_all(bind=engine)
+# Migrated once from scratch, then kept as an in-memory template that every test starts from
+models.Base.metadata.drop_all(bind=engine)
+migrations.Migration.__table__.drop(bind=engine, checkfirst=True)
+migrations.upgrade(engine)
+template = sqlite3.connect(":memory:", check_same_thread=False)
+with sqlite3.connect(TEST_DATABASE_PATH) as source:
+    source.backup(template)
 
 def override_get_db():
     db = TestingSessionLocal()
@@ -28,10 +42,38 @@ def override_get_db():
 app.dependency_overrides[get_db] = override_get_db
 client = TestClient(app)
 
+@contextmanager
+def count_queries():
+    # Collects every SQL statement the app sends to the test engine
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+
+def create_player(username, **fields):
+    player = {
+        "username": username, 
+        "first_name": "Player", 
+        "last_name": "Test", 
+        "middle_name": "Test", 
+        "state": "active",
+        "birthday": "1990-01-01",
+        "gender": "male",
+    }
+    player.update(fields)
+    response = client.post("/players/", json=player)
+    assert response.status_code == 200
+    return response.json()
+
 @pytest.fixture(autouse=True)
 def clear_database():
-    models.Base.metadata.drop_all(engine)
-    models.Base.metadata.create_all(engine)
+    # Copies the empty, migrated database over the test one, pages only, no DDL
+    with sqlite3.connect(TEST_DATABASE_PATH) as target:
+        template.backup(target)
+    player_cache.clear()
 
 def test_create_player():
     response = client.post(
@@ -182,6 +224,26 @@ def test_get_riskScores_for_a_player():
     assert "created_at" in response.json()[0]
     assert response.json()[0]["score"] == 90.5
 
+def test_score_window_bounds_with_an_offset_are_converted_to_local_time():
+    create_player("player4")
+    client.post("/scores/bulk", json=[
+        {"username": "player4", "score": 10.0, "created_at": "2023-01-01T00:00:00"},
+        {"username": "player4", "score": 20.0, "created_at": "2023-01-01T12:00:00"},
+    ])
+    # Bounds in UTC+5 that enclose only the second score once converted to local time
+    offset = datetime.timezone(datetime.timedelta(hours=5))
+    local = lambda *args: datetime.datetime(*args).astimezone(offset).isoformat()
+    window = {"since": local(2023, 1, 1, 6), "until": local(2023, 1, 1, 18)}
+    response = client.get("/players/player4/scores/", params=window)
+    assert [score["score"] for score in response.json()] == [20.0]
+
+    db = TestingSessionLocal()
+    try:
+        after = (datetime.datetime(2023, 1, 1, 6).astimezone(offset), 0)
+        assert [score.score for score in crud.get_riskScores_for_a_player(db, "player4", after=after)] == [20.0]
+    finally:
+        db.close()
+
 def test_get_scores_of_all_players():
     # Create player
     response = client.post(
@@ -296,4 +358,961 @@ def test_delete_player():
 
     # check if the player was deleted
     response = client.get("/players/player7")
-    assert response.status_code == 404
\ No newline at end of file
+    assert response.status_code == 404
+
+def test_deletes_cascade_in_the_database_and_in_bulk():
+    for username in ["old", "recent", "active", "listed"]:
+        create_player(username, state="active" if username == "active" else "inactive")
+    with TestingSessionLocal() as db:
+        crud.bulk_add_riskScores(db, [
+            (0, schemas.BulkRiskScoreIn(username="old", score=1.0, created_at=datetime.datetime(2020, 1, 1))),
+            (1, schemas.BulkRiskScoreIn(username="recent", score=2.0)),
+            (2, schemas.BulkRiskScoreIn(username="listed", score=3.0)),
+        ])
+
+    # The scores are deleted by ON DELETE CASCADE, never loaded
+    with count_queries() as statements:
+        response = client.delete("/players/listed")
+    assert response.status_code == 200 and response.json()["risk_scores"] == []
+    assert not any("FROM scores" in statement for statement in statements)
+
+    response = client.request("DELETE", "/players/", json={"filter": {"state": "inactive", "no_scores_since": "2021-01-01T00:00:00"}})
+    assert response.json() == {"deleted": 1}
+    response = client.request("DELETE", "/players/", json={"usernames": ["recent", "ghost"]})
+    assert response.json() == {"deleted": 1}
+    assert [player["username"] for player in client.get("/players/").json()] == ["active"]
+    with TestingSessionLocal() as db:
+        assert db.query(models.RiskScores).count() == 0
+        assert db.query(models.PlayerScoreSummary).count() == 1
+    assert client.request("DELETE", "/players/", json={}).status_code == 422
+
+def test_export_scores_of_players_resumes_from_cursor():
+    for username in ["player12", "player13"]:
+        response = client.post(
+            "/players/",
+            json={
+                "username": username, 
+                "first_name": "Player", 
+                "last_name": "Export", 
+                "middle_name": "Test", 
+                "state": "active",
+                "birthday": "1990-01-01",
+                "gender": "male",
+            },
+        )
+        assert response.status_code == 200
+        client.post(f"/players/{username}/scores/", json={"score": 10.0})
+        client.post(f"/players/{username}/scores/", json={"score": 20.0})
+
+    # first page holds a single player
+    response = client.get("/players/scores/export", params={"limit": 1})
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert len(lines) == 1
+    assert lines[0]["username"] == "player12"
+    assert [score["score"] for score in lines[0]["risk_scores"]] == [10.0, 20.0]
+
+    # resume after the first player
+    response = client.get("/players/scores/export", params={"format": "json", "cursor": lines[0]["cursor"]})
+    assert response.status_code == 200
+    data = response.json()
+    assert [player["username"] for player in data["players"]] == ["player13"]
+    assert data["next_cursor"] is None
+
+    response = client.get("/players/scores/export", params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
+
+
+def test_bulk_add_riskScores(monkeypatch):
+    response = client.post(
+        "/players/",
+        json={
+            "username": "player14", 
+            "first_name": "Player", 
+            "last_name": "Fourteen", 
+            "middle_name": "Test", 
+            "state": "active",
+            "birthday": "1990-01-01",
+            "gender": "male",
+        },
+    )
+    assert response.status_code == 200
+
+    # JSON array with one unknown player and one invalid score
+    response = client.post(
+        "/scores/bulk",
+        json=[
+            {"username": "player14", "score": 10.0},
+            {"username": "nobody", "score": 20.0},
+            {"username": "player14", "score": 200.0},
+            {"username": "player14", "score": 30.0, "created_at": "2023-01-01T10:00:00"},
+        ],
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["inserted"] == 2
+    assert [(error["index"], error["username"]) for error in data["failed"]] == [(1, "nobody"), (2, "player14")]
+
+    # NDJSON stream
+    response = client.post(
+        "/scores/bulk",
+        data='{"username": "player14", "score": 40.0}\n{"username": "player14", "score": 50.0}\n',
+        headers={"content-type": "application/x-ndjson"},
+    )
+    assert response.status_code == 200
+    assert response.json() == {"inserted": 2, "failed": []}
+
+    response = client.get("/players/player14/scores/")
+    assert sorted(score["score"] for score in response.json()) == [10.0, 30.0, 40.0, 50.0]
+
+    response = client.post("/scores/bulk", data="{not json", headers={"content-type": "application/json"})
+    assert response.status_code == 400
+
+    # An offset is converted to local time, and can be mixed with naive timestamps in one request
+    aware = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone(datetime.timedelta(hours=5)))
+    response = client.post("/scores/bulk", json=[
+        {"username": "player14", "score": 60.0, "created_at": aware.isoformat()},
+        {"username": "player14", "score": 70.0, "created_at": "2023-01-02T00:00:00"},
+    ])
+    assert response.json() == {"inserted": 2, "failed": []}
+    scores = {score["score"]: score["created_at"] for score in client.get("/players/player14/scores/").json()}
+    assert scores[60.0] == aware.astimezone().replace(tzinfo=None).isoformat()
+
+    monkeypatch.setattr(settings, "bulk_scores_max_items", 2)
+    response = client.post("/scores/bulk", json=[{"username": "player14", "score": 1}] * 3)
+    assert response.status_code == 413
+
+
+def test_routes_with_async_session():
+    from sqlalchemy.ext.asyncio import AsyncSession
+    from database import make_async_engine, to_async_url
+
+    async_engine = make_async_engine(to_async_url(SQLALCHEMY_DATABASE_URL))
+    AsyncTestingSessionLocal = sessionmaker(async_engine, class_=AsyncSession, autocommit=False, autoflush=False)
+
+    async def override_get_async_db():
+        async with AsyncTestingSessionLocal() as db:
+            yield db
+
+    app.dependency_overrides[get_db] = override_get_async_db
+    try:
+        response = client.post(
+            "/players/",
+            json={
+                "username": "player15", 
+                "first_name": "Player", 
+                "last_name": "Fifteen", 
+                "middle_name": "Test", 
+                "state": "active",
+                "birthday": "1990-01-01",
+                "gender": "male",
+            },
+        )
+        assert response.status_code == 200
+
+        response = client.post("/players/player15/scores/", json={"score": 42.0})
+        assert response.status_code == 200
+
+        response = client.get("/players/player15")
+        assert response.status_code == 200
+        assert [score["score"] for score in response.json()["risk_scores"]] == [42.0]
+
+        response = client.get("/players/scores/export")
+        assert [line["username"] for line in map(json.loads, response.text.splitlines())] == ["player15"]
+
+        response = client.patch("/players/player15/state/")
+        assert response.json()["state"] == "inactive"
+
+        response = client.delete("/players/player15")
+        assert response.status_code == 200
+        assert response.json()["username"] == "player15"
+    finally:
+        app.dependency_overrides[get_db] = override_get_db
+
+
+def test_sqlite_engine_pragmas():
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+        assert connection.exec_driver_sql("PRAGMA foreign_keys").scalar() == 1
+
+
+def test_player_cache_serves_existence_checks_without_queries():
+    response = client.post(
+        "/players/",
+        json={
+            "username": "player16", 
+            "first_name": "Player", 
+            "last_name": "Sixteen", 
+            "middle_name": "Test", 
+            "state": "active",
+            "birthday": "1990-01-01",
+            "gender": "male",
+        },
+    )
+    assert response.status_code == 200
+
+    # first lookup fills the cache
+    assert client.get("/players/player16/state/").json()["state"] == "active"
+
+    with count_queries() as statements:
+        assert client.get("/players/player16/state/").json()["state"] == "active"
+    assert statements == []
+    assert player_cache.stats()["hits"] >= 1
+
+    # writes invalidate the cached entry
+    assert client.patch("/players/player16/state/").json()["state"] == "inactive"
+    assert client.get("/players/player16/state/").json()["state"] == "inactive"
+    assert client.delete("/players/player16").status_code == 200
+    assert client.get("/players/player16/state/").status_code == 404
+    assert client.post("/players/player16/scores/", json={"score": 1.0}).status_code == 404
+
+
+def test_player_cache_backends():
+    backend = MemoryBackend(max_size=2, ttl=60)
+    backend.set("a", {"state": "active"})
+    backend.set("b", {"state": "active"})
+    backend.get("a")
+    backend.set("c", {"state": "active"})
+    assert backend.get("b") is None
+    assert backend.get("a") is not None
+
+    expired = MemoryBackend(max_size=2, ttl=-1)
+    expired.set("a", {"state": "active"})
+    assert expired.get("a") is None
+
+    for cache in [PlayerCache(KeyValueBackend(FakeKeyValueClient())), PlayerCache(MemoryBackend())]:
+        assert cache.get("a") is None
+        assert cache.fill("a", {"state": "inactive"})
+        assert cache.get("a") == {"state": "inactive"}
+        cache.invalidate("a")
+        assert cache.get("a") is None
+        # a read that loaded the row before the write committed can't cache it afterwards
+        assert not cache.fill("a", {"state": "inactive"})
+        assert cache.get("a") is None
+        generation = cache.generation
+        cache.invalidate_all()
+        assert not cache.fill("b", {"state": "active"}, generation)
+        assert cache.stats() == {"hits": 1, "misses": 3}
+
+
+def test_get_all_players_loads_scores_without_n_plus_one():
+    for index in range(5):
+        create_player(f"player2{index}")
+        for score in [10.0, 20.0, 30.0]:
+            client.post(f"/players/player2{index}/scores/", json={"score": score})
+
+    with count_queries() as statements:
+        response = client.get("/players/")
+    assert response.status_code == 200
+    assert len(response.json()) == 5
+    assert all(len(player["risk_scores"]) == 3 for player in response.json())
+    # players + their scores, after the ETag version lookup
+    assert len(statements) == 3
+
+    with count_queries() as statements:
+        response = client.get("/players/", params={"scores_limit": 2})
+    assert [score["score"] for score in response.json()[0]["risk_scores"]] == [20.0, 30.0]
+    assert len(statements) == 3
+
+    response = client.get("/players/player20", params={"scores_limit": 1})
+    assert [score["score"] for score in response.json()["risk_scores"]] == [30.0]
+
+
+
+def test_players_batch_keeps_request_order_and_marks_misses(monkeypatch):
+    for username in ["alice", "bob"]:
+        create_player(username, state="inactive" if username == "bob" else "active")
+        for score in [10.0, 20.0, 30.0]:
+            client.post(f"/players/{username}/scores/", json={"score": score})
+
+    with count_queries() as statements:
+        response = client.post("/players/batch", json={"usernames": ["bob", "ghost", "alice"], "fields": ["state", "risk_scores"], "scores_limit": 2})
+    assert response.status_code == 200
+    bob, ghost, alice = response.json()
+    assert ghost == {"username": "ghost", "found": False}
+    assert bob["state"] == "inactive" and "birthday" not in bob
+    assert [score["score"] for score in alice["risk_scores"]] == [20.0, 30.0]
+    # one IN query for players, one windowed query for scores
+    assert len(statements) == 2
+
+    response = client.post("/players/batch", json={"usernames": ["alice"], "scores_limit": 0})
+    assert response.json()[0]["birthday"] == "1990-01-01" and response.json()[0]["risk_scores"] == []
+    assert client.post("/players/batch", json={"usernames": ["alice"], "scores_limit": 101}).status_code == 422
+
+    # Fast and validated responses are the same bytes, key order included
+    batch = {"usernames": ["bob", "ghost", "alice"]}
+    monkeypatch.setattr(settings, "fast_json_responses", False)
+    validated = client.post("/players/batch", json=batch)
+    monkeypatch.setattr(settings, "fast_json_responses", True)
+    assert client.post("/players/batch", json=batch).content == validated.content
+
+def test_score_stats_and_rollup():
+    create_player("player30")
+    create_player("player31", state="inactive", gender="female")
+    response = client.post(
+        "/scores/bulk",
+        json=[
+            {"username": "player30", "score": 10.0, "created_at": "2023-01-01T10:05:00"},
+            {"username": "player30", "score": 20.0, "created_at": "2023-01-01T10:40:00"},
+            {"username": "player30", "score": 30.0, "created_at": "2023-01-01T11:15:00"},
+            {"username": "player31", "score": 90.0, "created_at": "2023-01-02T09:00:00"},
+        ],
+    )
+    assert response.json()["inserted"] == 4
+
+    response = client.get("/players/player30/scores/stats/", params={"percentiles": [50]})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["count"] == 3
+    assert data["mean"] == 20.0
+    assert (data["min"], data["max"]) == (10.0, 30.0)
+    assert abs(data["stddev"] - 8.16496580927726) < 1e-9
+    assert data["percentiles"] == {"p50": 20.0}
+
+    response = client.get("/scores/stats/", params={"state": "inactive"})
+    assert response.json()["count"] == 1
+    assert response.json()["max"] == 90.0
+
+    response = client.get("/scores/stats/", params={"until": "2023-01-01T11:00:00"})
+    assert response.json()["count"] == 2
+
+    response = client.get("/scores/rollup/", params={"bucket": "hour", "username": "player30"})
+    assert [(bucket["bucket"], bucket["count"]) for bucket in response.json()] == [
+        ("2023-01-01T10:00:00", 2),
+        ("2023-01-01T11:00:00", 1),
+    ]
+
+    response = client.get("/scores/rollup/", params={"bucket": "day"})
+    assert [bucket["count"] for bucket in response.json()] == [3, 1]
+
+    assert client.get("/players/nobody/scores/stats/").status_code == 404
+    assert client.get("/scores/stats/", params={"percentiles": [120]}).status_code == 400
+
+
+def test_top_players_and_threshold_crossings():
+    now = datetime.datetime.now()
+    histories = {"calm": [10.0, 20.0], "spiky": [95.0, 30.0], "steady": [70.0, 75.0], "asleep": [90.0, 85.0]}
+    for username, scores in histories.items():
+        create_player(username, state="inactive" if username == "asleep" else "active")
+    create_player("new")
+    with TestingSessionLocal() as db:
+        crud.bulk_add_riskScores(db, [
+            (index, schemas.BulkRiskScoreIn(username=username, score=score, created_at=now - datetime.timedelta(minutes=90 - 60 * position)))
+            for index, (username, position, score) in enumerate(
+                (username, position, score) for username, scores in histories.items() for position, score in enumerate(scores))
+        ])
+
+    response = client.get("/players/top/", params={"k": 3})
+    assert [player["username"] for player in response.json()] == ["asleep", "steady", "spiky"]
+    response = client.get("/players/top/", params={"by": "average", "state": "active"})
+    assert [(player["username"], player["mean"]) for player in response.json()] == [("steady", 72.5), ("spiky", 62.5), ("calm", 15.0)]
+
+    # spiky's 95 was 90 minutes ago, outside the default one-hour window
+    response = client.get("/players/crossings/", params={"threshold": 70})
+    assert [(row["username"], row["max_score"]) for row in response.json()] == [("asleep", 85.0), ("steady", 75.0)]
+    response = client.get("/players/crossings/", params={"threshold": 70, "state": "active", "since": (now - datetime.timedelta(hours=2)).isoformat()})
+    assert [(row["username"], row["count"]) for row in response.json()] == [("spiky", 1), ("steady", 2)]
+
+
+def test_score_summary_is_maintained_on_insert():
+    create_player("player40")
+    create_player("player41")
+    client.post("/players/player40/scores/", json={"score": 10.0})
+    client.post("/players/player40/scores/", json={"score": 30.0})
+    client.post(
+        "/scores/bulk",
+        json=[
+            {"username": "player40", "score": 50.0, "created_at": "2000-01-01T00:00:00"},
+            {"username": "player41", "score": 70.0},
+        ],
+    )
+
+    response = client.get("/players/player40/scores/summary/")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["count"] == 3
+    assert data["mean"] == 30.0
+    assert (data["min"], data["max"]) == (10.0, 50.0)
+    # the back-dated bulk row does not replace the latest score
+    assert data["latest_score"] == 30.0
+    assert abs(data["variance"] - 800 / 3) < 1e-9
+
+    db = TestingSessionLocal()
+    try:
+        assert summary.check(db) == []
+
+        db.query(models.PlayerScoreSummary).filter_by(player_username="player41").update({"count": 99})
+        db.commit()
+        assert [problem["field"] for problem in summary.check(db)] == ["count"]
+
+        summary.rebuild(db)
+        assert summary.check(db) == []
+
+        # a missing summary row is created by the next score
+        db.query(models.PlayerScoreSummary).filter_by(player_username="player41").delete()
+        db.commit()
+    finally:
+        db.close()
+    client.post("/players/player41/scores/", json={"score": 90.0})
+    data = client.get("/players/player41/scores/summary/").json()
+    assert (data["count"], data["latest_score"]) == (1, 90.0)
+
+    assert client.delete("/players/player40").status_code == 200
+    db = TestingSessionLocal()
+    try:
+        assert db.query(models.PlayerScoreSummary).filter_by(player_username="player40").count() == 0
+    finally:
+        db.close()
+
+
+def test_keyset_pagination_of_scores_and_players():
+    create_player("player50")
+    client.post(
+        "/scores/bulk",
+        json=[
+            {"username": "player50", "score": float(score), "created_at": f"2023-01-0{day}T00:00:00"}
+            for score, day in [(1, 1), (2, 2), (3, 2), (4, 3), (5, 4)]
+        ],
+    )
+
+    seen, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        response = client.get("/players/player50/scores/", params=params)
+        assert response.status_code == 200
+        seen += [score["score"] for score in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert seen == [1.0, 2.0, 3.0, 4.0, 5.0]
+
+    response = client.get("/players/player50/scores/", params={"order": "desc", "limit": 2})
+    assert [score["score"] for score in response.json()] == [5.0, 4.0]
+    response = client.get("/players/player50/scores/", params={"order": "desc", "limit": 2, "cursor": response.headers["X-Next-Cursor"]})
+    assert [score["score"] for score in response.json()] == [3.0, 2.0]
+
+    response = client.get("/players/player50/scores/", params={"since": "2023-01-02T00:00:00", "until": "2023-01-03T00:00:00"})
+    assert [score["score"] for score in response.json()] == [2.0, 3.0]
+
+    assert client.get("/players/player50/scores/", params={"cursor": "bogus"}).status_code == 400
+
+    create_player("player51")
+    create_player("player52")
+    response = client.get("/players/", params={"limit": 2})
+    assert [player["username"] for player in response.json()] == ["player50", "player51"]
+    response = client.get("/players/", params={"limit": 2, "cursor": response.headers["X-Next-Cursor"]})
+    assert [player["username"] for player in response.json()] == ["player52"]
+    assert "X-Next-Cursor" not in response.headers
+
+
+def test_concurrent_state_toggles_are_not_lost():
+    from concurrent.futures import ThreadPoolExecutor
+
+    create_player("player60")
+
+    def toggle(_):
+        db = TestingSessionLocal()
+        try:
+            return crud.change_player_state(db, "player60")["state"]
+        finally:
+            db.close()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(toggle, range(40)))
+
+    # every toggle saw a distinct state transition, so an even count lands back on active
+    assert results.count("inactive") == 20
+    assert client.get("/players/player60/state/").json()["state"] == "active"
+    assert client.patch("/players/nobody/state/").status_code == 404
+
+
+def test_set_state_of_players_in_bulk():
+    create_player("player61")
+    create_player("player62", gender="female")
+    create_player("player63", gender="female")
+    client.get("/players/player61/state/")
+
+    response = client.patch("/players/state/", json={"state": "inactive", "usernames": ["player61", "player62", "nobody"]})
+    assert response.json() == {"updated": 2}
+    assert client.get("/players/player61/state/").json()["state"] == "inactive"
+
+    response = client.patch("/players/state/", json={"state": "active", "filter": {"gender": "female"}})
+    assert response.json() == {"updated": 2}
+    states = {player["username"]: player["state"] for player in client.get("/players/state/").json()}
+    assert states == {"player61": "inactive", "player62": "active", "player63": "active"}
+
+    assert client.patch("/players/state/", json={"state": "active"}).status_code == 422
+
+
+@pytest.mark.parametrize("path", ["/players/", "/players/state/", "/players/scores/", "/players/player70/scores/"])
+def test_fast_json_responses_match_validated_responses(path, monkeypatch):
+    create_player("player70", first_name="Zoë", middle_name="")
+    create_player("player71", gender="others", state="inactive")
+    for score in [0.00001, 12.5, 100.0]:
+        client.post("/players/player70/scores/", json={"score": score})
+
+    monkeypatch.setattr(settings, "fast_json_responses", False)
+    validated = client.get(path)
+    monkeypatch.setattr(settings, "fast_json_responses", True)
+    fast = client.get(path)
+
+    assert fast.status_code == validated.status_code == 200
+    assert fast.content == validated.content
+    assert fast.headers["content-type"] == validated.headers["content-type"]
+
+
+def test_fast_render_matches_stdlib_json():
+    from datetime import datetime as dt
+    from starlette.responses import JSONResponse
+    import responses
+
+    content = [{"score": value, "created_at": dt(2023, 1, 1, 10, 0, 0, 5), "name": "Zoë 1e5"}
+               for value in [0.0, 1e-05, 9.999e-05, 0.0001, 1 / 3, 100.0, 1e16, 1.5e20]]
+    expected = JSONResponse(content=[{**row, "created_at": row["created_at"].isoformat()} for row in content]).body
+    assert responses.render(content) == expected
+
+
+def test_state_listing_projects_columns_and_filters_in_sql():
+    create_player("player80")
+    create_player("player81", state="inactive")
+
+    with count_queries() as statements:
+        response = client.get("/players/state/", params={"state": "inactive"})
+    assert [player["username"] for player in response.json()] == ["player81"]
+    # the first statement is the ETag version lookup
+    assert len(statements) == 2
+    assert "birthday" not in statements[1]
+    assert "WHERE players.state" in statements[1]
+
+    response = client.get("/players/state/", params={"state": "active"})
+    assert [player["username"] for player in response.json()] == ["player80"]
+    assert client.get("/players/state/", params={"state": "unknown"}).status_code == 422
+
+    with engine.connect() as connection:
+        plan = connection.exec_driver_sql("EXPLAIN QUERY PLAN SELECT username FROM players WHERE state = 'active'").all()
+    assert any("ix_players_state" in row[-1] for row in plan)
+
+
+def test_metrics_endpoint_reports_routes_and_queries():
+    create_player("player90")
+    client.get("/players/player90")
+    client.get("/players/player90")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    text = response.text
+    assert '# TYPE http_request_duration_seconds histogram' in text
+    assert 'http_requests_total{method="GET",route="/players/{player_username}",status="200"}' in text
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/players/{player_username}",le="+Inf"}' in text
+    assert 'http_request_db_queries_count{route="/players/{player_username}"}' in text
+    assert "db_pool_checkout_wait_seconds_count" in text
+    assert "player_cache_misses_total" in text
+    assert "http_requests_in_flight" in text
+    assert float(response.headers["X-Process-Time"]) >= 0
+
+
+def test_failed_statements_leave_no_timing_state_on_the_connection():
+    from sqlalchemy import text
+    from sqlalchemy.exc import OperationalError
+
+    with engine.connect() as connection:
+        for _ in range(3):
+            with pytest.raises(OperationalError):
+                connection.execute(text("SELECT * FROM no_such_table"))
+        assert connection.execute(text("SELECT 1")).scalar() == 1
+        assert not any(key.endswith("query_start") for key in connection.info)
+
+
+def test_signed_request_is_profiled(tmp_path, monkeypatch):
+    import profiling
+    monkeypatch.setattr(settings, "profiling_enabled", True)
+    monkeypatch.setattr(settings, "profiling_secret", "s3cret")
+    monkeypatch.setattr(settings, "profiling_dir", str(tmp_path))
+    create_player("player91")
+
+    assert "X-Profile-Id" not in client.get("/players/player91").headers
+    bad = client.get("/players/player91", headers={"X-Profile-Timestamp": "0", "X-Profile-Signature": "0" * 64})
+    assert "X-Profile-Id" not in bad.headers
+    # a captured signature stops working once it is stale
+    stale = profiling.signed_headers("GET", "/players/player91", "s3cret", timestamp=int(time.time()) - 3600)
+    assert "X-Profile-Id" not in client.get("/players/player91", headers=stale).headers
+
+    response = client.get("/players/player91", headers=profiling.signed_headers("GET", "/players/player91", "s3cret"))
+    assert response.status_code == 200
+    profile_id = response.headers["X-Profile-Id"]
+    assert (tmp_path / f"{profile_id}.prof").exists()
+    # while another request holds the profiler, signed requests are served unprofiled
+    monkeypatch.setattr(profiling, "_event_loop_busy", True)
+    busy = client.get("/players/player91", headers=profiling.signed_headers("GET", "/players/player91", "s3cret"))
+    assert busy.status_code == 200 and "X-Profile-Id" not in busy.headers
+    monkeypatch.setattr(profiling, "_event_loop_busy", False)
+
+    path = f"/debug/profiles/{profile_id}"
+    assert client.get(path).status_code == 403
+    report = client.get(path, params={"sort": "tottime", "limit": 100000}, headers=profiling.signed_headers("GET", path, "s3cret"))
+    assert report.status_code == 200
+    # the threadpool hop that ran the query is merged into the same profile
+    assert "get_player_by_username" in report.text
+    assert client.get("/debug/profiles/missing", headers=profiling.signed_headers("GET", "/debug/profiles/missing", "s3cret")).status_code == 404
+
+
+def test_slow_query_log_records_statement_and_origin(tmp_path, monkeypatch, caplog):
+    import profiling
+    monkeypatch.setattr(settings, "slow_query_threshold_ms", 0.000001)
+    monkeypatch.setattr(settings, "profiling_secret", "s3cret")
+    monkeypatch.setattr(settings, "profiling_dir", str(tmp_path))
+    profiling.slow_queries.clear()
+    create_player("player92")
+
+    with caplog.at_level("WARNING", logger="slow_query"):
+        client.get("/players/scores/")
+    entry = next(entry for entry in profiling.slow_queries if entry["origin"] == "crud.get_scores_of_players")
+    assert "FROM" in entry["statement"]
+    assert entry["parameters"] is None
+    assert any("crud.get_scores_of_players" in record.getMessage() for record in caplog.records)
+
+    signed = profiling.signed_headers("GET", "/debug/slow-queries", "s3cret")
+    assert client.get("/debug/slow-queries", headers=signed).status_code == 404
+    monkeypatch.setattr(settings, "profiling_enabled", True)
+    assert client.get("/debug/slow-queries").status_code == 403
+    assert client.get("/debug/slow-queries", headers=signed).json()
+
+
+@pytest.mark.parametrize("path", ["/players/state/", "/players/scores/", "/players/player93", "/players/"])
+def test_polled_reads_answer_304_until_a_write(path):
+    create_player("player93")
+    client.post("/players/player93/scores/", json={"score": 10})
+
+    first = client.get(path)
+    etag = first.headers["ETag"]
+    assert etag.startswith('W/"')
+    assert first.headers["Cache-Control"] == settings.read_cache_control
+
+    with count_queries() as statements:
+        unchanged = client.get(path, headers={"If-None-Match": etag})
+    assert unchanged.status_code == 304
+    assert unchanged.content == b""
+    assert unchanged.headers["ETag"] == etag
+    # Only the version lookup ran, not the listing
+    assert len(statements) == 1 and "data_versions" in statements[0]
+
+    client.post("/players/player93/scores/", json={"score": 20})
+    client.patch("/players/player93/state/")
+    changed = client.get(path, headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+
+
+def test_etags_follow_bulk_writes_and_deletes():
+    create_player("player94")
+    create_player("player95")
+    etag = client.get("/players/player95").headers["ETag"]
+    state_etag = client.get("/players/state/", params={"state": "active"}).headers["ETag"]
+    assert state_etag != client.get("/players/state/").headers["ETag"]
+
+    client.patch("/players/state/", json={"state": "inactive", "filter": {"gender": "male"}})
+    assert client.get("/players/player95", headers={"If-None-Match": etag}).status_code == 200
+    etag = client.get("/players/player95").headers["ETag"]
+
+    client.delete("/players/player94")
+    assert client.get("/players/player95", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/players/state/", params={"state": "active"}, headers={"If-None-Match": state_etag}).status_code == 200
+
+
+def test_prune_archives_old_scores_and_history_reads_merge_them(tmp_path, monkeypatch):
+    import retention
+    monkeypatch.setattr(settings, "retention_archive_dir", str(tmp_path))
+    create_player("player96")
+    create_player("player97")
+    start = datetime.datetime(2020, 1, 1)
+    body = [
+        {"username": username, "score": index, "created_at": (start + datetime.timedelta(hours=12 * index)).isoformat()}
+        for index in range(6) for username in ("player96", "player97")
+    ]
+    assert client.post("/scores/bulk", json=body).json()["inserted"] == 12
+    etag = client.get("/players/player96").headers["ETag"]
+
+    db = TestingSessionLocal()
+    result = retention.prune(db, start + datetime.timedelta(days=2), batch_size=3, archive_dir=str(tmp_path))
+    assert result == {"deleted": 8, "archived": 8, "batches": 3, "players": 2}
+    assert db.query(models.RiskScores).count() == 4
+    assert summary.check(db) == []
+    db.close()
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "HORIZON", "scores-2020-01-01.ndjson.gz", "scores-2020-01-02.ndjson.gz"]
+    assert client.get("/players/player96", headers={"If-None-Match": etag}).status_code == 200
+
+    # Without a since before the horizon only live rows are read
+    assert [score["score"] for score in client.get("/players/player96/scores/").json()] == [4, 5]
+
+    # Cursor pages walk from the archive into the live table without gaps
+    seen, cursor = [], None
+    while True:
+        params = {"since": "2020-01-01T00:00:00", "limit": 4, **({"cursor": cursor} if cursor else {})}
+        response = client.get("/players/player96/scores/", params=params)
+        seen += [score["score"] for score in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert seen == [0, 1, 2, 3, 4, 5]
+
+    response = client.get("/players/player96/scores/", params={"since": "2020-01-01T00:00:00", "order": "desc", "limit": 3})
+    assert [score["score"] for score in response.json()] == [5, 4, 3]
+    # until is exclusive, as in the live query
+    response = client.get("/players/player96/scores/", params={"since": "2020-01-01T12:00:00", "until": "2020-01-02T12:00:00"})
+    assert [score["score"] for score in response.json()] == [1, 2]
+
+
+def test_buffered_score_ingest_group_commits_with_backpressure(monkeypatch):
+    import ingest
+    import threading
+    release = threading.Event()
+
+    def slow_sessions():
+        # Holds the writer in its first flush so the queue can fill up
+        release.wait(5)
+        return TestingSessionLocal()
+
+    ingestor = ingest.ScoreIngestor(slow_sessions, max_size=2, flush_rows=1, flush_interval=0.01)
+    monkeypatch.setattr(ingest, "ingestor", ingestor)
+    monkeypatch.setattr(settings, "buffered_score_ingest", True)
+    create_player("player98")
+
+    accepted = []
+    for score in [10, 20, 30]:
+        response = client.post("/players/player98/scores/", json={"score": score})
+        assert response.status_code == 202
+        accepted.append(response.json()["ingestion_id"])
+        if score == 10:
+            # wait for the writer to pick it up, leaving the queue empty
+            while ingestor.queue.qsize():
+                pass
+    rejected = client.post("/players/player98/scores/", json={"score": 40})
+    assert rejected.status_code == 429
+    assert rejected.headers["Retry-After"] == "1"
+    assert client.post("/players/nobody/scores/", json={"score": 1}).status_code == 404
+    assert client.get(f"/scores/ingest/{accepted[-1]}").json()["status"] == "queued"
+
+    release.set()
+    ingestor.stop()
+    assert [score["score"] for score in client.get("/players/player98/scores/").json()] == [10, 20, 30]
+    assert client.get("/players/player98/scores/summary/").json()["count"] == 3
+    assert all(client.get(f"/scores/ingest/{ingestion_id}").json()["status"] == "committed" for ingestion_id in accepted)
+    assert client.get("/scores/ingest/unknown-1").status_code == 404
+
+    text = client.get("/metrics").text
+    assert "score_ingest_queue_depth 0" in text
+    assert "score_ingest_flush_seconds_count" in text
+
+
+def test_buffered_score_flush_retries_locks_and_isolates_bad_rows(monkeypatch):
+    import ingest
+    from sqlalchemy.exc import IntegrityError, OperationalError
+    create_player("player95")
+    real_bulk_add, calls = crud.bulk_add_riskScores, []
+
+    def flaky_bulk_add(db, items):
+        calls.append(len(items))
+        if len(calls) == 1:
+            raise OperationalError("INSERT", {}, sqlite3.OperationalError("database is locked"))
+        if any(item.username == "deleted" for _, item in items):
+            # a player deleted between the 202 and the flush
+            raise IntegrityError("INSERT", {}, sqlite3.IntegrityError("FOREIGN KEY constraint failed"))
+        return real_bulk_add(db, items)
+
+    monkeypatch.setattr(crud, "bulk_add_riskScores", flaky_bulk_add)
+    ingestor = ingest.ScoreIngestor(TestingSessionLocal, retries=2, retry_backoff=0)
+    now = datetime.datetime.now()
+    ingestor.flush([(1, "player95", 10, now), (2, "deleted", 20, now), (3, "player95", 30, now), (4, "player95", 40, now)])
+
+    assert list(ingestor.failed) == [2]
+    assert ingestor.committed_through == 4
+    # the locked attempt, the retry, then halves and quarters of the batch
+    assert calls == [4, 4, 2, 1, 1, 2]
+    assert [score["score"] for score in client.get("/players/player95/scores/").json()] == [10, 30, 40]
+
+
+def test_admission_control_rate_limits_per_client_and_sheds_when_busy(monkeypatch):
+    import admission
+    controller = admission.AdmissionController(admission.KeyValueBucketStore(FakeKeyValueClient()))
+    monkeypatch.setattr(admission, "controller", controller)
+    monkeypatch.setattr(settings, "admission_enabled", True)
+    monkeypatch.setattr(settings, "admission_client_header", "X-Client-Id")
+    monkeypatch.setattr(settings, "admission_point_read_rate", 0.01)
+    monkeypatch.setattr(settings, "admission_point_read_burst", 2)
+    create_player("player97")
+
+    alice = {"X-Client-Id": "alice"}
+    assert [client.get("/players/player97", headers=alice).status_code for _ in range(3)] == [200, 200, 429]
+    limited = client.get("/players/player97/state/", headers=alice)
+    assert limited.status_code == 429
+    assert int(limited.headers["Retry-After"]) >= 90
+    # Other clients and other route classes have their own buckets
+    assert client.get("/players/player97", headers={"X-Client-Id": "bob"}).status_code == 200
+    assert client.get("/players/", headers=alice).status_code == 200
+
+    monkeypatch.setattr(settings, "admission_max_in_flight", 1)
+    controller.in_flight = 1
+    busy = client.get("/players/", headers={"X-Client-Id": "carol"})
+    assert busy.status_code == 503
+    assert busy.headers["Retry-After"] == "1"
+    assert client.get("/metrics").status_code == 200
+    controller.in_flight = 0
+
+    class BrokenStore:
+        async def take(self, *args):
+            raise ConnectionError("store is down")
+
+    # an unreachable store lets requests through instead of failing them
+    monkeypatch.setattr(controller, "store", BrokenStore())
+    assert client.get("/players/player97", headers=alice).status_code == 200
+
+    text = client.get("/metrics").text
+    assert "admission_store_errors_total 1" in text
+    assert 'admission_shed_total{reason="rate_limited",route_class="point_read"} 2' in text
+    assert 'admission_shed_total{reason="overloaded",route_class="list_read"} 1' in text
+    assert 'http_requests_total{method="GET",route="/players/{player_username}",status="429"}' in text
+    assert "admission_in_flight 0" in text
+
+
+def test_schema_is_migrated_by_startup_not_import(monkeypatch):
+    import startup
+    calls = []
+    monkeypatch.setattr(startup, "init_db", lambda: calls.append("init_db"))
+    monkeypatch.setattr(startup, "check_schema", lambda: calls.append("check_schema"))
+    with TestClient(app):
+        pass
+    assert calls == ["init_db"]
+
+    # gunicorn workers only check the version; the master migrated once before forking
+    monkeypatch.setattr(settings, "migrate_on_startup", False)
+    with TestClient(app):
+        pass
+    assert calls == ["init_db", "check_schema"]
+
+
+def test_migrations_upgrade_an_old_database_and_gate_startup(tmp_path):
+    old_engine = make_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    migrations.upgrade(old_engine, target=1)
+    with old_engine.begin() as connection:
+        connection.execute(models.Player.__table__.insert().values(
+            username="veteran", first_name="A", last_name="B", birthday=datetime.date(1990, 1, 1), gender="male", state="active"))
+        connection.execute(models.RiskScores.__table__.insert().values(
+            player_username="veteran", score=40.0, created_at=datetime.datetime(2020, 1, 1)))
+    with pytest.raises(migrations.SchemaOutOfDate):
+        migrations.check(old_engine)
+
+    applied = migrations.upgrade(old_engine)
+    assert [version for version, _ in applied] == list(range(2, migrations.LATEST + 1))
+    assert migrations.check(old_engine) == migrations.LATEST
+    assert migrations.upgrade(old_engine) == []
+    with sessionmaker(bind=old_engine)() as db:
+        assert summary.get_summary(db, "veteran")["count"] == 1
+    old_engine.dispose()
+
+
+def test_change_feed_outbox_sse_and_websocket(monkeypatch):
+    monkeypatch.setattr(settings, "change_feed_poll_seconds", 0.1)
+    monkeypatch.setattr(settings, "change_feed_max_stream_seconds", 0.5)
+    create_player("alice")
+    create_player("bob")
+    client.post("/players/alice/scores/", json={"score": 42.0})
+    client.patch("/players/alice/state/")
+    client.delete("/players/bob")
+
+    response = client.get("/events/")
+    assert [(event["type"], event["username"]) for event in response.json()] == [
+        ("player.created", "alice"), ("player.created", "bob"), ("score.added", "alice"),
+        ("state.changed", "alice"), ("player.deleted", "bob"),
+    ]
+    assert [event["seq"] for event in response.json()] == sorted(event["seq"] for event in response.json())
+    response = client.get("/events/", params={"username": "alice", "type": "state.changed"})
+    assert [event["data"] for event in response.json()] == [{"state": "inactive"}]
+
+    # Resuming over SSE replays the outbox after Last-Event-ID, then ends the stream
+    third = client.get("/events/").json()[2]["seq"]
+    response = client.get("/events/stream", headers={"Last-Event-ID": str(third)})
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert "event: state.changed" in response.text and "event: score.added" not in response.text
+
+    # A WebSocket subscriber gets later writes pushed
+    monkeypatch.setattr(settings, "change_feed_max_stream_seconds", 5)
+    last = client.get("/events/").json()[-1]["seq"]
+    with client.websocket_connect(f"/events/ws?username=alice&after={last}") as websocket:
+        client.post("/players/alice/scores/", json={"score": 7.0})
+        event = websocket.receive_json()
+    assert event["type"] == "score.added" and event["data"]["score"] == 7.0
+
+
+def test_writes_without_returning_support(monkeypatch):
+    # What SQLAlchemy reports for SQLite before 3.35
+    for flag in ("insert_returning", "insert_executemany_returning", "insert_executemany_returning_sort_by_parameter_order",
+                 "update_returning", "delete_returning"):
+        monkeypatch.setattr(engine.dialect, flag, False)
+    create_player("alice")
+    create_player("bob")
+    response = client.post("/scores/bulk", json=[{"username": "alice", "score": 1.0}, {"username": "bob", "score": 2.0}])
+    assert response.status_code == 200
+    assert client.patch("/players/alice/state/").json()["state"] == "inactive"
+    assert client.patch("/players/state/", json={"state": "inactive", "usernames": ["bob"]}).json() == {"updated": 1}
+
+    events = client.get("/events/").json()
+    assert [(event["type"], event["username"]) for event in events] == [
+        ("player.created", "alice"), ("player.created", "bob"), ("score.added", "alice"), ("score.added", "bob"),
+        ("state.changed", "alice"), ("state.changed", None),
+    ]
+    assert [event["seq"] for event in events] == list(range(events[0]["seq"], events[0]["seq"] + 6))
+
+
+def test_change_feed_follow_delivers_out_of_order_events_in_sequence():
+    import asyncio
+    import events
+
+    def event(seq):
+        return {"seq": seq, "type": events.SCORE_ADDED, "username": "alice", "data": {}, "created_at": ""}
+
+    async def run(committed, published, hidden_reads=None, commit_lag=0):
+        # committed: seqs that reach the outbox once the feed is running; published:
+        # seqs handed to this process's bus, in that order; hidden_reads: seq -> how
+        # many outbox reads hold back it and every later row, like rows inside
+        # PostgreSQL's commit lag
+        outbox, hidden_reads = [], dict(hidden_reads or {})
+
+        async def read(last):
+            held_back = min([seq for seq, reads in hidden_reads.items() if reads], default=None)
+            for seq in hidden_reads:
+                hidden_reads[seq] = max(0, hidden_reads[seq] - 1)
+            return [event(seq) for seq in outbox if seq > last and (held_back is None or seq < held_back)]
+
+        subscription = events.bus.subscribe()
+        received = []
+        try:
+            feed = events.follow(subscription, read, 0, poll_interval=0.5, duration=2, commit_lag=commit_lag)
+            # Commit and publish while the feed waits on its queue, between outbox reads
+            waiting = asyncio.ensure_future(feed.__anext__())
+            await asyncio.sleep(0.05)
+            outbox.extend(committed)
+            events.bus.publish([event(seq) for seq in published])
+            item = await waiting
+            while True:
+                if item is not None:
+                    received.append(item["seq"])
+                if len(received) == len(committed):
+                    break
+                try:
+                    item = await feed.__anext__()
+                except StopAsyncIteration:
+                    break
+            await feed.aclose()
+        finally:
+            events.bus.unsubscribe(subscription)
+        return received
+
+    # seq 1 committed by another worker, only seq 2 published here
+    assert asyncio.run(run([1, 2], [2])) == [1, 2]
+    # another thread of this worker publishes its lower seq late
+    assert asyncio.run(run([1, 2, 3], [1, 3, 2])) == [1, 2, 3]
+    # seq 1 commits late and stays out of outbox reads for a while
+    assert asyncio.run(run([1, 2], [2], hidden_reads={1: 2}, commit_lag=0.05)) == [1, 2]
@@ -0,0 +1,63 @@
+from sqlalchemy.orm import Session
+from typing import Iterable, List
+import hashlib
+import models
+from database import upsert
+
+Version = models.DataVersion
+
+# Table-wide counters for the listings
+PLAYERS = "players"
+SCORES = "scores"
+# Bumped when players change without us knowing which ones (filter-based bulk updates)
+ALL_PLAYERS = "players:*"
+
+
+def player_key(player_username: str):
+    return f"player:{player_username}"
+
+
+# Built once per dialect
+_bump_statements = {}
+
+
+def _bump_statement(db: Session):
+    dialect = db.get_bind().dialect.name
+    if dialect not in _bump_statements:
+        _bump_statements[dialect] = upsert(db, Version.__table__).on_conflict_do_update(
+            index_elements=[Version.key], set_={"version": Version.__table__.c.version + 1})
+    return _bump_statements[dialect]
+
+
+def bump(db: Session, keys: Iterable[str]):
+    # Called inside the write's transaction, before commit, so a rolled back
+    # write never changes an ETag. Rows are kept on delete: a re-created player
+    # must not get back a version an old client still holds. One upsert, so two
+    # first writes to the same key can't both try to insert it.
+    keys = sorted(set(keys))
+    if keys:
+        db.execute(_bump_statement(db), [{"key": key, "version": 1} for key in keys])
+
+
+def get_versions(db: Session, keys: List[str]):
+    found = dict(db.query(Version.key, Version.version).filter(Version.key.in_(keys)))
+    return [found.get(key, 0) for key in keys]
+
+
+def etag(keys: List[str], versions: List[int], variant: str = ""):
+    # variant is the path and query string, so e.g. ?state=active gets its own tag
+    digest = hashlib.sha1(repr((keys, versions, variant)).encode()).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def etag_matches(if_none_match: str, etag: str):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, as If-None-Match requires
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    return any(
+        (candidate[2:] if candidate.startswith("W/") else candidate) == opaque
+        for candidate in (part.strip() for part in if_none_match.split(","))
+    )